@@ -71,6 +71,8 @@ setuptools.setup(
         appcfg_service = typhoonae.appcfg.service:main
         appserver = typhoonae.fcgiserver:main
         apptool = typhoonae.apptool:main
+        datastore_migrate = typhoonae.migrate:main
+        datastore_mysql_upgrade = typhoonae.mysql.upgrade:main
         ejabberdauth = typhoonae.xmpp.ejabberdauth:main
         runtask = typhoonae.runtask:main
         websocket = typhoonae.websocket.server:main
@@ -1,7 +1,13 @@
 import rpc_pb2
+import select
 import socket
 import struct
+import sys
+import threading
+import time
 
+from google.appengine.api import api_base_pb
+from google.appengine.api import apiproxy_rpc
 from google.appengine.api import apiproxy_stub
 from google.appengine.datastore import datastore_pb
 from google.appengine.runtime import apiproxy_errors
@@ -9,6 +15,24 @@ from google.appengine.runtime import apiproxy_errors
 
 MAX_REQUEST_SIZE = 1 << 20
 
+# Initial size of the buffer responses are received into.
+RECEIVE_BUFFER_SIZE = 64 << 10
+
+# Number of idle connections kept open between requests.
+POOL_SIZE = 4
+
+# Idle connections are closed after this many seconds.
+MAX_IDLE_TIME = 300
+
+# Connections are retired once the server holds this many cursors which were
+# opened through them but never read to the end.
+MAX_OPEN_CURSORS = 1000
+
+try:
+  memoryview
+except NameError:
+  memoryview = None
+
 # Stolen from google.appengine.runtime.apiproxy
 OK                =  0
 RPC_FAILED        =  1
@@ -53,29 +77,141 @@ _ExceptionsMap = {
 }
 
 
-class SocketApiProxyStub(apiproxy_stub.APIProxyStub):
-  def __init__(self, endpoint, max_request_size=MAX_REQUEST_SIZE):
-    self._endpoint = endpoint
-    self._max_request_size = max_request_size
-    self._sock = None
+class RPC(object):
+  """A pending call which completes once its response was read."""
+
+  def __init__(self, connection, rpc_id, service, method, response):
+    self.connection = connection
+    self.rpc_id = rpc_id
+    self.service = service
+    self.method = method
+    self.response = response
+    self._response_wrapper = None
+    self._exc_info = None
+    self.callback = None
+
+  def done(self):
+    return self._response_wrapper is not None or self._exc_info is not None
+
+  def wait(self):
+    """Blocks until the response arrived."""
+    self.connection.wait(self)
+
+  def get_result(self):
+    """Waits for the response and fills the response PB.
+
+    Raises:
+      The exception of a failed call.
+    """
+    self.wait()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    response_wrapper = self._response_wrapper
+    if response_wrapper.status == APPLICATION_ERROR:
+      raise apiproxy_errors.ApplicationError(
+          response_wrapper.application_error,
+          response_wrapper.error_detail)
+    elif response_wrapper.status in _ExceptionsMap:
+      ex, message = _ExceptionsMap[response_wrapper.status]
+      raise ex(message % (self.service, self.method))
+    else:
+      self.response.ParseFromString(response_wrapper.body)
+    if self.callback is not None:
+      callback, self.callback = self.callback, None
+      callback()
+    return self.response
+
+  def MakeSyncCall(self, service, method, request, response):
+    """Waits for the response, see PipelinedRPC."""
+    self.get_result()
+
+
+class Connection(object):
+  """A socket which carries any number of RPCs at once.
+
+  Requests are written as soon as they are made. Responses are matched to
+  their requests by rpc_id, so they may arrive in any order. Whichever thread
+  waits for a response reads from the socket and hands responses of other
+  RPCs over to them.
+  """
+
+  def __init__(self, endpoint):
+    self._sock = socket.socket()
+    self._sock.connect(endpoint)
+    self._send_lock = threading.Lock()
+    self._lock = threading.Condition()
+    self._pending = {}
+    self._reading = False
     self._next_rpc_id = 0
+    self._buffer = None
+    self.closed = False
+    # Session state the server keeps for this connection.
+    self.transactions = {}
+    self.cursors = set()
+    self.released_at = None
 
-  def closeSession(self):
-    if self._sock:
-      self._sock.close()
-      self._sock = None
+  def close(self, exc_info=None):
+    """Closes the socket and fails all pending RPCs."""
+    self._lock.acquire()
+    try:
+      if not self.closed:
+        self.closed = True
+        self._sock.close()
+      if exc_info is None:
+        exc_info = (socket.error, socket.error('Connection closed'), None)
+      for rpc in self._pending.values():
+        rpc._exc_info = exc_info
+      self._pending.clear()
+      self._lock.notifyAll()
+    finally:
+      self._lock.release()
+
+  def isIdle(self):
+    """Whether the connection is open and no RPC is in flight."""
+    self._lock.acquire()
+    try:
+      return not self.closed and not self._pending and not self._reading
+    finally:
+      self._lock.release()
+
+  def isHealthy(self):
+    """Checks an idle connection without blocking.
+
+    An idle socket must not be readable; if it is, the server either closed
+    it or sent data nobody asked for.
+    """
+    if not self.isIdle():
+      return False
+    try:
+      readable, _, _ = select.select([self._sock], [], [], 0)
+    except (select.error, socket.error):
+      return False
+    return not readable
 
   def _recvAll(self, size):
-    # We should use buffers here, but can't in the dev_appserver.
-    data = []
-    data_size = 0
-    while data_size < size:
-      d = self._sock.recv(size)
-      if len(d) == 0:
-        raise socket.error()
-      data.append(d)
-      data_size += len(d)
-    return ''.join(data)
+    if memoryview is None:
+      data = []
+      data_size = 0
+      while data_size < size:
+        d = self._sock.recv(size - data_size)
+        if len(d) == 0:
+          raise socket.error('Connection closed by server')
+        data.append(d)
+        data_size += len(d)
+      return ''.join(data)
+
+    # Receives into a buffer which is reused for all responses.
+    if self._buffer is None or len(self._buffer) < size:
+      self._buffer = bytearray(max(size, RECEIVE_BUFFER_SIZE))
+    view = memoryview(self._buffer)
+    received = 0
+    while received < size:
+      n = self._sock.recv_into(view[received:size])
+      if n == 0:
+        raise socket.error('Connection closed by server')
+      received += n
+    return view[:size].tobytes()
 
   def _writePB(self, pb):
     self._sock.sendall(struct.pack("!i", pb.ByteSize()) + pb.SerializeToString())
@@ -86,42 +222,232 @@ class SocketApiProxyStub(apiproxy_stub.APIProxyStub):
     pb.MergeFromString(data)
     return pb
 
-  def _sendRPC(self, service, method, request, response):
+  def send(self, service, method, request, response):
+    """Writes a request and returns its RPC."""
+    request_wrapper = rpc_pb2.Request()
+    request_wrapper.service = service
+    request_wrapper.method = method
+    request_wrapper.body = request.Encode()
+
+    self._send_lock.acquire()
     try:
-      request_wrapper = rpc_pb2.Request()
-      request_wrapper.rpc_id = self._next_rpc_id
-      self._next_rpc_id += 1
-      request_wrapper.service = service
-      request_wrapper.method = method
-      request_wrapper.body = request.Encode()
-      self._writePB(request_wrapper)
-      
-      response_wrapper = rpc_pb2.Response()
-      self._readPB(response_wrapper)
+      self._lock.acquire()
+      try:
+        if self.closed:
+          raise socket.error('Connection closed')
+        request_wrapper.rpc_id = self._next_rpc_id
+        self._next_rpc_id += 1
+        rpc = RPC(self, request_wrapper.rpc_id, service, method, response)
+        # Registers the RPC first, its response may arrive at any time.
+        self._pending[rpc.rpc_id] = rpc
+      finally:
+        self._lock.release()
+      try:
+        self._writePB(request_wrapper)
+      except:
+        # Any exception here should cause us to close the socket to make sure
+        # we don't leave it in an unknown state.
+        self.close(sys.exc_info())
+        raise
+    finally:
+      self._send_lock.release()
+    return rpc
+
+  def wait(self, rpc):
+    """Reads responses until the one of an RPC arrived.
+
+    The socket is only read by one thread at a time, the others wait until
+    it hands their response over or finishes reading.
+    """
+    self._lock.acquire()
+    try:
+      while not rpc.done():
+        if self._reading:
+          self._lock.wait()
+          continue
+        self._reading = True
+        self._lock.release()
+        exc_info = None
+        try:
+          response_wrapper = self._readPB(rpc_pb2.Response())
+        except:
+          exc_info = sys.exc_info()
+        self._lock.acquire()
+        self._reading = False
+        if exc_info is None:
+          other = self._pending.pop(response_wrapper.rpc_id, None)
+          if other is None:
+            exc_info = (AssertionError, AssertionError(
+                'Unexpected rpc_id %d' % response_wrapper.rpc_id), None)
+          else:
+            other._response_wrapper = response_wrapper
+        if exc_info is not None:
+          # The stream can't be trusted anymore.
+          self.close(exc_info)
+        self._lock.notifyAll()
+    finally:
+      self._lock.release()
+
+
+class PipelinedRPC(apiproxy_rpc.RPC):
+  """An apiproxy RPC whose request is sent as soon as it is made.
+
+  Waiting lets the SDK's RPC make a synchronous call against the pending
+  RPC, so callbacks and error handling are those of the SDK.
+  """
+
+  def _MakeCallImpl(self):
+    super(PipelinedRPC, self)._MakeCallImpl()
+    self.stub = self.stub.MakeCall(
+        self.package, self.call, self.request, self.response)
+
+
+class ConnectionPool(object):
+  """Keeps connections open across requests."""
+
+  def __init__(self, endpoint, size=POOL_SIZE, max_idle_time=MAX_IDLE_TIME,
+               clock=time.time):
+    self._endpoint = endpoint
+    self._size = size
+    self._max_idle_time = max_idle_time
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._idle = []
+
+  def get(self):
+    """Returns a healthy idle connection or a new one."""
+    while True:
+      self._lock.acquire()
+      try:
+        if not self._idle:
+          break
+        connection = self._idle.pop()
+      finally:
+        self._lock.release()
+      if (self._clock() - connection.released_at <= self._max_idle_time
+          and connection.isHealthy()):
+        return connection
+      connection.close()
+    return Connection(self._endpoint)
+
+  def release(self, connection):
+    """Takes a connection back or closes it."""
+    if connection.isIdle():
+      connection.released_at = self._clock()
+      self._lock.acquire()
+      try:
+        if len(self._idle) < self._size:
+          self._idle.append(connection)
+          return
+      finally:
+        self._lock.release()
+    connection.close()
+
+  def clear(self):
+    """Closes all idle connections."""
+    self._lock.acquire()
+    try:
+      idle, self._idle = self._idle, []
+    finally:
+      self._lock.release()
+    for connection in idle:
+      connection.close()
+
+
+class SocketApiProxyStub(apiproxy_stub.APIProxyStub):
+  def __init__(self, endpoint, max_request_size=MAX_REQUEST_SIZE,
+               pool_size=POOL_SIZE):
+    self._endpoint = endpoint
+    self._max_request_size = max_request_size
+    self._pool = ConnectionPool(endpoint, pool_size)
+    self._connection = None
+    self._connection_lock = threading.Lock()
+
+  def closeSession(self):
+    """Closes the connection of the current request and all idle ones."""
+    self._connection_lock.acquire()
+    try:
+      if self._connection:
+        self._connection.close()
+        self._connection = None
+    finally:
+      self._connection_lock.release()
+    self._pool.clear()
+
+  def releaseSession(self):
+    """Resets the session state of the current request.
+
+    Rolls back transactions the request left open and returns the connection
+    to the pool. Cursors can't be freed without closing the connection, so
+    connections which accumulated too many of them are closed instead.
+    """
+    self._connection_lock.acquire()
+    try:
+      connection, self._connection = self._connection, None
+    finally:
+      self._connection_lock.release()
+    if connection is None:
+      return
+
+    try:
+      for transaction in connection.transactions.values():
+        connection.send('datastore_v3', 'Rollback', transaction,
+                        api_base_pb.VoidProto()).get_result()
+      connection.transactions.clear()
     except:
-      # Any exception here should cause us to close the socket to make sure we
-      # don't leave it in an unknown state.
-      self.closeSession()
-      raise
+      connection.close()
+    if len(connection.cursors) > MAX_OPEN_CURSORS:
+      connection.close()
+    self._pool.release(connection)
+
+  def _getConnection(self):
+    self._connection_lock.acquire()
+    try:
+      if self._connection is None or self._connection.closed:
+        # The session state of a closed connection is gone with it.
+        self._connection = self._pool.get()
+      return self._connection
+    finally:
+      self._connection_lock.release()
+
+  def _trackSession(self, connection, call, request, rpc):
+    """Records transactions and cursors the server keeps for a call."""
+    if call in ('Commit', 'Rollback'):
+      connection.transactions.pop(request.handle(), None)
+    elif call == 'BeginTransaction':
+      def callback():
+        connection.transactions[rpc.response.handle()] = rpc.response
+      rpc.callback = callback
+    elif call == 'RunQuery':
+      def callback():
+        result = rpc.response
+        if result.more_results() and result.has_cursor():
+          connection.cursors.add(result.cursor().cursor())
+      rpc.callback = callback
+    elif call == 'Next':
+      cursor = request.cursor().cursor()
+      def callback():
+        if not rpc.response.more_results():
+          connection.cursors.discard(cursor)
+      rpc.callback = callback
+
+  def MakeCall(self, service, call, request, response):
+    """Sends a request without waiting for its response.
+
+    Returns:
+      An RPC whose get_result() method fills the response.
+    """
+    connection = self._getConnection()
+    rpc = connection.send(service, call, request, response)
+    if service == 'datastore_v3':
+      self._trackSession(connection, call, request, rpc)
+    return rpc
 
-    assert response_wrapper.rpc_id == request_wrapper.rpc_id
-    
-    if response_wrapper.status == APPLICATION_ERROR:
-      raise apiproxy_errors.ApplicationError(
-          response_wrapper.application_error,
-          response_wrapper.error_detail)
-    elif response_wrapper.status in _ExceptionsMap:
-      ex, message = _ExceptionsMap[response_wrapper.status]
-      raise ex(message % (service, method))
-    else:
-      response.ParseFromString(response_wrapper.body)
-  
   def MakeSyncCall(self, service, call, request, response):
-    if not self._sock:
-      self._sock = socket.socket()
-      self._sock.connect(self._endpoint)
-    
-    self._sendRPC(service, call, request, response)
+    self.MakeCall(service, call, request, response).get_result()
+
+  def CreateRPC(self):
+    return PipelinedRPC(stub=self)
 
 
 class RecordingSocketApiProxyStub(SocketApiProxyStub):
@@ -130,13 +456,13 @@ class RecordingSocketApiProxyStub(SocketApiProxyStub):
         endpoint, max_request_size)
     self.__query_history = {}
 
-  def MakeSyncCall(self, service, call, request, response):
+  def MakeCall(self, service, call, request, response):
     if service == 'datastore_v3' and call == 'RunQuery':
       clone = datastore_pb.Query()
       clone.CopyFrom(request)
       clone.clear_hint()
       self.__query_history[clone] = self.__query_history.get(clone, 0) + 1
-    super(RecordingSocketApiProxyStub, self).MakeSyncCall(
+    return super(RecordingSocketApiProxyStub, self).MakeCall(
         service, call, request, response)
   
   def QueryHistory(self):
@@ -142,13 +142,20 @@ def setupDatastore(options, conf, datastore_file, history, require_indexes, trus
     if name == 'mongodb':
         from typhoonae.mongodb import datastore_mongo_stub
         datastore = datastore_mongo_stub.DatastoreMongoStub(
-            conf.application, require_indexes=require_indexes)
+            conf.application, require_indexes=require_indexes,
+            root_path=os.getcwd(),
+            uri=options.mongodb_uri,
+            pool_size=options.mongodb_pool_size,
+            network_timeout=options.mongodb_timeout,
+            replica_set=options.mongodb_replica_set,
+            write_concern=options.mongodb_write_concern,
+            read_preference=options.mongodb_read_preference)
     elif name == 'bdbdatastore':
         from notdot.bdbdatastore import socket_apiproxy_stub
         datastore = socket_apiproxy_stub.RecordingSocketApiProxyStub(
             ('localhost', 9123))
         global end_request_hook
-        end_request_hook = datastore.closeSession
+        end_request_hook = datastore.releaseSession
     elif name == 'mysql':
         from typhoonae.mysql import datastore_mysql_stub
         database_info = {
@@ -158,7 +165,8 @@ def setupDatastore(options, conf, datastore_file, history, require_indexes, trus
             "db": options.mysql_db
         }
         datastore = datastore_mysql_stub.DatastoreMySQLStub(
-            conf.application, database_info, verbose=options.debug_mode)
+            conf.application, database_info, verbose=options.debug_mode,
+            pool_size=options.mysql_pool_size)
     elif name == 'sqlite':
       from google.appengine.datastore import datastore_sqlite_stub
       datastore = datastore_sqlite_stub.DatastoreSqliteStub(
@@ -167,15 +175,27 @@ def setupDatastore(options, conf, datastore_file, history, require_indexes, trus
     else:
         raise RuntimeError, "unknown datastore"
 
+    if options.datastore_cache:
+        from typhoonae import datastore_cache_stub
+        kinds = datastore_cache_stub.parseKinds(options.datastore_cache)
+        datastore = datastore_cache_stub.DatastoreCacheStub(
+            datastore, kinds,
+            query_cache_size=options.datastore_query_cache or 0)
+
     apiproxy_stub_map.apiproxy.RegisterStub(
         'datastore_v3', datastore)
 
-    if name == 'bdbdatastore':
+    if name in ('mongodb', 'mysql'):
+        from typhoonae import multiquery
+        multiquery.install()
+
+    if name in ('bdbdatastore', 'mysql'):
         from google.appengine.tools import dev_appserver_index
         app_root = os.getcwd()
         logging.info("%s" % app_root)
         dev_appserver_index.SetupIndexes(conf.application, app_root)
-        dev_appserver_index.IndexYamlUpdater(app_root)
+        if name == 'bdbdatastore':
+            dev_appserver_index.IndexYamlUpdater(app_root)
 
 
 def setupRdbmsSQLite(path):
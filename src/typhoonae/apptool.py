@@ -659,6 +659,21 @@ def write_supervisor_conf(options, conf, app_root):
         additional_options.append(('websocket_host', websocket_host))
         additional_options.append(('websocket_port', websocket_port))
 
+    if options.datastore_cache:
+        additional_options.append(
+            ('datastore_cache', options.datastore_cache))
+
+    if options.datastore_query_cache:
+        additional_options.append(
+            ('datastore_query_cache', options.datastore_query_cache))
+
+    if datastore == 'mongodb':
+        for opt in ('mongodb_pool_size', 'mongodb_read_preference',
+                    'mongodb_replica_set', 'mongodb_timeout', 'mongodb_uri',
+                    'mongodb_write_concern'):
+            if getattr(options, opt):
+                additional_options.append((opt, getattr(options, opt)))
+
     if datastore == 'mysql':
         if options.mysql_db:
             additional_options.append(('mysql_db', options.mysql_db))
@@ -669,6 +684,10 @@ def write_supervisor_conf(options, conf, app_root):
         if options.mysql_passwd:
             additional_options.append(('mysql_passwd', options.mysql_passwd))
 
+        if options.mysql_pool_size:
+            additional_options.append(
+                ('mysql_pool_size', options.mysql_pool_size))
+
         if options.mysql_user:
             additional_options.append(('mysql_user', options.mysql_user))
 
@@ -955,6 +974,16 @@ def main():
                       % '/'.join(sorted(typhoonae.SUPPORTED_DATASTORES)),
                   default='mongodb')
 
+    op.add_option("--datastore_cache", dest="datastore_cache",
+                  metavar="KIND[:TTL],...",
+                  help="cache entities of these kinds ('*' for all) in "
+                       "memcache", default=None)
+
+    op.add_option("--datastore_query_cache", dest="datastore_query_cache",
+                  metavar="NUM", type="int",
+                  help="maximum number of cached queries of the kinds "
+                       "given by --datastore_cache", default=None)
+
     op.add_option("--develop", dest="develop_mode", action="store_true",
                   help="configure application for development", default=False)
 
@@ -1032,6 +1061,33 @@ def main():
     op.add_option("--multiple", dest="multiple", action="store_true",
                   help="configure multiple applications", default=False)
 
+    op.add_option("--mongodb_pool_size", dest="mongodb_pool_size",
+                  metavar="NUM", type="int",
+                  help="maximum number of pooled MongoDB connections",
+                  default=None)
+
+    op.add_option("--mongodb_read_preference",
+                  dest="mongodb_read_preference", metavar="MODE",
+                  help="serve eventually consistent reads from the 'primary' "
+                       "or a 'secondary'", default=None)
+
+    op.add_option("--mongodb_replica_set", dest="mongodb_replica_set",
+                  metavar="NAME", help="name of the MongoDB replica set",
+                  default=None)
+
+    op.add_option("--mongodb_timeout", dest="mongodb_timeout",
+                  metavar="SECONDS", type="float",
+                  help="MongoDB socket timeout", default=None)
+
+    op.add_option("--mongodb_uri", dest="mongodb_uri", metavar="URI",
+                  help="connect to this MongoDB host or connection URI",
+                  default=None)
+
+    op.add_option("--mongodb_write_concern", dest="mongodb_write_concern",
+                  metavar="NUM", type="int",
+                  help="number of MongoDB servers which must acknowledge a "
+                       "write", default=None)
+
     op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
                   help="connect to the given MySQL database",
                   default='typhoonae')
@@ -1044,6 +1100,10 @@ def main():
                   help="use this password to connect to the MySQL database "
                        "server", default='')
 
+    op.add_option("--mysql_pool_size", dest="mysql_pool_size", metavar="NUM",
+                  type="int", help="maximum number of MySQL connections",
+                  default=None)
+
     op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
                   help="use this user to connect to the MySQL database server",
                   default='root')
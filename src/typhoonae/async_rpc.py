@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Asynchronous API calls for stubs which only implement MakeSyncCall.
+
+The RPCs the SDK creates for API proxy stubs run their call when they are
+waited for, so asynchronous Datastore calls like db.get_async() would run
+one after another. Stubs return an AsyncRPC from CreateRPC() instead, which
+starts its call in a thread pool right away.
+"""
+
+import Queue
+import sys
+import threading
+
+from google.appengine.api import apiproxy_rpc
+
+# Default number of worker threads.
+POOL_SIZE = 10
+
+
+def transactionKey(call, request):
+    """Returns the handle of the transaction a call belongs to or None."""
+
+    if call in ('Commit', 'Rollback'):
+        return request.handle()
+    if hasattr(request, 'has_transaction') and request.has_transaction():
+        return request.transaction().handle()
+    return None
+
+
+class PendingCall(object):
+    """The result of a call submitted to a thread pool."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._exc_info = None
+
+    def _run(self, func, args):
+        try:
+            try:
+                func(*args)
+            except:
+                self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.isSet()
+
+    def wait(self):
+        """Blocks until the call finished and re-raises its exception."""
+
+        self._done.wait()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def MakeSyncCall(self, service, call, request, response):
+        """Waits for the call, see AsyncRPC."""
+
+        self.wait()
+
+
+class ThreadPool(object):
+    """Runs calls in worker threads.
+
+    Calls submitted with the same key run one after another in the order of
+    submission, others run concurrently.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        assert size > 0
+        self.size = size
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        # Maps the keys of running calls to the calls waiting for them.
+        self._serial = {}
+
+    def submit(self, func, args=(), key=None):
+        """Submits a call.
+
+        Args:
+            func: The callable.
+            args: Positional arguments.
+            key: Calls with the same key run one after another.
+
+        Returns:
+            A PendingCall.
+        """
+        pending = PendingCall()
+        task = (func, args, key, pending)
+        self._lock.acquire()
+        try:
+            if len(self._workers) < self.size:
+                worker = threading.Thread(target=self._work)
+                worker.setDaemon(True)
+                worker.start()
+                self._workers.append(worker)
+            if key is not None:
+                if key in self._serial:
+                    self._serial[key].append(task)
+                    return pending
+                self._serial[key] = []
+        finally:
+            self._lock.release()
+        self._queue.put(task)
+        return pending
+
+    def _work(self):
+        while True:
+            func, args, key, pending = self._queue.get()
+            pending._run(func, args)
+            if key is None:
+                continue
+            self._lock.acquire()
+            try:
+                waiting = self._serial[key]
+                if waiting:
+                    self._queue.put(waiting.pop(0))
+                else:
+                    del self._serial[key]
+            finally:
+                self._lock.release()
+
+
+class AsyncRPC(apiproxy_rpc.RPC):
+    """RPC which runs its call in a thread pool as soon as it is made.
+
+    Waiting lets the SDK's RPC make a synchronous call against the pending
+    call, which blocks until the worker finished and re-raises its
+    exception. Callbacks and error handling are those of the SDK.
+    """
+
+    def __init__(self, pool, *args, **kwds):
+        super(AsyncRPC, self).__init__(*args, **kwds)
+        self._pool = pool
+
+    def _MakeCallImpl(self):
+        super(AsyncRPC, self)._MakeCallImpl()
+        self.stub = self._pool.submit(
+            self.stub.MakeSyncCall,
+            (self.package, self.call, self.request, self.response),
+            key=transactionKey(self.call, self.request))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Asynchronous get benchmark for the Datastore MongoDB and MySQL stubs.
+
+Issues a number of single entity Get RPCs one after another and all at once
+and reports the wall-clock time of both. Requires a running MongoDB or MySQL
+server; the benchmark database is cleared.
+"""
+
+from typhoonae.benchmarks.mysql_pagination import setupStub
+import optparse
+import os
+import time
+
+DESCRIPTION = "Datastore asynchronous get benchmark."
+USAGE = "usage: %prog [options]"
+
+REPEAT = 10
+
+
+def setupMongoStub(options):
+    """Registers a fresh Datastore MongoDB stub."""
+
+    from google.appengine.api import apiproxy_stub_map
+    from typhoonae.mongodb import datastore_mongo_stub
+
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = datastore_mongo_stub.DatastoreMongoStub(
+        os.environ['APPLICATION_ID'], uri=options.mongodb_uri)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    stub.Clear()
+    return stub
+
+
+def makeCall(key):
+    """Makes a Get RPC for a single key and returns it."""
+
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_pb
+
+    request = datastore_pb.GetRequest()
+    request.add_key().CopyFrom(key._ToPb())
+    rpc = apiproxy_stub_map.UserRPC('datastore_v3')
+    rpc.make_call('Get', request, datastore_pb.GetResponse())
+    return rpc
+
+
+def timeGets(keys, parallel):
+    """Returns the average number of seconds to get all keys.
+
+    Args:
+        keys: A list of keys.
+        parallel: Whether to make all RPCs before waiting for the first.
+    """
+    start = time.time()
+    for i in xrange(REPEAT):
+        if parallel:
+            rpcs = [makeCall(key) for key in keys]
+            for rpc in rpcs:
+                rpc.check_success()
+        else:
+            for key in keys:
+                makeCall(key).check_success()
+    return (time.time() - start) / REPEAT
+
+
+def run(gets):
+    """Runs the benchmark for a number of gets.
+
+    Args:
+        gets: Number of Get RPCs.
+
+    Returns:
+        A dict with the average seconds for sequential and parallel gets.
+    """
+    from google.appengine.api import datastore
+
+    keys = datastore.Put(
+        [datastore.Entity('Item', name='item%i' % i) for i in xrange(gets)])
+
+    return dict(sequential=timeGets(keys, False),
+                parallel=timeGets(keys, True))
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--datastore", dest="datastore", metavar="NAME",
+                  help="use this Datastore backend (mongodb/mysql)",
+                  default='mongodb')
+
+    op.add_option("--gets", dest="gets", metavar="LIST",
+                  help="comma separated numbers of Get RPCs",
+                  default="1,10,50,100")
+
+    op.add_option("--mongodb_uri", dest="mongodb_uri", metavar="URI",
+                  help="MongoDB host or connection URI", default=None)
+
+    op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
+                  help="benchmark database, will be cleared",
+                  default='typhoonae_benchmark')
+
+    op.add_option("--mysql_host", dest="mysql_host", metavar="ADDR",
+                  help="connect to this MySQL database server",
+                  default='127.0.0.1')
+
+    op.add_option("--mysql_passwd", dest="mysql_passwd", metavar="PASSWORD",
+                  help="use this password to connect to the MySQL database "
+                       "server", default='')
+
+    op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
+                  help="use this user to connect to the MySQL database server",
+                  default='root')
+
+    (options, args) = op.parse_args()
+
+    os.environ.setdefault('APPLICATION_ID', 'benchmark')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+    print "%10s %14s %14s %10s" % ("gets", "sequential", "parallel", "speedup")
+    for gets in [int(g) for g in options.gets.split(',')]:
+        if options.datastore == 'mysql':
+            setupStub(options)
+        else:
+            setupMongoStub(options)
+        results = run(gets)
+        print "%10i %12.2fms %12.2fms %9.1fx" % (
+            gets, results['sequential'] * 1000, results['parallel'] * 1000,
+            results['sequential'] / results['parallel'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark suite for the Datastore backends.
+
+Runs put, get, query, pagination and transaction workloads through the
+datastore_v3 API against the MongoDB, MySQL or SQLite stub and writes the
+results as JSON, so they can be compared between backends and versions.
+MongoDB and MySQL require a running server; the benchmark database is
+cleared.
+"""
+
+from typhoonae.benchmarks.async_get import setupMongoStub
+from typhoonae.benchmarks.mysql_pagination import setupStub
+import optparse
+import os
+import simplejson
+import sys
+import tempfile
+import threading
+import time
+
+DESCRIPTION = "Datastore backend benchmark suite."
+USAGE = "usage: %prog [options]"
+
+DATASTORES = ('mongodb', 'mysql', 'sqlite')
+
+PAGE_SIZE = 20
+
+QUERY_REPEAT = 20
+
+GROUPS = 10
+
+
+def setupSqliteStub(options):
+    """Registers a fresh Datastore SQLite stub."""
+
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_sqlite_stub
+
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = datastore_sqlite_stub.DatastoreSqliteStub(
+        os.environ['APPLICATION_ID'], options.sqlite_path)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    stub.Clear()
+    return stub
+
+
+def defineModels():
+    """Returns the model classes of the benchmark."""
+
+    from google.appengine.ext import db
+
+    class Item(db.Model):
+        number = db.IntegerProperty()
+        group = db.IntegerProperty()
+        text = db.StringProperty()
+
+    class Counter(db.Model):
+        count = db.IntegerProperty(default=0)
+
+    return Item, Counter
+
+
+def measure(func, operations):
+    """Runs a workload and returns its result.
+
+    Args:
+        func: Callable running the workload.
+        operations: Number of operations the workload performs.
+
+    Returns:
+        A dict with seconds, operations and operations per second.
+    """
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    return {'seconds': seconds, 'operations': operations,
+            'ops_per_second': seconds and operations / seconds or None}
+
+
+def batches(items, size):
+    """Splits a list into lists of size items."""
+
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def putEntities(Item, entities, batch_size):
+    """Puts entities in batches, a tenth of them as children of parents."""
+
+    from google.appengine.ext import db
+
+    parents = db.put([Item(key_name='parent%i' % i, number=-1, group=i)
+                      for i in xrange(GROUPS)])
+    items = []
+    for i in xrange(entities):
+        parent = None
+        if i % 10 == 0:
+            parent = parents[i / 10 % GROUPS]
+        items.append(Item(parent=parent, number=i, group=i % GROUPS,
+                          text='item%i' % i))
+
+    keys = []
+
+    def put():
+        for batch in batches(items, batch_size):
+            keys.extend(db.put(batch))
+
+    return measure(put, len(items)), keys, parents
+
+
+def getEntities(keys, batch_size):
+    """Gets entities in batches."""
+
+    from google.appengine.ext import db
+
+    def get():
+        for batch in batches(keys, batch_size):
+            db.get(batch)
+
+    return measure(get, len(keys))
+
+
+def runQueries(make_query):
+    """Fetches the first page of a query QUERY_REPEAT times."""
+
+    def run():
+        for i in xrange(QUERY_REPEAT):
+            make_query(i).fetch(PAGE_SIZE)
+
+    return measure(run, QUERY_REPEAT)
+
+
+def paginate(Item, pages):
+    """Pages through a query with cursors and times the last pages."""
+
+    query = Item.all().order('number')
+    for i in xrange(pages - QUERY_REPEAT):
+        query.fetch(PAGE_SIZE)
+        query.with_cursor(query.cursor())
+    cursor = query.cursor()
+
+    def run():
+        query = Item.all().order('number')
+        query.with_cursor(cursor)
+        for i in xrange(QUERY_REPEAT):
+            query.fetch(PAGE_SIZE)
+            query.with_cursor(query.cursor())
+
+    return measure(run, QUERY_REPEAT)
+
+
+def contendTransactions(Counter, threads, increments):
+    """Increments a single counter from several threads."""
+
+    from google.appengine.ext import db
+
+    key = Counter(key_name='counter').put()
+    failures = []
+
+    def increment():
+        counter = Counter.get(key)
+        counter.count += 1
+        counter.put()
+
+    def work():
+        for i in xrange(increments):
+            try:
+                db.run_in_transaction(increment)
+            except db.TransactionFailedError:
+                failures.append(1)
+
+    def run():
+        workers = [threading.Thread(target=work) for i in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    result = measure(run, threads * increments)
+    result['failures'] = len(failures)
+    result['count'] = Counter.get(key).count
+    return result
+
+
+def run(options):
+    """Runs all workloads.
+
+    Args:
+        options: The parsed command line options.
+
+    Returns:
+        A dict which maps workload names to their results. Workloads which
+        fail report their error instead.
+    """
+    if options.datastore == 'mongodb':
+        setupMongoStub(options)
+    elif options.datastore == 'mysql':
+        setupStub(options)
+    else:
+        setupSqliteStub(options)
+
+    Item, Counter = defineModels()
+    results = {}
+
+    results['batch_put'], keys, parents = putEntities(
+        Item, options.entities, options.batch_size)
+
+    workloads = [
+        ('batch_get', lambda: getEntities(keys, options.batch_size)),
+        ('single_property_query', lambda: runQueries(
+            lambda i: Item.all().filter('number >=', i * 7).order('number'))),
+        ('composite_query', lambda: runQueries(
+            lambda i: Item.all().filter('group =', i % GROUPS).order(
+                '-number'))),
+        ('ancestor_query', lambda: runQueries(
+            lambda i: Item.all().ancestor(parents[i % GROUPS]))),
+        ('cursor_pagination', lambda: paginate(
+            Item, min(options.pages, options.entities / PAGE_SIZE))),
+        ('contended_transactions', lambda: contendTransactions(
+            Counter, options.threads, options.increments)),
+    ]
+    for name, workload in workloads:
+        try:
+            results[name] = workload()
+        except Exception, e:
+            results[name] = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    return results
+
+
+def main():
+    """Runs the benchmark suite and writes the results as JSON."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--batch_size", dest="batch_size", metavar="NUM",
+                  help="number of entities per batch put and get",
+                  default=100, type="int")
+
+    op.add_option("--datastore", dest="datastore", metavar="NAME",
+                  help="use this Datastore backend (%s)" % '/'.join(
+                      DATASTORES), default='mongodb')
+
+    op.add_option("--entities", dest="entities", metavar="NUM",
+                  help="number of entities", default=10000, type="int")
+
+    op.add_option("--increments", dest="increments", metavar="NUM",
+                  help="number of transactions per thread",
+                  default=20, type="int")
+
+    op.add_option("--mongodb_uri", dest="mongodb_uri", metavar="URI",
+                  help="MongoDB host or connection URI", default=None)
+
+    op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
+                  help="benchmark database, will be cleared",
+                  default='typhoonae_benchmark')
+
+    op.add_option("--mysql_host", dest="mysql_host", metavar="ADDR",
+                  help="connect to this MySQL database server",
+                  default='127.0.0.1')
+
+    op.add_option("--mysql_passwd", dest="mysql_passwd", metavar="PASSWORD",
+                  help="use this password to connect to the MySQL database "
+                       "server", default='')
+
+    op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
+                  help="use this user to connect to the MySQL database server",
+                  default='root')
+
+    op.add_option("--output", dest="output", metavar="FILE",
+                  help="write the results to this file instead of stdout",
+                  default=None)
+
+    op.add_option("--pages", dest="pages", metavar="NUM",
+                  help="page through this many pages with cursors",
+                  default=100, type="int")
+
+    op.add_option("--sqlite_path", dest="sqlite_path", metavar="PATH",
+                  help="SQLite database file, will be cleared",
+                  default=os.path.join(tempfile.gettempdir(),
+                                       'typhoonae_benchmark.sqlite'))
+
+    op.add_option("--threads", dest="threads", metavar="NUM",
+                  help="number of threads updating the same entity group",
+                  default=4, type="int")
+
+    (options, args) = op.parse_args()
+
+    if options.datastore not in DATASTORES:
+        op.error("unknown datastore %r" % options.datastore)
+
+    os.environ.setdefault('APPLICATION_ID', 'benchmark')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+    report = {
+        'datastore': options.datastore,
+        'entities': options.entities,
+        'batch_size': options.batch_size,
+        'page_size': PAGE_SIZE,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': run(options),
+    }
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    try:
+        simplejson.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmark for the entity/BSON conversion of the MongoDB stub.
+
+Converts entities with mixed property types into MongoDB documents and back
+and verifies that the resulting protocol buffers are identical. No MongoDB
+server is required.
+"""
+
+import datetime
+import optparse
+import os
+import sys
+import time
+
+DESCRIPTION = "Entity to BSON conversion micro-benchmark."
+USAGE = "usage: %prog [options]"
+
+
+def makeEntity(i):
+    """Returns an EntityProto with one property of each supported type.
+
+    Args:
+        i: Number used to vary the property values.
+    """
+    from google.appengine.api import datastore
+    from google.appengine.api import datastore_types
+    from google.appengine.api import users
+
+    entity = datastore.Entity('Mixed', name='mixed%i' % i)
+    entity.update({
+        'string': u'Ünïcode string %i' % i,
+        'integer': i,
+        'long': (1L << 40) + i,
+        'float': i / 3.0,
+        'boolean': bool(i % 2),
+        'none': None,
+        'datetime': datetime.datetime(2011, 1, 1, 12, 0, i % 60,
+                                      1000 * (i % 1000)),
+        'rating': datastore_types.Rating(i % 100),
+        'category': datastore_types.Category('category%i' % i),
+        'key': datastore_types.Key.from_path('Parent', i + 1, 'Child', 'c'),
+        'user': users.User('user%i@example.com' % i),
+        'text': datastore_types.Text(u'Some long text ' * 10),
+        'blob': datastore_types.Blob('\x00\x01binary%i' % i),
+        'bytes': datastore_types.ByteString('bytes%i' % i),
+        'im': datastore_types.IM('xmpp', 'user%i@example.com' % i),
+        'geopt': datastore_types.GeoPt(52.5, 13.4),
+        'email': datastore_types.Email('mail%i@example.com' % i),
+        'blobkey': datastore_types.BlobKey('blobkey%i' % i),
+        'integers': [i + 2, i, i + 1],
+        'strings': [u'b', u'a', u'c'],
+        'keys': [datastore_types.Key.from_path('Other', n + 1)
+                 for n in range(3)],
+    })
+    return entity._ToPb()
+
+
+def run(count, app_id):
+    """Runs the benchmark.
+
+    Args:
+        count: Number of entities to convert.
+        app_id: The application id.
+
+    Returns:
+        A dict with the measured times in seconds.
+    """
+    from google.appengine.api import datastore
+    from typhoonae.mongodb import datastore_mongo_stub
+
+    entities = [makeEntity(i) for i in xrange(count)]
+
+    start = time.time()
+    documents = [datastore_mongo_stub.mongo_document_for_entity(e)
+                 for e in entities]
+    to_bson = time.time() - start
+
+    start = time.time()
+    converted = [datastore_mongo_stub.entity_for_mongo_document(d, app_id)
+                 for d in documents]
+    from_bson = time.time() - start
+
+    for original, result in zip(entities, converted):
+        if original != result:
+            raise AssertionError('Round trip failed:\n%s\n!=\n%s' %
+                                 (original, result))
+
+    # The high-level Entity round trip the stub used to pay for every entity.
+    start = time.time()
+    for e in entities:
+        datastore.Entity._FromPb(e)._ToPb()
+    entity_api = time.time() - start
+
+    return dict(to_bson=to_bson, from_bson=from_bson, entity_api=entity_api)
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("-n", "--count", dest="count", metavar="NUM", type="int",
+                  help="number of entities to convert", default=10000)
+
+    (options, args) = op.parse_args()
+
+    os.environ.setdefault('APPLICATION_ID', 'benchmark')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+    results = run(options.count, os.environ['APPLICATION_ID'])
+
+    for name in ('to_bson', 'from_bson', 'entity_api'):
+        print "%-12s %8.3f s  %8.1f us/entity" % (
+            name, results[name], results[name] * 1e6 / options.count)
+    print "Round trip of %i entities produced identical protocol buffers." % (
+        options.count)
+
+
+if __name__ == "__main__":
+    main()
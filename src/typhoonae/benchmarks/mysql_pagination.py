@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Pagination benchmark for the Datastore MySQL stub.
+
+Pages through a kind with query cursors and with offsets and reports the time
+per page near the start and near the end of the result set. Requires a
+running MySQL server; the benchmark database is cleared.
+"""
+
+import optparse
+import os
+import time
+
+DESCRIPTION = "Datastore MySQL pagination benchmark."
+USAGE = "usage: %prog [options]"
+
+PAGE_SIZE = 100
+
+SAMPLE_PAGES = 10
+
+
+def setupStub(options, clear=True):
+    """Registers a fresh Datastore MySQL stub.
+
+    Args:
+        options: The parsed command line options.
+        clear: Whether to clear the benchmark database.
+
+    Returns:
+        The stub.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from typhoonae.mysql import datastore_mysql_stub
+
+    database_info = {
+        "host": options.mysql_host,
+        "user": options.mysql_user,
+        "passwd": options.mysql_passwd,
+        "db": options.mysql_db,
+    }
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = datastore_mysql_stub.DatastoreMySQLStub(
+        os.environ['APPLICATION_ID'], database_info)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    if clear:
+        stub.Clear()
+    return stub
+
+
+def populate(model, rows):
+    """Stores rows entities in batches."""
+
+    from google.appengine.ext import db
+
+    batch = []
+    for i in xrange(rows):
+        batch.append(model(number=i))
+        if len(batch) == 500:
+            db.put(batch)
+            batch = []
+    if batch:
+        db.put(batch)
+
+
+def timePages(fetch, pages):
+    """Returns the average number of seconds for the given page numbers.
+
+    Args:
+        fetch: Callable fetching the page with the given number.
+        pages: A list of page numbers.
+    """
+    start = time.time()
+    for page in pages:
+        fetch(page)
+    return (time.time() - start) / len(pages)
+
+
+def run(rows):
+    """Runs the benchmark for a number of rows.
+
+    Args:
+        rows: Number of entities to page through.
+
+    Returns:
+        A dict with the average seconds per page.
+    """
+    from google.appengine.ext import db
+
+    class Item(db.Model):
+        number = db.IntegerProperty()
+
+    populate(Item, rows)
+
+    last_page = rows / PAGE_SIZE - 1
+    head = range(SAMPLE_PAGES)
+    tail = range(last_page - SAMPLE_PAGES + 1, last_page + 1)
+
+    # Collect the cursors for all pages.
+    cursors = [None]
+    query = Item.all().order('number')
+    while len(cursors) <= last_page:
+        if cursors[-1]:
+            query.with_cursor(cursors[-1])
+        query.fetch(PAGE_SIZE)
+        cursors.append(query.cursor())
+
+    def fetchWithCursor(page):
+        query = Item.all().order('number')
+        if cursors[page]:
+            query.with_cursor(cursors[page])
+        result = query.fetch(PAGE_SIZE)
+        assert result[0].number == page * PAGE_SIZE
+
+    def fetchWithOffset(page):
+        result = Item.all().order('number').fetch(
+            PAGE_SIZE, offset=page * PAGE_SIZE)
+        assert result[0].number == page * PAGE_SIZE
+
+    return dict(cursor_head=timePages(fetchWithCursor, head),
+                cursor_tail=timePages(fetchWithCursor, tail),
+                offset_head=timePages(fetchWithOffset, head),
+                offset_tail=timePages(fetchWithOffset, tail))
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--rows", dest="rows", metavar="LIST",
+                  help="comma separated numbers of entities",
+                  default="10000,100000,1000000")
+
+    op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
+                  help="benchmark database, will be cleared",
+                  default='typhoonae_benchmark')
+
+    op.add_option("--mysql_host", dest="mysql_host", metavar="ADDR",
+                  help="connect to this MySQL database server",
+                  default='127.0.0.1')
+
+    op.add_option("--mysql_passwd", dest="mysql_passwd", metavar="PASSWORD",
+                  help="use this password to connect to the MySQL database "
+                       "server", default='')
+
+    op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
+                  help="use this user to connect to the MySQL database server",
+                  default='root')
+
+    (options, args) = op.parse_args()
+
+    os.environ.setdefault('APPLICATION_ID', 'benchmark')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+    print "%10s %14s %14s %14s %14s" % (
+        "rows", "cursor head", "cursor tail", "offset head", "offset tail")
+    for rows in [int(r) for r in options.rows.split(',')]:
+        setupStub(options)
+        results = run(rows)
+        print "%10i %12.2fms %12.2fms %12.2fms %12.2fms" % (
+            rows,
+            results['cursor_head'] * 1000, results['cursor_tail'] * 1000,
+            results['offset_head'] * 1000, results['offset_tail'] * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Single property query benchmark for the Datastore MySQL stub.
+
+Stores entities into an EntitiesByProperty table with the layout of earlier
+versions, upgrades the table and reports the query plan and the time of a
+sorted single property query before and after the upgrade. Requires a
+running MySQL server; the benchmark database is cleared.
+"""
+
+from typhoonae.benchmarks.mysql_pagination import populate, setupStub
+import optparse
+import os
+import time
+
+DESCRIPTION = "Datastore MySQL single property query benchmark."
+USAGE = "usage: %prog [options]"
+
+REPEAT = 20
+
+# The statement __SinglePropertyQuery creates for the first page of
+# Item.all().order('number').
+QUERY = """
+SELECT Entities.__path__, Entities.entity, value, EntitiesByProperty.__path__
+FROM %(prefix)s_EntitiesByProperty AS EntitiesByProperty
+INNER JOIN %(prefix)s_Entities AS Entities USING (__path__)
+WHERE EntitiesByProperty.kind = 'Item' AND name = 'number'
+ORDER BY EntitiesByProperty.kind, name, value, EntitiesByProperty.__path__
+LIMIT 100
+"""
+
+
+def connect(options):
+    """Returns a connection to the benchmark database."""
+
+    import MySQLdb
+
+    return MySQLdb.connect(host=options.mysql_host, user=options.mysql_user,
+                           passwd=options.mysql_passwd, db=options.mysql_db)
+
+
+def explain(conn, prefix):
+    """Returns (table, key, rows, extra) tuples of the query plan."""
+
+    import MySQLdb.cursors
+
+    cursor = conn.cursor(MySQLdb.cursors.DictCursor)
+    cursor.execute('EXPLAIN ' + QUERY % {'prefix': prefix})
+    plan = [(row['table'], row['key'], row['rows'], row['Extra'])
+            for row in cursor.fetchall()]
+    cursor.close()
+    return plan
+
+
+def timeQuery(conn, prefix):
+    """Returns the average number of seconds the query takes."""
+
+    cursor = conn.cursor()
+    start = time.time()
+    for i in xrange(REPEAT):
+        cursor.execute(QUERY % {'prefix': prefix})
+        cursor.fetchall()
+    cursor.close()
+    return (time.time() - start) / REPEAT
+
+
+def run(options, rows):
+    """Runs the benchmark for a number of rows.
+
+    Args:
+        options: The parsed command line options.
+        rows: Number of entities.
+
+    Returns:
+        A dict with the plans and the average seconds per query before and
+        after the upgrade.
+    """
+    from google.appengine.ext import db
+    from typhoonae.mysql import datastore_mysql_stub
+    from typhoonae.mysql import upgrade
+
+    setupStub(options)
+    prefix = datastore_mysql_stub.formatTableName(
+        '%s_' % os.environ['APPLICATION_ID'])
+    conn = connect(options)
+    cursor = conn.cursor()
+    cursor.execute('DROP TABLE %s_EntitiesByProperty' % prefix)
+    cursor.execute(upgrade.LEGACY_SCHEMA % {'prefix': prefix})
+    cursor.close()
+    setupStub(options, clear=False)
+
+    class Item(db.Model):
+        number = db.IntegerProperty()
+
+    populate(Item, rows)
+
+    result = {}
+    result['plan_before'] = explain(conn, prefix)
+    result['time_before'] = timeQuery(conn, prefix)
+    upgrade.upgradeTable(conn, '%s_EntitiesByProperty' % prefix)
+    result['plan_after'] = explain(conn, prefix)
+    result['time_after'] = timeQuery(conn, prefix)
+    conn.close()
+    return result
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--rows", dest="rows", metavar="LIST",
+                  help="comma separated numbers of entities",
+                  default="10000,100000")
+
+    op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
+                  help="benchmark database, will be cleared",
+                  default='typhoonae_benchmark')
+
+    op.add_option("--mysql_host", dest="mysql_host", metavar="ADDR",
+                  help="connect to this MySQL database server",
+                  default='127.0.0.1')
+
+    op.add_option("--mysql_passwd", dest="mysql_passwd", metavar="PASSWORD",
+                  help="use this password to connect to the MySQL database "
+                       "server", default='')
+
+    op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
+                  help="use this user to connect to the MySQL database server",
+                  default='root')
+
+    (options, args) = op.parse_args()
+
+    os.environ.setdefault('APPLICATION_ID', 'benchmark')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+    for rows in [int(r) for r in options.rows.split(',')]:
+        results = run(options, rows)
+        for when in ('before', 'after'):
+            print "%i rows, %s upgrade: %.2fms" % (
+                rows, when, results['time_' + when] * 1000)
+            for table, key, estimate, extra in results['plan_' + when]:
+                print "  %-20s %-12s %10s  %s" % (table, key, estimate, extra)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Write amplification benchmark for the Datastore MySQL stub.
+
+Updates a number of properties of entities with many properties and reports
+the rows InnoDB inserted and deleted per put. Properties may hold lists of
+values which all change. Rewriting the whole index of an entity costs two rows
+per property value, while only writing the changed index rows costs two rows
+per changed value, which the benchmark reports as the minimum. Requires a
+running MySQL server which isn't used otherwise; the benchmark database is
+cleared.
+"""
+
+from typhoonae.benchmarks.mysql_pagination import setupStub
+import optparse
+import os
+import time
+
+DESCRIPTION = "Datastore MySQL write amplification benchmark."
+USAGE = "usage: %prog [options]"
+
+ENTITIES = 100
+
+
+def rowCounters(conn):
+    """Returns the number of rows InnoDB inserted and deleted so far."""
+
+    cursor = conn.cursor()
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN "
+                   "('Innodb_rows_inserted', 'Innodb_rows_deleted')")
+    result = sum(int(value) for name, value in cursor.fetchall())
+    cursor.close()
+    return result
+
+
+def propertyValue(number, values):
+    """Returns a property value, or a list of distinct values."""
+
+    if values == 1:
+        return number
+    return [number * values + v for v in xrange(values)]
+
+
+def run(conn, properties, changed, values=1):
+    """Runs the benchmark for a number of changed properties.
+
+    Args:
+        conn: A connection to the MySQL server.
+        properties: Number of properties per entity.
+        changed: Number of properties changed per put.
+        values: Number of values per property, properties with more than one
+            value are lists.
+
+    Returns:
+        A tuple of rows written per put and the average seconds per put.
+    """
+    from google.appengine.ext import db
+
+    entities = []
+    for i in xrange(ENTITIES):
+        entity = db.Expando(key_name='e%i' % i)
+        for p in xrange(properties):
+            setattr(entity, 'p%i' % p, propertyValue(p, values))
+        entities.append(entity)
+    db.put(entities)
+
+    for entity in entities:
+        for p in xrange(changed):
+            setattr(entity, 'p%i' % p, propertyValue(-p - 1, values))
+
+    rows = rowCounters(conn)
+    start = time.time()
+    for entity in entities:
+        entity.put()
+    seconds = time.time() - start
+    return ((rowCounters(conn) - rows) / float(ENTITIES),
+            seconds / ENTITIES)
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--changed", dest="changed", metavar="LIST",
+                  help="comma separated numbers of changed properties",
+                  default="1,10,50")
+
+    op.add_option("--properties", dest="properties", metavar="NUMBER",
+                  help="number of properties per entity",
+                  default=50, type="int")
+
+    op.add_option("--values", dest="values", metavar="LIST",
+                  help="comma separated numbers of values per property",
+                  default="1,10")
+
+    op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
+                  help="benchmark database, will be cleared",
+                  default='typhoonae_benchmark')
+
+    op.add_option("--mysql_host", dest="mysql_host", metavar="ADDR",
+                  help="connect to this MySQL database server",
+                  default='127.0.0.1')
+
+    op.add_option("--mysql_passwd", dest="mysql_passwd", metavar="PASSWORD",
+                  help="use this password to connect to the MySQL database "
+                       "server", default='')
+
+    op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
+                  help="use this user to connect to the MySQL database server",
+                  default='root')
+
+    (options, args) = op.parse_args()
+
+    os.environ.setdefault('APPLICATION_ID', 'benchmark')
+    os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+
+    import MySQLdb
+
+    conn = MySQLdb.connect(host=options.mysql_host, user=options.mysql_user,
+                           passwd=options.mysql_passwd, db='mysql')
+
+    print "%10s %10s %10s %14s %14s %14s" % (
+        "properties", "changed", "values", "rows per put", "minimum",
+        "time per put")
+    for values in [int(v) for v in options.values.split(',')]:
+        for changed in [int(c) for c in options.changed.split(',')]:
+            setupStub(options)
+            rows, seconds = run(conn, options.properties, changed, values)
+            print "%10i %10i %10i %14.1f %14i %12.2fms" % (
+                options.properties, changed, values, rows,
+                2 * changed * values, seconds * 1000)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read-through entity cache for any Datastore stub.
+
+The cache stub wraps the Datastore stub of whichever backend is used and
+serves Get requests for entities of selected kinds from an in-process LRU
+cache and memcache. Puts and deletes invalidate the cached entities, inside
+transactions when the transaction commits. Transactional gets always go to
+the wrapped stub.
+
+Invalidated entities are locked in memcache for a few seconds, and gets only
+add entities which are neither cached nor locked. So a get which read an entity
+before a concurrent write doesn't cache it after the write. Other processes
+only invalidate memcache, so entities cached in-process may miss their writes
+for a few seconds.
+
+Optionally, the keys returned by queries of the selected kinds are cached
+in-process as well. Cached queries stay valid as long as the generation
+counters in memcache of what they depend on don't change: the kind and
+namespace, or the entity group of ancestor queries. Every write increments
+the counters of its kind and entity group.
+"""
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+
+import threading
+import time
+import typhoonae.async_rpc
+import typhoonae.lrucache
+
+# Namespace of the cached entities in memcache.
+MEMCACHE_NAMESPACE = '__typhoonae.datastore_cache__'
+
+# Number of seconds entities are cached if their kind doesn't specify it.
+DEFAULT_TTL = 60
+
+# Maximum number of entities cached in-process.
+LOCAL_CACHE_SIZE = 1000
+
+# Number of seconds entities are cached in-process.
+LOCAL_TTL = 5
+
+# Number of seconds invalidated entities can't be cached in memcache.
+LOCK_TTL = 10
+
+# Value of locked entities in memcache, no encoded entity is empty.
+_LOCKED = ''
+
+# Namespace of the generation counters in memcache.
+GENERATIONS_NAMESPACE = '__typhoonae.datastore_cache.generations__'
+
+# Queries are only cached if their limit doesn't exceed this.
+MAX_QUERY_RESULTS = 1000
+
+# Calls which read or write entities, all others go to the wrapped stub.
+_CACHE_CALLS = frozenset(
+    ['Get', 'Put', 'Delete', 'Commit', 'Rollback', 'RunQuery'])
+
+
+def parseKinds(value):
+    """Parses the kinds whose entities are cached.
+
+    Args:
+        value: Comma separated kinds, each optionally followed by a colon and
+            the number of seconds its entities are cached. The kind '*'
+            matches all kinds.
+
+    Returns:
+        A dict which maps kinds to numbers of seconds.
+    """
+    kinds = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            kind, ttl = item.split(':', 1)
+            kinds[kind.strip()] = int(ttl)
+        else:
+            kinds[item] = DEFAULT_TTL
+    return kinds
+
+
+def _isComplete(key):
+    """Whether the last path element of a key has an ID or a name."""
+
+    last = key.path().element_list()[-1]
+    return last.has_id() or last.has_name()
+
+
+def _kindGeneration(app, name_space, kind):
+    """Returns the key of the generation counter of a kind."""
+
+    return 'kind:' + repr((app, name_space, kind))
+
+
+def _groupGeneration(key):
+    """Returns the key of the generation counter of an entity group."""
+
+    root = entity_pb.Reference()
+    root.set_app(key.app())
+    if key.has_name_space():
+        root.set_name_space(key.name_space())
+    root.mutable_path().add_element().CopyFrom(key.path().element(0))
+    return 'group:' + root.Encode()
+
+
+class DatastoreCacheStub(apiproxy_stub.APIProxyStub):
+    """Caches the entities of another Datastore stub."""
+
+    def __init__(self, stub, kinds, local_cache_size=LOCAL_CACHE_SIZE,
+                 local_ttl=LOCAL_TTL, query_cache_size=0,
+                 service_name='datastore_v3'):
+        """Constructor.
+
+        Args:
+            stub: The wrapped Datastore stub.
+            kinds: Dict which maps the cached kinds to the number of seconds
+                their entities are cached.
+            local_cache_size: Maximum number of entities cached in-process.
+            local_ttl: Number of seconds entities are cached in-process.
+            query_cache_size: Maximum number of cached queries, 0 disables
+                the query cache.
+            service_name: Service name expected for all calls.
+        """
+        super(DatastoreCacheStub, self).__init__(service_name)
+        self._stub = stub
+        self._kinds = kinds
+        self._local_ttl = local_ttl
+        self._local_cache = typhoonae.lrucache.LRUCache(local_cache_size)
+        self._lock = threading.Lock()
+        # Number of invalidations, gets don't cache entities in-process which
+        # they read before an invalidation.
+        self._epoch = 0
+        # Maps transaction handles to the keys they wrote.
+        self._tx_keys = {}
+        self._query_cache = None
+        if query_cache_size:
+            self._query_cache = typhoonae.lrucache.LRUCache(query_cache_size)
+        self._stats = {'local_hits': 0, 'memcache_hits': 0, 'misses': 0,
+                       'query_hits': 0, 'query_misses': 0}
+        self._rpc_pool = typhoonae.async_rpc.ThreadPool()
+
+    def __getattr__(self, name):
+        """Exposes the attributes of the wrapped stub, e.g. QueryHistory."""
+
+        stub = self.__dict__.get('_stub')
+        if stub is None:
+            raise AttributeError(name)
+        return getattr(stub, name)
+
+    def MakeSyncCall(self, service, call, request, response):
+        """The main RPC entry point."""
+
+        if call in _CACHE_CALLS:
+            super(DatastoreCacheStub, self).MakeSyncCall(
+                service, call, request, response)
+        else:
+            self._stub.MakeSyncCall(service, call, request, response)
+
+    def CreateRPC(self):
+        """Returns an RPC which runs its call in a worker thread."""
+
+        return typhoonae.async_rpc.AsyncRPC(self._rpc_pool, stub=self)
+
+    def _getTTL(self, key):
+        """Returns the number of seconds an entity is cached or None."""
+
+        kind = key.path().element_list()[-1].type()
+        return self._kinds.get(kind, self._kinds.get('*'))
+
+    def _count(self, stat, n):
+        if n:
+            self._lock.acquire()
+            try:
+                self._stats[stat] += n
+            finally:
+                self._lock.release()
+
+    def GetStats(self):
+        """Returns the numbers of hits and misses and the hit ratios.
+
+        Query statistics are only included if the query cache is enabled.
+        """
+
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+        finally:
+            self._lock.release()
+        hits = stats['local_hits'] + stats['memcache_hits']
+        total = hits + stats['misses']
+        stats['hit_ratio'] = total and float(hits) / total or 0.0
+        if self._query_cache is None:
+            del stats['query_hits'], stats['query_misses']
+            return stats
+        total = stats['query_hits'] + stats['query_misses']
+        stats['query_hit_ratio'] = (
+            total and float(stats['query_hits']) / total or 0.0)
+        return stats
+
+    def Clear(self):
+        """Clears the wrapped stub, the cache and memcache."""
+
+        self._stub.Clear()
+        self._local_cache.clear()
+        if self._query_cache is not None:
+            self._query_cache.clear()
+        memcache.flush_all()
+        self._lock.acquire()
+        try:
+            self._tx_keys.clear()
+            for stat in self._stats:
+                self._stats[stat] = 0
+        finally:
+            self._lock.release()
+
+    def _invalidate(self, keys, new_keys=()):
+        """Removes entities and the queries which may return them.
+
+        Args:
+            keys: The keys of the written entities.
+            new_keys: Those of the keys which the write allocated IDs for. No
+                get can have read them, so they aren't locked.
+        """
+
+        keys = [key for key in keys if self._getTTL(key) is not None]
+        if not keys:
+            return
+
+        cache_keys = [key.Encode() for key in keys if _isComplete(key)]
+        self._lock.acquire()
+        try:
+            self._epoch += 1
+            for cache_key in cache_keys:
+                self._local_cache.pop(cache_key)
+        finally:
+            self._lock.release()
+        locked = set(cache_keys).difference(key.Encode() for key in new_keys)
+        if locked:
+            # Unlike deleting them, this keeps gets from adding the entities
+            # they read before the write.
+            memcache.set_multi(dict.fromkeys(locked, _LOCKED),
+                               time=LOCK_TTL, namespace=MEMCACHE_NAMESPACE)
+
+        if self._query_cache is None:
+            return
+        generations = set()
+        for key in keys:
+            last = key.path().element_list()[-1]
+            generations.add(
+                _kindGeneration(key.app(), key.name_space(), last.type()))
+            if key.path().element_size() > 1 or _isComplete(key):
+                generations.add(_groupGeneration(key))
+        # Counters start at the current time, so a counter which memcache
+        # evicted doesn't return to a value a cached query has seen.
+        memcache.offset_multi(
+            dict.fromkeys(generations, 1), namespace=GENERATIONS_NAMESPACE,
+            initial_value=int(time.time() * 1000))
+
+    def _rememberKeys(self, transaction, keys):
+        """Records keys written in a transaction until it ends."""
+
+        self._lock.acquire()
+        try:
+            self._tx_keys.setdefault(transaction.handle(), []).extend(keys)
+        finally:
+            self._lock.release()
+
+    def _cacheLocally(self, cache_key, data, epoch):
+        """Caches an entity in-process unless it was invalidated since."""
+
+        self._lock.acquire()
+        try:
+            if self._epoch == epoch:
+                self._local_cache.put(cache_key, data, self._local_ttl)
+        finally:
+            self._lock.release()
+
+    def _forgetKeys(self, transaction):
+        """Returns and forgets the keys written in a transaction."""
+
+        self._lock.acquire()
+        try:
+            return self._tx_keys.pop(transaction.handle(), [])
+        finally:
+            self._lock.release()
+
+    def _Dynamic_Get(self, get_request, get_response):
+        """Serves cached entities and fetches the others."""
+
+        if get_request.has_transaction():
+            self._stub.MakeSyncCall(
+                'datastore_v3', 'Get', get_request, get_response)
+            return
+
+        keys = get_request.key_list()
+        epoch = self._epoch
+        cache_keys = {}
+        for i, key in enumerate(keys):
+            if self._getTTL(key) is not None:
+                cache_keys[i] = key.Encode()
+
+        cached = {}
+        for i, cache_key in cache_keys.iteritems():
+            data = self._local_cache.get(cache_key)
+            if data is not None:
+                cached[i] = data
+        self._count('local_hits', len(cached))
+
+        lookup = [cache_keys[i] for i in cache_keys if i not in cached]
+        if lookup:
+            found = memcache.get_multi(lookup, namespace=MEMCACHE_NAMESPACE)
+            hits = 0
+            for i, cache_key in cache_keys.iteritems():
+                if found.get(cache_key):
+                    cached[i] = found[cache_key]
+                    self._cacheLocally(cache_key, found[cache_key], epoch)
+                    hits += 1
+            self._count('memcache_hits', hits)
+            self._count('misses', len(lookup) - hits)
+
+        missing = [i for i in xrange(len(keys)) if i not in cached]
+        fetched = {}
+        if missing:
+            request = get_request.__class__()
+            request.CopyFrom(get_request)
+            request.clear_key()
+            for i in missing:
+                request.add_key().CopyFrom(keys[i])
+            response = get_response.__class__()
+            self._stub.MakeSyncCall('datastore_v3', 'Get', request, response)
+            fetched = dict(zip(missing, response.entity_list()))
+
+        mappings = {}
+        for i in xrange(len(keys)):
+            group = get_response.add_entity()
+            if i in cached:
+                group.mutable_entity().ParseFromString(cached[i])
+                continue
+            group.CopyFrom(fetched[i])
+            if i in cache_keys and group.has_entity():
+                data = group.entity().Encode()
+                self._cacheLocally(cache_keys[i], data, epoch)
+                mappings.setdefault(
+                    self._getTTL(keys[i]), {})[cache_keys[i]] = data
+
+        for ttl, mapping in mappings.iteritems():
+            memcache.add_multi(
+                mapping, time=ttl, namespace=MEMCACHE_NAMESPACE)
+
+    def _Dynamic_Put(self, put_request, put_response):
+        """Writes entities and invalidates them."""
+
+        keys = [entity.key() for entity in put_request.entity_list()]
+        try:
+            self._stub.MakeSyncCall(
+                'datastore_v3', 'Put', put_request, put_response)
+        finally:
+            # The written keys include the IDs of new entities.
+            new_keys = [key for key, entity in zip(
+                            put_response.key_list(), put_request.entity_list())
+                        if not _isComplete(entity.key())]
+            keys = put_response.key_list() or keys
+            if put_request.has_transaction():
+                self._rememberKeys(put_request.transaction(), keys)
+            else:
+                self._invalidate(keys, new_keys)
+
+    def _Dynamic_Delete(self, delete_request, delete_response):
+        """Deletes entities and invalidates them."""
+
+        keys = delete_request.key_list()
+        try:
+            self._stub.MakeSyncCall(
+                'datastore_v3', 'Delete', delete_request, delete_response)
+        finally:
+            if delete_request.has_transaction():
+                self._rememberKeys(delete_request.transaction(), keys)
+            else:
+                self._invalidate(keys)
+
+    def _Dynamic_Commit(self, transaction, transaction_response):
+        """Commits a transaction and invalidates the entities it wrote."""
+
+        try:
+            self._stub.MakeSyncCall(
+                'datastore_v3', 'Commit', transaction, transaction_response)
+        finally:
+            self._invalidate(self._forgetKeys(transaction))
+
+    def _Dynamic_Rollback(self, transaction, transaction_response):
+        """Rolls back a transaction."""
+
+        self._forgetKeys(transaction)
+        self._stub.MakeSyncCall(
+            'datastore_v3', 'Rollback', transaction, transaction_response)
+
+    def _getQueryTTL(self, query):
+        """Returns the number of seconds a query is cached or None."""
+
+        if (self._query_cache is None or not query.has_kind() or
+                query.has_transaction() or not query.has_limit() or
+                query.limit() > MAX_QUERY_RESULTS):
+            return None
+        return self._kinds.get(query.kind(), self._kinds.get('*'))
+
+    def _runQuery(self, query, query_result):
+        """Runs a query and fetches all results up to its limit."""
+
+        self._stub.MakeSyncCall(
+            'datastore_v3', 'RunQuery', query, query_result)
+        while (query_result.more_results() and
+               query_result.result_size() < query.limit()):
+            next_request = datastore_pb.NextRequest()
+            next_request.mutable_cursor().CopyFrom(query_result.cursor())
+            next_request.set_count(query.limit() - query_result.result_size())
+            result = datastore_pb.QueryResult()
+            self._stub.MakeSyncCall(
+                'datastore_v3', 'Next', next_request, result)
+            for entity in result.result_list():
+                query_result.add_result().CopyFrom(entity)
+            if result.has_compiled_cursor():
+                query_result.mutable_compiled_cursor().CopyFrom(
+                    result.compiled_cursor())
+            if result.has_skipped_results():
+                query_result.set_skipped_results(
+                    query_result.skipped_results() + result.skipped_results())
+            query_result.set_more_results(result.more_results())
+
+    def _Dynamic_RunQuery(self, query, query_result):
+        """Serves cached queries and caches the keys of the others."""
+
+        ttl = self._getQueryTTL(query)
+        if ttl is None:
+            self._stub.MakeSyncCall(
+                'datastore_v3', 'RunQuery', query, query_result)
+            return
+
+        clone = datastore_pb.Query()
+        clone.CopyFrom(query)
+        clone.clear_hint()
+        clone.clear_count()
+        cache_key = clone.Encode()
+        if query.has_ancestor():
+            generation_keys = [_groupGeneration(query.ancestor())]
+        else:
+            generation_keys = [
+                _kindGeneration(query.app(), query.name_space(), query.kind())]
+        # Read before the query runs, so writes meanwhile invalidate it.
+        generations = memcache.get_multi(
+            generation_keys, namespace=GENERATIONS_NAMESPACE)
+        if len(generations) < len(generation_keys):
+            # Otherwise the query would stay valid while the counters are
+            # missing, even if they were evicted after a write.
+            memcache.add_multi(
+                dict.fromkeys(generation_keys, int(time.time() * 1000)),
+                namespace=GENERATIONS_NAMESPACE)
+            generations = memcache.get_multi(
+                generation_keys, namespace=GENERATIONS_NAMESPACE)
+
+        cached = self._query_cache.get(cache_key)
+        if cached is not None and cached[0] == generations:
+            self._count('query_hits', 1)
+            query_result.ParseFromString(cached[1])
+            if not query.keys_only():
+                get_request = datastore_pb.GetRequest()
+                for key in cached[2]:
+                    get_request.add_key().ParseFromString(key)
+                get_response = datastore_pb.GetResponse()
+                self._Dynamic_Get(get_request, get_response)
+                for group in get_response.entity_list():
+                    if group.has_entity():
+                        query_result.add_result().CopyFrom(group.entity())
+            return
+
+        self._count('query_misses', 1)
+        self._runQuery(query, query_result)
+        if (len(generations) < len(generation_keys) or
+                (query_result.more_results() and
+                 query_result.result_size() < query.limit())):
+            return
+        stored = datastore_pb.QueryResult()
+        stored.CopyFrom(query_result)
+        # Compiled cursors are kept, they don't depend on the wrapped stub's
+        # cursor which isn't used for the cached results.
+        stored.set_more_results(False)
+        keys = []
+        if not query.keys_only():
+            keys = [entity.key().Encode()
+                    for entity in query_result.result_list()]
+            stored.clear_result()
+        self._query_cache.put(
+            cache_key, (generations, stored.Encode(), keys), ttl)
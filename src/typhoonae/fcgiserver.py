@@ -317,6 +317,16 @@ def main():
                       % '/'.join(sorted(typhoonae.SUPPORTED_DATASTORES)),
                   default='mongodb')
 
+    op.add_option("--datastore_cache", dest="datastore_cache",
+                  metavar="KIND[:TTL],...",
+                  help="cache entities of these kinds ('*' for all) in "
+                       "memcache", default=None)
+
+    op.add_option("--datastore_query_cache", dest="datastore_query_cache",
+                  metavar="NUM", type="int",
+                  help="maximum number of cached queries of the kinds "
+                       "given by --datastore_cache", default=0)
+
     op.add_option("--debug", dest="debug_mode", action="store_true",
                   help="enables debug mode", default=False)
 
@@ -338,6 +348,33 @@ def main():
     op.add_option("--logout_url", dest="logout_url", metavar="URL",
                   help="logout URL", default='/_ah/logout')
 
+    op.add_option("--mongodb_pool_size", dest="mongodb_pool_size",
+                  metavar="NUM", type="int",
+                  help="maximum number of pooled MongoDB connections",
+                  default=10)
+
+    op.add_option("--mongodb_read_preference",
+                  dest="mongodb_read_preference", metavar="MODE",
+                  help="serve eventually consistent reads from the 'primary' "
+                       "or a 'secondary'", default='primary')
+
+    op.add_option("--mongodb_replica_set", dest="mongodb_replica_set",
+                  metavar="NAME", help="name of the MongoDB replica set",
+                  default=None)
+
+    op.add_option("--mongodb_timeout", dest="mongodb_timeout",
+                  metavar="SECONDS", type="float",
+                  help="MongoDB socket timeout", default=None)
+
+    op.add_option("--mongodb_uri", dest="mongodb_uri", metavar="URI",
+                  help="connect to this MongoDB host or connection URI",
+                  default=None)
+
+    op.add_option("--mongodb_write_concern", dest="mongodb_write_concern",
+                  metavar="NUM", type="int",
+                  help="number of MongoDB servers which must acknowledge a "
+                       "write", default=None)
+
     op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
                   help="connect to the given MySQL database",
                   default='typhoonae')
@@ -350,6 +387,10 @@ def main():
                   help="use this password to connect to the MySQL database "
                        "server", default='')
 
+    op.add_option("--mysql_pool_size", dest="mysql_pool_size", metavar="NUM",
+                  type="int", help="maximum number of MySQL connections",
+                  default=10)
+
     op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
                   help="use this user to connect to the MySQL database server",
                   default='root')
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Allocates integer IDs from blocks reserved in a shared counter.
+
+Every process reserves blocks of consecutive IDs with a single atomic
+operation on a counter which is shared by all processes, and hands out the
+IDs of its blocks from memory. The block size adapts to the rate at which
+IDs are used, so frequently written kinds rarely touch the counter while
+rarely written ones don't waste many IDs.
+"""
+
+import threading
+import time
+
+MIN_BLOCK_SIZE = 10
+
+MAX_BLOCK_SIZE = 100000
+
+# Number of seconds a block should last.
+BLOCK_INTERVAL = 10.0
+
+
+class IdAllocator(object):
+    """Thread-safe allocator of consecutive integer IDs per key.
+
+    Handing out IDs of a reserved block only takes a short in-memory lock.
+    Reserving a new block blocks the threads which wait for IDs of the same
+    key, but not the others.
+    """
+
+    def __init__(self, reserve, min_block_size=MIN_BLOCK_SIZE,
+                 max_block_size=MAX_BLOCK_SIZE, interval=BLOCK_INTERVAL,
+                 clock=time.time):
+        """Constructor.
+
+        Args:
+            reserve: Callable receiving a key and a number of IDs which
+                atomically advances the shared counter of the key and
+                returns the first reserved ID.
+            min_block_size: Minimum number of IDs reserved at once.
+            max_block_size: Maximum number of IDs reserved at once.
+            interval: Number of seconds a block should last.
+            clock: Used for dependency injection.
+        """
+        assert 0 < min_block_size <= max_block_size
+        self._reserve = reserve
+        self.min_block_size = min_block_size
+        self.max_block_size = max_block_size
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Maps keys to [next_id, end, block_size, reserved_at] lists.
+        self._blocks = {}
+        self._refill_locks = {}
+
+    def _take(self, key, size):
+        """Returns the first of size IDs of the current block or None."""
+
+        self._lock.acquire()
+        try:
+            block = self._blocks.get(key)
+            if block is None or block[1] - block[0] < size:
+                return None
+            first = block[0]
+            block[0] += size
+            return first
+        finally:
+            self._lock.release()
+
+    def _nextBlockSize(self, key):
+        """Returns the size of the next block of a key.
+
+        The size doubles when the last block was used up in less than half
+        the interval and halves when it lasted more than twice as long.
+        """
+        self._lock.acquire()
+        try:
+            block = self._blocks.get(key)
+        finally:
+            self._lock.release()
+        if block is None:
+            return self.min_block_size
+        block_size = block[2]
+        elapsed = self._clock() - block[3]
+        if elapsed < self.interval / 2:
+            block_size *= 2
+        elif elapsed > self.interval * 2:
+            block_size //= 2
+        return max(self.min_block_size, min(self.max_block_size, block_size))
+
+    def allocate(self, key, size=1):
+        """Allocates consecutive IDs.
+
+        Args:
+            key: The key of the counter, e.g. a kind.
+            size: Number of IDs.
+
+        Returns:
+            The first ID.
+        """
+        assert size > 0
+        first = self._take(key, size)
+        if first is not None:
+            return first
+
+        self._lock.acquire()
+        try:
+            refill_lock = self._refill_locks.setdefault(
+                key, threading.Lock())
+        finally:
+            self._lock.release()
+
+        refill_lock.acquire()
+        try:
+            # Another thread may have reserved a block meanwhile.
+            first = self._take(key, size)
+            if first is not None:
+                return first
+            block_size = self._nextBlockSize(key)
+            if size >= block_size:
+                return self._reserve(key, size)
+            first = self._reserve(key, block_size)
+            self._lock.acquire()
+            try:
+                self._blocks[key] = [
+                    first + size, first + block_size, block_size,
+                    self._clock()]
+            finally:
+                self._lock.release()
+            return first
+        finally:
+            refill_lock.release()
+
+    def discard(self, key):
+        """Forgets the unused IDs of a key."""
+
+        self._lock.acquire()
+        try:
+            self._blocks.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Forgets the unused IDs of all keys."""
+
+        self._lock.acquire()
+        try:
+            self._blocks.clear()
+        finally:
+            self._lock.release()
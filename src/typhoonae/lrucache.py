@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Bounded in-process cache with LRU eviction and optional expiration."""
+
+import threading
+import time
+
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = range(5)
+
+
+class LRUCache(object):
+    """Thread-safe mapping which holds a bounded number of items.
+
+    Items are evicted in least recently used order when the cache is full and
+    after they have not been written for ttl seconds.
+    """
+
+    def __init__(self, max_size, ttl=None, on_evict=None, clock=time.time):
+        """Constructor.
+
+        Args:
+            max_size: Maximum number of items.
+            ttl: Number of seconds after which an item expires or None.
+            on_evict: Callable receiving key and value of every item which
+                gets evicted, expires or is cleared.
+            clock: Used for dependency injection.
+        """
+        assert max_size > 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self._on_evict = on_evict
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._map = {}
+        # Circular doubly linked list, the root's successor is the least
+        # recently used link.
+        self._root = root = [None, None, None, None, None]
+        root[_PREV] = root[_NEXT] = root
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def _unlink(self, link):
+        link[_PREV][_NEXT] = link[_NEXT]
+        link[_NEXT][_PREV] = link[_PREV]
+
+    def _append(self, link):
+        root = self._root
+        last = root[_PREV]
+        link[_PREV], link[_NEXT] = last, root
+        last[_NEXT] = root[_PREV] = link
+
+    def _evict(self, link):
+        self._unlink(link)
+        del self._map[link[_KEY]]
+        if self._on_evict:
+            self._on_evict(link[_KEY], link[_VALUE])
+
+    def get(self, key, default=None):
+        """Returns the value for key and marks it as recently used."""
+
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            if link[_EXPIRES] is not None and link[_EXPIRES] <= self._clock():
+                self._evict(link)
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, ttl=None):
+        """Stores a value and evicts the least recently used items if needed.
+
+        Args:
+            key: The key.
+            value: The value.
+            ttl: Overrides the cache's default time to live for this item.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = self._clock() + ttl
+
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[_VALUE], link[_EXPIRES] = value, expires
+            else:
+                link = [None, None, key, value, expires]
+                self._map[key] = link
+            self._append(link)
+            while len(self._map) > self.max_size:
+                self._evict(self._root[_NEXT])
+        finally:
+            self._lock.release()
+
+    __setitem__ = put
+
+    def pop(self, key, default=None):
+        """Removes an item without calling the eviction callback."""
+
+        self._lock.acquire()
+        try:
+            link = self._map.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[_VALUE]
+        finally:
+            self._lock.release()
+
+    def expire(self):
+        """Evicts all expired items."""
+
+        if self.ttl is None:
+            return
+        self._lock.acquire()
+        try:
+            now = self._clock()
+            for link in self._map.values():
+                if link[_EXPIRES] is not None and link[_EXPIRES] <= now:
+                    self._evict(link)
+        finally:
+            self._lock.release()
+
+    def trim(self, size):
+        """Evicts the least recently used items until at most size remain."""
+
+        self._lock.acquire()
+        try:
+            while len(self._map) > max(size, 0):
+                self._evict(self._root[_NEXT])
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Evicts all items."""
+
+        self._lock.acquire()
+        try:
+            while self._map:
+                self._evict(self._root[_NEXT])
+        finally:
+            self._lock.release()
+
+    def items(self):
+        """Returns a list of (key, value) tuples, least recently used first."""
+
+        self._lock.acquire()
+        try:
+            result = []
+            link = self._root[_NEXT]
+            while link is not self._root:
+                result.append((link[_KEY], link[_VALUE]))
+                link = link[_NEXT]
+            return result
+        finally:
+            self._lock.release()
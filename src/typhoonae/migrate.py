@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Copies the entities of an app from one Datastore backend to another.
+
+Entities are read through a stub of the source backend in key order and
+written in batches through a stub of the destination backend, so keys,
+namespaces and IDs are kept. Every kind of every namespace is copied by one
+of several worker processes. Unless given, namespaces and kinds are taken
+from the source. Finally, the ID counters of the destination are advanced
+beyond the highest copied IDs.
+
+The progress is written to a checkpoint file after every batch. An
+interrupted migration continues where it stopped when started again with
+the same checkpoint file.
+"""
+
+import base64
+import logging
+import multiprocessing
+import optparse
+import os
+import simplejson
+
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import entity_pb
+
+DESCRIPTION = "Copies an app's entities between Datastore backends."
+USAGE = "usage: %prog [options] SOURCE DESTINATION"
+
+BATCH_SIZE = 500
+
+WORKERS = 4
+
+
+def createStub(spec, app_id):
+    """Creates a Datastore stub.
+
+    Args:
+        spec: 'mongodb[:URI]', 'mysql:USER[:PASSWD]@HOST/DB' or
+            'sqlite:PATH'.
+        app_id: The application id.
+
+    Returns:
+        A Datastore stub.
+    """
+    name, sep, arg = spec.partition(':')
+
+    if name == 'mongodb':
+        from typhoonae.mongodb import datastore_mongo_stub
+        return datastore_mongo_stub.DatastoreMongoStub(app_id, uri=arg or None)
+    elif name == 'mysql':
+        from typhoonae.mysql import datastore_mysql_stub
+        credentials, sep, location = arg.rpartition('@')
+        user, sep, passwd = credentials.partition(':')
+        host, sep, db = location.partition('/')
+        database_info = {
+            "host": host or '127.0.0.1',
+            "user": user or 'root',
+            "passwd": passwd,
+            "db": db or 'typhoonae',
+        }
+        return datastore_mysql_stub.DatastoreMySQLStub(app_id, database_info)
+    elif name == 'sqlite':
+        from google.appengine.datastore import datastore_sqlite_stub
+        return datastore_sqlite_stub.DatastoreSqliteStub(app_id, arg)
+    raise ValueError("unknown datastore %r" % spec)
+
+
+def getNamespaces(stub, app_id):
+    """Returns the namespaces of an app, always including ''.
+
+    The MongoDB and MySQL stubs list their namespaces, others are asked with
+    a __namespace__ metadata query.
+    """
+    if hasattr(stub, 'Namespaces'):
+        return stub.Namespaces()
+    query = datastore_pb.Query()
+    query.set_app(app_id)
+    query.set_kind('__namespace__')
+    query.set_keys_only(True)
+    query.set_limit(BATCH_SIZE)
+    namespaces = set([''])
+    for entity in fetchBatch(stub, query):
+        namespaces.add(entity.key().path().element(0).name())
+    return sorted(namespaces)
+
+
+def getKinds(stub, app_id, namespace):
+    """Returns the kinds of a namespace the stub reports in its schema."""
+
+    request = datastore_pb.GetSchemaRequest()
+    request.set_app(app_id)
+    if namespace and hasattr(request, 'set_name_space'):
+        request.set_name_space(namespace)
+    schema = datastore_pb.Schema()
+    stub.MakeSyncCall('datastore_v3', 'GetSchema', request, schema)
+    return sorted(set(entity.key().path().element(0).type()
+                      for entity in schema.kind_list()))
+
+
+def _makeQuery(app_id, namespace, kind, last_key, batch_size):
+    """Returns a query for the next batch of entities in key order."""
+
+    query = datastore_pb.Query()
+    query.set_app(app_id)
+    if namespace:
+        query.set_name_space(namespace)
+    query.set_kind(kind)
+    query.set_limit(batch_size)
+    query.set_count(batch_size)
+    order = query.add_order()
+    order.set_property('__key__')
+    order.set_direction(datastore_pb.Query_Order.ASCENDING)
+    if last_key is not None:
+        query_filter = query.add_filter()
+        query_filter.set_op(datastore_pb.Query_Filter.GREATER_THAN)
+        prop = query_filter.add_property()
+        prop.set_name('__key__')
+        prop.set_multiple(False)
+        ref = prop.mutable_value().mutable_referencevalue()
+        ref.set_app(last_key.app())
+        if last_key.has_name_space():
+            ref.set_name_space(last_key.name_space())
+        for element in last_key.path().element_list():
+            path_element = ref.add_pathelement()
+            path_element.set_type(element.type())
+            if element.has_id():
+                path_element.set_id(element.id())
+            if element.has_name():
+                path_element.set_name(element.name())
+    return query
+
+
+def fetchBatch(stub, query):
+    """Returns the entities of a query up to its limit."""
+
+    result = datastore_pb.QueryResult()
+    stub.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+    entities = list(result.result_list())
+    while result.more_results() and len(entities) < query.limit():
+        next_request = datastore_pb.NextRequest()
+        next_request.mutable_cursor().CopyFrom(result.cursor())
+        next_request.set_count(query.limit() - len(entities))
+        result = datastore_pb.QueryResult()
+        stub.MakeSyncCall('datastore_v3', 'Next', next_request, result)
+        entities.extend(result.result_list())
+    return entities[:query.limit()]
+
+
+def copyKind(source, destination, app_id, namespace, kind, last_key=None,
+             batch_size=BATCH_SIZE, progress=None):
+    """Copies the entities of a kind in batches.
+
+    Args:
+        source: The source stub.
+        destination: The destination stub.
+        app_id: The application id.
+        namespace: The namespace.
+        kind: The kind.
+        last_key: The entity_pb.Reference of the last copied entity of an
+            earlier run or None.
+        batch_size: Number of entities per batch.
+        progress: Callable receiving the last copied key, the number of
+            copied entities and the highest copied ID after every batch.
+
+    Returns:
+        The number of copied entities.
+    """
+    copied = 0
+    while True:
+        query = _makeQuery(app_id, namespace, kind, last_key, batch_size)
+        entities = fetchBatch(source, query)
+        if not entities:
+            return copied
+        request = datastore_pb.PutRequest()
+        for entity in entities:
+            request.add_entity().CopyFrom(entity)
+        destination.MakeSyncCall(
+            'datastore_v3', 'Put', request, datastore_pb.PutResponse())
+        copied += len(entities)
+        last_key = entities[-1].key()
+        max_id = max([entity.key().path().element_list()[-1].id()
+                      for entity in entities])
+        if progress:
+            progress(last_key, len(entities), max_id)
+        if len(entities) < batch_size:
+            return copied
+
+
+def advanceIds(stub, app_id, namespace, kind, max_id):
+    """Makes sure the stub never allocates IDs up to max_id for a kind."""
+
+    request = datastore_pb.AllocateIdsRequest()
+    model_key = request.mutable_model_key()
+    model_key.set_app(app_id)
+    if namespace:
+        model_key.set_name_space(namespace)
+    model_key.mutable_path().add_element().set_type(kind)
+    request.set_max(max_id)
+    stub.MakeSyncCall('datastore_v3', 'AllocateIds', request,
+                      datastore_pb.AllocateIdsResponse())
+
+
+class Checkpoint(object):
+    """The progress of a migration, stored in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.units = {}
+        if path and os.path.exists(path):
+            f = open(path)
+            try:
+                for unit in simplejson.load(f)['units']:
+                    self.units[(unit['namespace'], unit['kind'])] = unit
+            finally:
+                f.close()
+
+    def get(self, namespace, kind):
+        """Returns the state of a kind, creating it if necessary."""
+
+        return self.units.setdefault((namespace, kind), {
+            'namespace': namespace, 'kind': kind, 'last_key': None,
+            'copied': 0, 'max_id': 0, 'done': False})
+
+    def getLastKey(self, namespace, kind):
+        """Returns the last copied key of a kind or None."""
+
+        last_key = self.get(namespace, kind)['last_key']
+        if last_key is None:
+            return None
+        return entity_pb.Reference(base64.b64decode(last_key))
+
+    def update(self, namespace, kind, last_key, copied, max_id):
+        unit = self.get(namespace, kind)
+        unit['last_key'] = base64.b64encode(last_key.Encode())
+        unit['copied'] += copied
+        unit['max_id'] = max(unit['max_id'], max_id)
+
+    def save(self):
+        """Replaces the checkpoint file atomically."""
+
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            simplejson.dump({'units': self.units.values()}, f, indent=2)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+
+def _work(source_spec, destination_spec, app_id, batch_size, tasks, results):
+    """Copies the kinds it takes from the task queue."""
+
+    source = createStub(source_spec, app_id)
+    destination = createStub(destination_spec, app_id)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        namespace, kind, last_key = task
+        if last_key is not None:
+            last_key = entity_pb.Reference(last_key)
+
+        def progress(last_key, copied, max_id):
+            results.put(('progress', namespace, kind, last_key.Encode(),
+                         copied, max_id))
+
+        try:
+            copyKind(source, destination, app_id, namespace, kind, last_key,
+                     batch_size, progress)
+        except Exception, e:
+            results.put(('error', namespace, kind, '%s: %s' % (
+                e.__class__.__name__, e)))
+        else:
+            results.put(('done', namespace, kind))
+
+
+def migrate(source_spec, destination_spec, app_id, namespaces, kinds=None,
+            checkpoint_path=None, workers=WORKERS, batch_size=BATCH_SIZE):
+    """Copies all entities of an app.
+
+    Args:
+        source_spec: The source backend, see createStub.
+        destination_spec: The destination backend, see createStub.
+        app_id: The application id.
+        namespaces: A list of namespaces. If None, the namespaces are taken
+            from the source.
+        kinds: A list of kinds. If None, the kinds are taken from the
+            source's schema.
+        checkpoint_path: Path of the checkpoint file or None.
+        workers: Number of worker processes.
+        batch_size: Number of entities per batch.
+
+    Returns:
+        A list of (namespace, kind, error) tuples of kinds which failed.
+
+    Raises:
+        ValueError: If no kinds are given and the source reports none.
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    source = createStub(source_spec, app_id)
+
+    if namespaces is None:
+        namespaces = getNamespaces(source, app_id)
+    units = []
+    for namespace in namespaces:
+        for kind in kinds or getKinds(source, app_id, namespace):
+            units.append((namespace, kind))
+    if not units:
+        raise ValueError("the source reports no kinds, they must be given")
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    pending = 0
+    for namespace, kind in units:
+        if checkpoint.get(namespace, kind)['done']:
+            continue
+        last_key = checkpoint.getLastKey(namespace, kind)
+        if last_key is not None:
+            last_key = last_key.Encode()
+        tasks.put((namespace, kind, last_key))
+        pending += 1
+    checkpoint.save()
+
+    processes = [
+        multiprocessing.Process(
+            target=_work, args=(source_spec, destination_spec, app_id,
+                                batch_size, tasks, results))
+        for i in xrange(min(workers, pending))]
+    for process in processes:
+        tasks.put(None)
+        process.start()
+
+    errors = []
+    while pending:
+        message = results.get()
+        namespace, kind = message[1:3]
+        if message[0] == 'progress':
+            last_key, copied, max_id = message[3:]
+            checkpoint.update(namespace, kind, entity_pb.Reference(last_key),
+                              copied, max_id)
+        elif message[0] == 'done':
+            checkpoint.get(namespace, kind)['done'] = True
+            logging.info("Copied %s/%s", namespace, kind)
+            pending -= 1
+        else:
+            logging.error("Failed to copy %s/%s: %s", namespace, kind,
+                          message[3])
+            errors.append((namespace, kind, message[3]))
+            pending -= 1
+        checkpoint.save()
+
+    for process in processes:
+        process.join()
+
+    destination = createStub(destination_spec, app_id)
+    for (namespace, kind), unit in sorted(checkpoint.units.items()):
+        if unit['max_id']:
+            advanceIds(destination, app_id, namespace, kind, unit['max_id'])
+    return errors
+
+
+def main():
+    """Runs the migration."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--app_id", dest="app_id", metavar="STRING",
+                  help="the application id")
+
+    op.add_option("--batch_size", dest="batch_size", metavar="NUMBER",
+                  help="number of entities per batch",
+                  default=BATCH_SIZE, type="int")
+
+    op.add_option("--checkpoint", dest="checkpoint", metavar="PATH",
+                  help="resume from and record progress in this file",
+                  default=None)
+
+    op.add_option("--kinds", dest="kinds", metavar="LIST",
+                  help="comma separated kinds, by default the kinds in the "
+                       "source's schema", default=None)
+
+    op.add_option("--namespaces", dest="namespaces", metavar="LIST",
+                  help="comma separated namespaces, the default namespace "
+                       "is empty, by default all namespaces of the source",
+                  default=None)
+
+    op.add_option("--workers", dest="workers", metavar="NUMBER",
+                  help="number of worker processes",
+                  default=WORKERS, type="int")
+
+    (options, args) = op.parse_args()
+
+    if len(args) != 2 or not options.app_id:
+        op.error("an app id, a source and a destination are required, e.g. "
+                 "--app_id=app sqlite:app.datastore mysql:root@localhost/app")
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    os.environ['APPLICATION_ID'] = options.app_id
+
+    namespaces = None
+    if options.namespaces is not None:
+        namespaces = options.namespaces.split(',')
+    kinds = None
+    if options.kinds:
+        kinds = options.kinds.split(',')
+    try:
+        errors = migrate(args[0], args[1], options.app_id, namespaces, kinds,
+                         options.checkpoint, options.workers,
+                         options.batch_size)
+    except ValueError, e:
+        op.error(str(e))
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
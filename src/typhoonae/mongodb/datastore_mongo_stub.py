@@ -23,7 +23,7 @@ from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore
 from google.appengine.api import datastore_errors
 from google.appengine.api import datastore_types
-from google.appengine.api import users
+from google.appengine.api import yaml_errors
 from google.appengine.datastore import datastore_pb
 from google.appengine.datastore import datastore_index
 from google.appengine.runtime import apiproxy_errors
@@ -32,13 +32,21 @@ from pymongo.connection import Connection
 from pymongo.binary import Binary
 from pymongo.errors import InvalidName
 
+import datetime
+import itertools
 import logging
+import os
 import pymongo
 import re
 import random
 import sys
 import threading
+import time
 import types
+import typhoonae.async_rpc
+import typhoonae.idallocator
+import typhoonae.lrucache
+import typhoonae.multiquery
 
 try:
   __import__('google.appengine.api.taskqueue.taskqueue_service_pb')
@@ -58,8 +66,439 @@ _CURSOR_CONCAT_STR = '!CURSOR!'
 
 _MAX_ACTIONS_PER_TXN = 5
 
+_MAX_CURSORS = 1000
+
+_CURSOR_TTL = 600
+
+_MAX_QUERY_HISTORY = 1000
+
+_OPERATORS = {datastore_pb.Query_Filter.LESS_THAN:             '<',
+              datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
+              datastore_pb.Query_Filter.GREATER_THAN:          '>',
+              datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+              datastore_pb.Query_Filter.EQUAL:                 '==',
+              datastore_pb.Query_Filter.IN:                    'IN',
+              typhoonae.multiquery.NOT_EQUAL:                  '!=',
+              }
+
 _NAMESPACE_CONCAT_STR = '.'
 
+_PATH_CONCAT_STR = '\10'
+
+_REGEX_SPECIAL_CHARS = re.compile(r'([.^$*+?{}\[\]\\|()])')
+
+_ENTITY_GROUP_PREFIX = 'EntityGroup_'
+
+# Seconds after which the lock of a writer which died is broken.
+_ENTITY_GROUP_LOCK_TIMEOUT = 30
+
+# Seconds to wait between attempts to read or lock a locked entity group.
+_ENTITY_GROUP_LOCK_WAIT = 0.01
+
+_READ_PREFERENCES = ('primary', 'secondary')
+
+
+_EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+_RAW_MEANINGS = frozenset([entity_pb.Property.BLOB, entity_pb.Property.TEXT])
+
+
+def _mongo_id_for_path(elements):
+  """Returns the document id for a list of key path elements."""
+
+  db_path = []
+  for elem in elements:
+    db_path.append(elem.type())
+    if elem.has_name():
+      db_path.append(elem.name())
+    else:
+      db_path.append("\t" + str(elem.id()).zfill(10))
+  return _PATH_CONCAT_STR.join(db_path)
+
+
+def _fill_path_for_mongo_id(id, add_element):
+  """Adds the key path elements encoded in a document id.
+
+  Args:
+    id: The document id.
+    add_element: Callable returning a new, empty path element.
+  """
+  parts = id.split(_PATH_CONCAT_STR)
+  for i in xrange(0, len(parts), 2):
+    elem = add_element()
+    elem.set_type(parts[i].encode('utf-8'))
+    if parts[i + 1].startswith("\t"):
+      elem.set_id(int(parts[i + 1][1:]))
+    else:
+      elem.set_name(parts[i + 1].encode('utf-8'))
+
+
+# Converters from property values to BSON values. Strings are dispatched on
+# the property's meaning.
+
+def _mongo_text(value):
+  return {
+    'class': 'text',
+    'string': value.decode('utf-8'),
+    }
+
+def _mongo_bytes(value):
+  return {
+    'class': 'bytes',
+    'value': Binary(value)
+    }
+
+def _mongo_category(value):
+  return {
+    'class': 'category',
+    'category': value,
+    }
+
+def _mongo_email(value):
+  return {
+    'class': 'email',
+    'value': value.decode('utf-8'),
+    }
+
+def _mongo_im(value):
+  protocol, address = value.decode('utf-8').split(' ', 1)
+  return {
+    'class': 'im',
+    'protocol': protocol,
+    'address': address,
+    }
+
+def _mongo_blobkey(value):
+  return {
+    'class': 'blobkey',
+    'value': value,
+    }
+
+_MONGO_VALUE_FOR_STRING = {
+    entity_pb.Property.BLOB: Binary,
+    entity_pb.Property.TEXT: _mongo_text,
+    entity_pb.Property.BYTESTRING: _mongo_bytes,
+    entity_pb.Property.ATOM_CATEGORY: _mongo_category,
+    entity_pb.Property.GD_EMAIL: _mongo_email,
+    entity_pb.Property.GD_IM: _mongo_im,
+    entity_pb.Property.BLOBKEY: _mongo_blobkey,
+}
+
+
+def _mongo_value_for_property(prop):
+  """Converts the value of a Property PB into a BSON value."""
+
+  value = prop.value()
+  if value.has_stringvalue():
+    converter = _MONGO_VALUE_FOR_STRING.get(prop.meaning())
+    if converter is None:
+      return value.stringvalue().decode('utf-8')
+    return converter(value.stringvalue())
+  if value.has_int64value():
+    meaning = prop.meaning()
+    if meaning == entity_pb.Property.GD_WHEN:
+      return _EPOCH + datetime.timedelta(microseconds=value.int64value())
+    if meaning == entity_pb.Property.GD_RATING:
+      return {
+        'class': 'rating',
+        'rating': int(value.int64value()),
+        }
+    return value.int64value()
+  if value.has_booleanvalue():
+    return value.booleanvalue()
+  if value.has_doublevalue():
+    return value.doublevalue()
+  if value.has_referencevalue():
+    return {
+      'class': 'key',
+      'path': _mongo_id_for_path(
+          value.referencevalue().pathelement_list()),
+      }
+  if value.has_pointvalue():
+    return {
+      'class': 'geopt',
+      'lat': value.pointvalue().x(),
+      'lon': value.pointvalue().y(),
+      }
+  if value.has_uservalue():
+    return {
+      'class': 'user',
+      'email': value.uservalue().email().decode('utf-8'),
+      }
+  return None
+
+
+_SORT_KEY_FOR_CLASS = {
+    'rating': lambda v: v['rating'],
+    'category': lambda v: v['category'],
+    'key': lambda v: v['path'],
+    'user': lambda v: v['email'],
+    'text': lambda v: v['string'],
+    'im': lambda v: (v['protocol'], v['address']),
+    'geopt': lambda v: (v['lat'], v['lon']),
+    'email': lambda v: v['value'],
+    'bytes': lambda v: str(v['value']),
+    'blobkey': lambda v: v['value'],
+}
+
+
+def _sort_key_for_mongo_value(value):
+  """Returns a key which sorts BSON values like their datastore values."""
+
+  if isinstance(value, dict):
+    return _SORT_KEY_FOR_CLASS[value['class']](value)
+  if isinstance(value, Binary):
+    return str(value)
+  return value
+
+
+def _mongo_list(values):
+  """Returns the BSON representation of a multi-valued property."""
+
+  sorted_values = sorted(values, key=_sort_key_for_mongo_value)
+  return {
+    'class': 'list',
+    'list': values,
+    'ascending_sort_key': sorted_values[0],
+    'descending_sort_key': sorted_values[-1],
+    }
+
+
+def mongo_document_for_entity(entity):
+  """Converts an EntityProto into a MongoDB document.
+
+  Args:
+    entity: An entity_pb.EntityProto instance.
+
+  Returns:
+    A dict which can be stored by pymongo.
+  """
+  document = {'_id': _mongo_id_for_path(entity.key().path().element_list())}
+  lists = {}
+  for prop in itertools.chain(entity.property_list(),
+                              entity.raw_property_list()):
+    name = prop.name().decode('utf-8')
+    if prop.multiple():
+      lists.setdefault(name, []).append(_mongo_value_for_property(prop))
+    else:
+      document[name] = _mongo_value_for_property(prop)
+  for name, values in lists.iteritems():
+    document[name] = _mongo_list(values)
+  return document
+
+
+# Converters from BSON values to property values, dispatched on the value's
+# type or its 'class' tag. Each converter fills out a Property PB.
+
+def _set_int64(prop, value, app, name_space):
+  prop.mutable_value().set_int64value(value)
+
+def _set_boolean(prop, value, app, name_space):
+  prop.mutable_value().set_booleanvalue(value)
+
+def _set_double(prop, value, app, name_space):
+  prop.mutable_value().set_doublevalue(value)
+
+def _set_unicode(prop, value, app, name_space):
+  prop.mutable_value().set_stringvalue(value.encode('utf-8'))
+
+def _set_string(prop, value, app, name_space):
+  prop.mutable_value().set_stringvalue(value)
+
+def _set_none(prop, value, app, name_space):
+  prop.mutable_value()
+
+def _set_blob(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.BLOB)
+  prop.mutable_value().set_stringvalue(str(value))
+
+def _set_datetime(prop, value, app, name_space):
+  if value.tzinfo is not None:
+    value = value.replace(tzinfo=None) - value.utcoffset()
+  delta = value - _EPOCH
+  prop.set_meaning(entity_pb.Property.GD_WHEN)
+  prop.mutable_value().set_int64value(
+      (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+def _set_rating(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.GD_RATING)
+  prop.mutable_value().set_int64value(int(value['rating']))
+
+def _set_category(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.ATOM_CATEGORY)
+  prop.mutable_value().set_stringvalue(value['category'].encode('utf-8'))
+
+def _set_key(prop, value, app, name_space):
+  ref = prop.mutable_value().mutable_referencevalue()
+  ref.set_app(app)
+  if name_space:
+    ref.set_name_space(name_space)
+  _fill_path_for_mongo_id(value['path'], ref.add_pathelement)
+
+def _set_user(prop, value, app, name_space):
+  user = prop.mutable_value().mutable_uservalue()
+  user.set_email(value['email'].encode('utf-8'))
+  user.set_auth_domain(os.environ.get('AUTH_DOMAIN', 'gmail.com'))
+  user.set_gaiaid(0)
+
+def _set_text(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.TEXT)
+  prop.mutable_value().set_stringvalue(value['string'].encode('utf-8'))
+
+def _set_im(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.GD_IM)
+  prop.mutable_value().set_stringvalue(
+      (u'%s %s' % (value['protocol'], value['address'])).encode('utf-8'))
+
+def _set_geopt(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.GEORSS_POINT)
+  point = prop.mutable_value().mutable_pointvalue()
+  point.set_x(value['lat'])
+  point.set_y(value['lon'])
+
+def _set_email(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.GD_EMAIL)
+  prop.mutable_value().set_stringvalue(value['value'].encode('utf-8'))
+
+def _set_bytes(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.BYTESTRING)
+  prop.mutable_value().set_stringvalue(str(value['value']))
+
+def _set_blobkey(prop, value, app, name_space):
+  prop.set_meaning(entity_pb.Property.BLOBKEY)
+  prop.mutable_value().set_stringvalue(value['value'].encode('utf-8'))
+
+_PROPERTY_SETTER_FOR_CLASS = {
+    'rating': _set_rating,
+    'category': _set_category,
+    'key': _set_key,
+    'user': _set_user,
+    'text': _set_text,
+    'im': _set_im,
+    'geopt': _set_geopt,
+    'email': _set_email,
+    'bytes': _set_bytes,
+    'blobkey': _set_blobkey,
+}
+
+def _set_class(prop, value, app, name_space):
+  _PROPERTY_SETTER_FOR_CLASS[value['class']](prop, value, app, name_space)
+
+_PROPERTY_SETTER_FOR_TYPE = {
+    int: _set_int64,
+    long: _set_int64,
+    bool: _set_boolean,
+    float: _set_double,
+    unicode: _set_unicode,
+    str: _set_string,
+    types.NoneType: _set_none,
+    Binary: _set_blob,
+    datetime.datetime: _set_datetime,
+    dict: _set_class,
+}
+
+
+def _property_setter_for_value(value):
+  """Looks up the converter for a BSON value."""
+
+  setter = _PROPERTY_SETTER_FOR_TYPE.get(type(value))
+  if setter is None:
+    for value_type, setter in _PROPERTY_SETTER_FOR_TYPE.iteritems():
+      if isinstance(value, value_type) and value_type is not bool:
+        break
+    else:
+      raise datastore_errors.BadValueError(
+          'Unsupported document value %r' % (value,))
+  return setter
+
+
+def entity_for_mongo_document(document, app, name_space=''):
+  """Converts a MongoDB document into an EntityProto.
+
+  Args:
+    document: A dict as returned by pymongo.
+    app: The app id of the entity.
+    name_space: The namespace of the entity.
+
+  Returns:
+    An entity_pb.EntityProto instance.
+  """
+  entity = entity_pb.EntityProto()
+  key = entity.mutable_key()
+  key.set_app(app)
+  if name_space:
+    key.set_name_space(name_space)
+  _fill_path_for_mongo_id(document['_id'], key.mutable_path().add_element)
+  entity.mutable_entity_group().add_element().CopyFrom(key.path().element(0))
+
+  names = document.keys()
+  names.sort()
+  for name in names:
+    if name == '_id':
+      continue
+    value = document[name]
+    encoded_name = name.encode('utf-8')
+    if isinstance(value, dict) and value.get('class') == 'list':
+      values, multiple = value['list'], True
+    else:
+      values, multiple = (value,), False
+    for value in values:
+      prop = entity_pb.Property()
+      prop.set_name(encoded_name)
+      prop.set_multiple(multiple)
+      _property_setter_for_value(value)(prop, value, app, name_space)
+      if prop.meaning() in _RAW_MEANINGS:
+        entity.raw_property_list().append(prop)
+      else:
+        entity.property_list().append(prop)
+  return entity
+
+
+def _connect_to_secondary(connection, options):
+  """Connects to a random secondary member of a replica set.
+
+  Args:
+    connection: A pymongo Connection to the replica set's primary.
+    options: Keyword arguments for the new Connection.
+
+  Returns:
+    A pymongo Connection or None if no secondary is available.
+  """
+  status = connection.admin.command('ismaster')
+  hosts = [h for h in status.get('hosts', []) if h != status.get('primary')]
+  if not hosts:
+    logging.warning('No replica set secondary found, reading from primary.')
+    return None
+  host, port = random.choice(hosts).rsplit(':', 1)
+  options = dict(options, slave_okay=True)
+  options.pop('replicaset', None)
+  return Connection(host, int(port), **options)
+
+
+def _eventually_consistent(request):
+  """Returns whether a Get or Query request accepts eventual consistency."""
+
+  if request.has_strong():
+    return not request.strong()
+  return request.has_failover_ms() and request.failover_ms() < 0
+
+
+class _Transaction(object):
+  """Holds the state of a single transaction.
+
+  A transaction is bound to the entity group of the first key it touches. The
+  version of that entity group is remembered and checked again on commit.
+  """
+
+  def __init__(self, app, handle):
+    self.app = app
+    self.handle = handle
+    self.entity_group = None
+    self.version = None
+    self.writes = {}
+    self.deletes = set()
+    self.actions = []
+
 
 class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
   """Persistent stub for the Python datastore API, using MongoDB to persist.
@@ -71,7 +510,14 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
                app_id,
                datastore_file=None,
                require_indexes=False,
-               service_name='datastore_v3'):
+               service_name='datastore_v3',
+               root_path=None,
+               uri=None,
+               pool_size=10,
+               network_timeout=None,
+               replica_set=None,
+               write_concern=None,
+               read_preference='primary'):
     """Constructor.
 
     Initializes the datastore stub.
@@ -82,6 +528,17 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       require_indexes: bool, default False.  If True, composite indexes must
           exist in index.yaml for queries that need them.
       service_name: Service name expected for all calls.
+      root_path: The app's root directory. If given, secondary indexes are
+          ensured for all composite indexes defined in its index.yaml.
+      uri: MongoDB host or connection URI, defaults to localhost.
+      pool_size: Maximum number of pooled sockets per connection.
+      network_timeout: Socket timeout in seconds or None.
+      replica_set: Name of the replica set to connect to.
+      write_concern: Number of servers which must acknowledge a write. If
+          None, writes are not acknowledged.
+      read_preference: 'primary' or 'secondary'. With 'secondary',
+          non-transactional queries and gets with eventual consistency are
+          served by a secondary member of the replica set.
     """
     super(DatastoreMongoStub, self).__init__(service_name)
 
@@ -90,31 +547,56 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     self.__require_indexes = require_indexes
     self.__trusted = True
 
-    # TODO should be a way to configure the connection
-    self.__db = Connection()[app_id]
+    if read_preference not in _READ_PREFERENCES:
+      raise ValueError('Unknown read preference %r' % read_preference)
+
+    options = {'max_pool_size': pool_size, 'network_timeout': network_timeout}
+    if replica_set:
+      options['replicaset'] = replica_set
+    if write_concern:
+      options['safe'] = True
+      options['w'] = write_concern
+
+    connection = Connection(uri, **options)
+    self.__db = connection[app_id]
+    self.__secondary_db = self.__db
+    if read_preference == 'secondary':
+      secondary = _connect_to_secondary(connection, options)
+      if secondary is not None:
+        self.__secondary_db = secondary[app_id]
 
     # NOTE our query history gets reset each time the server restarts...
     # should this be fixed?
-    self.__query_history = {}
+    self.__query_history = typhoonae.lrucache.LRUCache(_MAX_QUERY_HISTORY)
 
     self.__next_index_id = 1
     self.__indexes = {}
     self.__index_lock = threading.Lock()
 
+    # Composite index definitions from index.yaml by kind and the secondary
+    # indexes we already ensured by (collection, spec).
+    self.__composite_indexes = {}
+    self.__ensured_indexes = set()
+    self.__explained_queries = set()
+    if root_path:
+      self.__load_index_yaml(root_path)
+
     self.__cursor_lock = threading.Lock()
     self.__next_cursor = 1
-    self.__queries = {}
+    self.__queries = typhoonae.lrucache.LRUCache(
+        _MAX_CURSORS, ttl=_CURSOR_TTL, on_evict=self.__close_cursor)
 
-    self.__id_lock = threading.Lock()
-    self.__id_map = {}
+    self.__id_allocator = typhoonae.idallocator.IdAllocator(
+        self.__reserve_ids)
 
     # Transaction support
     self.__next_tx_handle = 1
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
-    self.__tx_actions = []
+    self.__transactions = {}
     self.__tx_lock = threading.Lock()
 
+    # Runs the calls of asynchronous RPCs, see CreateRPC.
+    self.__rpc_pool = typhoonae.async_rpc.ThreadPool(pool_size)
+
   def Clear(self):
     """Clears the datastore.
 
@@ -123,14 +605,14 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     for name in self.__db.collection_names():
       if not name.startswith('system.'):
         self.__db.drop_collection(name)
-    self.__queries = {}
-    self.__query_history = {}
+    self.__queries.clear()
+    self.__query_history.clear()
     self.__indexes = {}
-    self.__id_map = {}
+    self.__ensured_indexes = set()
+    self.__explained_queries = set()
+    self.__id_allocator.clear()
     self.__next_tx_handle = 1
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
-    self.__tx_actions = []
+    self.__transactions = {}
 
     self.__db.datastore.drop()
 
@@ -147,6 +629,10 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
 
     self.AssertPbIsInitialized(response)
 
+  def CreateRPC(self):
+    """Returns an RPC which runs its call in a worker thread."""
+    return typhoonae.async_rpc.AsyncRPC(self.__rpc_pool, stub=self)
+
   def AssertPbIsInitialized(self, pb):
     """Raises an exception if the given PB is not initialized and valid."""
     explanation = []
@@ -154,10 +640,71 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     pb.Encode()
 
   def QueryHistory(self):
-    """Returns a dict that maps Query PBs to times they've been run."""
+    """Returns a dict that maps Query PBs to times they've been run.
+
+    Queries are aggregated by shape, so the returned PB is the first query
+    seen for its shape.
+    """
 
-    return dict((pb, times) for pb, times in self.__query_history.items()
-                if pb.app() == self.__app_id)
+    return dict((pb, times) for unused_shape, (pb, times)
+                in self.__query_history.items() if pb.app() == self.__app_id)
+
+  def TopQueries(self, count=10):
+    """Returns the most frequently run query shapes.
+
+    Useful for finding out which indexes are worth defining.
+
+    Args:
+      count: Maximum number of query shapes to return.
+
+    Returns:
+      A list of (times, description) tuples, most frequent first.
+    """
+    history = [(times, self.__describe_query_shape(shape))
+               for shape, (pb, times) in self.__query_history.items()
+               if pb.app() == self.__app_id]
+    history.sort(reverse=True)
+    return history[:count]
+
+  @staticmethod
+  def __query_shape(query):
+    """Returns a hashable shape of a query which ignores filter values."""
+
+    filters = sorted((f.property(0).name(), f.op())
+                     for f in query.filter_list())
+    orders = tuple((o.property(), o.direction()) for o in query.order_list())
+    return (query.app(), query.name_space(), query.kind(),
+            query.has_ancestor(), query.keys_only(), tuple(filters), orders)
+
+  @staticmethod
+  def __describe_query_shape(shape):
+    """Returns a GQL-like description of a query shape."""
+
+    app, name_space, kind, ancestor, keys_only, filters, orders = shape
+    conditions = ['%s %s ?' % (name, _OPERATORS.get(op, op))
+                  for name, op in filters]
+    if ancestor:
+      conditions.append('ANCESTOR IS ?')
+    description = 'SELECT %s FROM %s' % (keys_only and '__key__' or '*',
+                                         kind or '*')
+    if name_space:
+      description += ' (namespace %s)' % name_space
+    if conditions:
+      description += ' WHERE ' + ' AND '.join(conditions)
+    if orders:
+      description += ' ORDER BY ' + ', '.join(
+          '%s%s' % (name, direction == datastore_pb.Query_Order.DESCENDING
+                    and ' DESC' or '')
+          for name, direction in orders)
+    return description
+
+  @staticmethod
+  def __close_cursor(unused_index, cursor):
+    """Closes an evicted pymongo cursor."""
+
+    close = getattr(cursor, 'close', None)
+    if close:
+      close()
 
   def __collection_for_key(self, key):
     collection = key.path().element(-1).type()
@@ -166,149 +713,27 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     return collection
 
   def __id_for_key(self, key):
-    db_path = []
-    def add_element_to_db_path(elem):
-      db_path.append(elem.type())
-      if elem.has_name():
-        db_path.append(elem.name())
-      else:
-        db_path.append("\t" + str(elem.id()).zfill(10))
-    for elem in key.path().element_list():
-      add_element_to_db_path(elem)
-    return "\10".join(db_path)
-
-  def __key_for_id(self, id):
-    def from_db(value):
-      if value.startswith("\t"):
-        return int(value[1:])
-      return value
-    return datastore_types.Key.from_path(*[from_db(a) for a in id.split("\10")])
-
-  def __create_mongo_value_for_value(self, value):
-    if isinstance(value, datastore_types.Rating):
-      return {
-        'class': 'rating',
-        'rating': int(value),
-        }
-    if isinstance(value, datastore_types.Category):
-      return {
-        'class': 'category',
-        'category': str(value),
-        }
-    if isinstance(value, datastore_types.Key):
-      return {
-        'class': 'key',
-        'path': self.__id_for_key(value._ToPb()),
-        }
-    if isinstance(value, types.ListType):
-      list_for_db = [self.__create_mongo_value_for_value(v) for v in value]
-      sorted_list = sorted(value)
-      return {
-        'class': 'list',
-        'list': list_for_db,
-        'ascending_sort_key': self.__create_mongo_value_for_value(
-          sorted_list[0]),
-        'descending_sort_key': self.__create_mongo_value_for_value(
-          sorted_list[-1]),
-        }
-    if isinstance(value, users.User):
-      return {
-        'class': 'user',
-        'email': value.email(),
-        }
-    if isinstance(value, datastore_types.Text):
-      return {
-        'class': 'text',
-        'string': unicode(value),
-        }
-    if isinstance(value, datastore_types.Blob):
-      return Binary(value)
-    if isinstance(value, datastore_types.ByteString):
-      return {
-        'class': 'bytes',
-        'value': Binary(value)
-        }
-    if isinstance(value, datastore_types.IM):
-      return {
-        'class': 'im',
-        'protocol': value.protocol,
-        'address': value.address,
-        }
-    if isinstance(value, datastore_types.GeoPt):
-      return {
-        'class': 'geopt',
-        'lat': value.lat,
-        'lon': value.lon,
-        }
-    if isinstance(value, datastore_types.Email):
-      return {
-        'class': 'email',
-        'value': value,
-        }
-    if isinstance(value, datastore_types.BlobKey):
-      return {
-        'class': 'blobkey',
-        'value': str(value),
-        }
-    return value
-
-  def __create_value_for_mongo_value(self, mongo_value):
-    if isinstance(mongo_value, Binary):
-      return datastore_types.Blob(str(mongo_value))
-    if isinstance(mongo_value, types.DictType):
-      if mongo_value['class'] == 'rating':
-        return datastore_types.Rating(int(mongo_value["rating"]))
-      if mongo_value['class'] == 'category':
-        return datastore_types.Category(mongo_value["category"])
-      if mongo_value['class'] == 'key':
-        return self.__key_for_id(mongo_value['path'])
-      if mongo_value['class'] == 'list':
-        return [self.__create_value_for_mongo_value(v)
-                for v in mongo_value['list']]
-      if mongo_value['class'] == 'user':
-        return users.User(email=mongo_value["email"])
-      if mongo_value['class'] == 'text':
-        return datastore_types.Text(mongo_value['string'])
-      if mongo_value['class'] == 'im':
-        return datastore_types.IM(mongo_value['protocol'],
-                                  mongo_value['address'])
-      if mongo_value['class'] == 'geopt':
-        return datastore_types.GeoPt(mongo_value['lat'], mongo_value['lon'])
-      if mongo_value['class'] == 'email':
-        return datastore_types.Email(mongo_value['value'])
-      if mongo_value['class'] == 'bytes':
-        return datastore_types.ByteString(mongo_value['value'])
-      if mongo_value['class'] == 'blobkey':
-        return datastore_types.BlobKey(mongo_value['value'])
-    return mongo_value
-
-  def __mongo_document_for_entity(self, entity):
-    document = {}
-    document["_id"] = self.__id_for_key(entity.key())
-
-    entity = datastore.Entity._FromPb(entity)
-    for (k, v) in entity.iteritems():
-      v = self.__create_mongo_value_for_value(v)
-      document[k] = v
-
-    return document
-
-  def __entity_for_mongo_document(self, document):
-    key = self.__key_for_id(document.get('_id'))
-    entity = datastore.Entity(
-      kind=key.kind(), parent=key.parent(), name=key.name())
-
-    for k in document.keys():
-      if k != '_id':
-        v = self.__create_value_for_mongo_value(document[k])
-        entity[k] = v
-
-    pb = entity._ToPb()
-    # no decent way to initialize an Entity w/ an existing key...
-    if not key.name():
-      pb.key().path().element_list()[-1].set_id(key.id())
-
-    return pb
+    return _mongo_id_for_path(key.path().element_list())
+
+  def __reserve_ids(self, kind, size):
+    """Atomically reserves a block of IDs in the shared counter of a kind.
+
+    Args:
+      kind: A kind.
+      size: Number of IDs to reserve.
+
+    Returns:
+      The first reserved ID.
+    """
+    result = self.__db.datastore.find_and_modify(
+        query={'_id': 'IdSeq_%s' % kind},
+        update={'$inc': {'next_id': size}},
+        upsert=True, new=True)
+    first = int(result['next_id']) - size
+    if first < 1:
+      # The counter was just created, IDs start at 1.
+      return self.__reserve_ids(kind, size)
+    return first
 
   def __allocate_ids(self, kind, size=None, max=None):
     """Allocates IDs.
@@ -321,41 +746,28 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     Returns:
       Integer as the beginning of a range of size IDs.
     """
-    self.__id_lock.acquire()
-    ret = None
+    if size is not None:
+      return self.__id_allocator.allocate(kind, size)
+
+    # Unused IDs of this process' block may not exceed max.
+    self.__id_allocator.discard(kind)
     col = self.__db.datastore
     _id = 'IdSeq_%s' % kind
-    if not col.find_one({'_id': _id}):
-      col.insert({'_id': _id, 'next_id': 1})
-    if size is not None:
-      assert size > 0
-      next_id, block_size = self.__id_map.get(kind, (0, 0))
-      if not block_size:
-        block_size = (size / 1000 + 1) * 1000
-        result = self.__db.command(
-          "findandmodify",
-          "datastore",
-          query={"_id": _id},
-          update={"$inc": {"next_id": next_id+block_size}})
-        next_id = int(result['value']['next_id'])
-      if size > block_size:
-        result = self.__db.command(
-          "findandmodify",
-          "datastore",
-          query={"_id": _id},
-          update={"$inc": {"next_id": size}})
-        ret = int(result['value']['next_id'])
-      else:
-        ret = next_id;
-        next_id += size
-        block_size -= size
-        self.__id_map[kind] = (next_id, block_size)
-    else:
-      ret = col.find_one({'_id': _id}).get('next_id')
-      if max and max >= ret:
-        col.update({'_id': _id}, {'$set': {'next_id': max+1}})
-    self.__id_lock.release()
-    return ret
+    while True:
+      doc = col.find_one({'_id': _id})
+      if doc is None:
+        try:
+          col.insert({'_id': _id, 'next_id': (max or 0) + 1}, safe=True)
+        except pymongo.errors.DuplicateKeyError:
+          continue
+        return 1
+      ret = int(doc['next_id'])
+      if not max or max < ret:
+        return ret
+      # Only advances the counter if no other process changed it meanwhile.
+      if col.find_and_modify(query={'_id': _id, 'next_id': doc['next_id']},
+                             update={'$set': {'next_id': max + 1}}):
+        return ret
 
   def __ValidateAppId(self, app_id):
     """Verify that this is the stub for app_id.
@@ -402,6 +814,129 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
             'each key path element should have id or name but not both: %r'
             % key)
 
+  def __GetTransaction(self, tx):
+    """Returns the state of a running transaction.
+
+    Args:
+      tx: datastore_pb.Transaction
+
+    Raises:
+      apiproxy_errors.ApplicationError: if the transaction doesn't exist.
+    """
+    self.__ValidateTransaction(tx)
+    try:
+      return self.__transactions[tx.handle()]
+    except KeyError:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Transaction %d not found' % tx.handle())
+
+  def __entity_group_for_key(self, key):
+    """Returns the id of the version document for a key's entity group."""
+
+    root = entity_pb.Reference()
+    root.mutable_path().add_element().CopyFrom(key.path().element(0))
+    return (_ENTITY_GROUP_PREFIX + key.name_space() + _NAMESPACE_CONCAT_STR +
+            self.__id_for_key(root))
+
+  def __entity_group_version(self, entity_group):
+    """Reads the current version of an entity group.
+
+    Waits while the entity group is locked, so that a transaction never pairs
+    a version with entities a writer has not finished writing.
+    """
+    while True:
+      document = self.__db.datastore.find_one({'_id': entity_group})
+      if document is None:
+        return 0
+      if document.get('locked_until', 0) < time.time():
+        return document['version']
+      time.sleep(_ENTITY_GROUP_LOCK_WAIT)
+
+  def __lock_entity_group(self, entity_group, version=None):
+    """Locks an entity group for writing.
+
+    Writers lock an entity group, write its entities and unlock it, which
+    increments the version. Locks are broken after
+    _ENTITY_GROUP_LOCK_TIMEOUT seconds.
+
+    Args:
+      entity_group: The id of the entity group version document.
+      version: The version read when the transaction started. If None, waits
+        until the entity group is unlocked instead of failing.
+
+    Returns:
+      A lock token, or None if the version changed or the entity group is
+      locked by another transaction.
+    """
+    col = self.__db.datastore
+    token = random.getrandbits(62)
+    while True:
+      now = time.time()
+      lock = {'$set': {'locked_until': now + _ENTITY_GROUP_LOCK_TIMEOUT,
+                       'lock': token}}
+      spec = {'_id': entity_group, 'locked_until': {'$not': {'$gte': now}}}
+      if version is not None:
+        spec['version'] = version
+      if col.update(spec, lock, safe=True).get('n') == 1:
+        return token
+      if not version and col.find_one({'_id': entity_group}) is None:
+        try:
+          col.insert({'_id': entity_group, 'version': 0,
+                      'locked_until': now + _ENTITY_GROUP_LOCK_TIMEOUT,
+                      'lock': token}, safe=True)
+          return token
+        except pymongo.errors.DuplicateKeyError:
+          pass
+      if version is not None:
+        return None
+      time.sleep(_ENTITY_GROUP_LOCK_WAIT)
+
+  def __unlock_entity_group(self, entity_group, token):
+    """Unlocks an entity group and increments its version."""
+
+    self.__db.datastore.update(
+        {'_id': entity_group, 'lock': token},
+        {'$inc': {'version': 1}, '$set': {'locked_until': 0},
+         '$unset': {'lock': 1}}, safe=True)
+
+  def __write_entity_groups(self, keys, write):
+    """Runs a non-transactional write while its entity groups are locked.
+
+    Transactions which read the entity groups before fail on commit, since
+    the write increments their versions.
+
+    Args:
+      keys: The keys written.
+      write: Callable writing the entities.
+    """
+    locks = []
+    try:
+      for entity_group in sorted(
+          set(self.__entity_group_for_key(k) for k in keys)):
+        locks.append(
+            (entity_group, self.__lock_entity_group(entity_group)))
+      write()
+    finally:
+      for entity_group, token in locks:
+        self.__unlock_entity_group(entity_group, token)
+
+  def __enlist_entity_group(self, tx, key):
+    """Binds a transaction to the entity group of the given key.
+
+    Raises:
+      apiproxy_errors.ApplicationError: if the transaction is already bound to
+        another entity group.
+    """
+    entity_group = self.__entity_group_for_key(key)
+    if tx.entity_group is None:
+      tx.entity_group = entity_group
+      tx.version = self.__entity_group_version(entity_group)
+    elif tx.entity_group != entity_group:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Cannot operate on different entity groups in a transaction.')
+
   def __PutEntities(self, entities):
     """Inserts or updates entities in the DB.
 
@@ -410,7 +945,7 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     """
     for entity in entities:
       collection = self.__collection_for_key(entity.key())
-      document = self.__mongo_document_for_entity(entity)
+      document = mongo_document_for_entity(entity)
       unused_id = self.__db[collection].save(document).decode('utf-8')
 
   def __DeleteEntities(self, keys):
@@ -430,6 +965,10 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
   def _Dynamic_Put(self, put_request, put_response):
     entities = put_request.entity_list()
 
+    tx = None
+    if put_request.transaction().handle():
+      tx = self.__GetTransaction(put_request.transaction())
+
     for entity in entities:
       self.__ValidateKey(entity.key())
 
@@ -450,39 +989,58 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
         assert (entity.has_entity_group() and
                 entity.entity_group().element_size() > 0)
 
-      if put_request.transaction().handle():
-        self.__tx_writes[entity.key()] = entity
-        self.__tx_deletes.discard(entity.key())
+      if tx:
+        self.__enlist_entity_group(tx, entity.key())
+        tx.writes[entity.key()] = entity
+        tx.deletes.discard(entity.key())
 
-    if not put_request.transaction().handle():
-      self.__PutEntities(entities)
+    if not tx:
+      self.__write_entity_groups([e.key() for e in entities],
+                                 lambda: self.__PutEntities(entities))
     put_response.key_list().extend([e.key() for e in entities])
 
   def _Dynamic_Get(self, get_request, get_response):
+    if get_request.has_transaction():
+      tx = self.__GetTransaction(get_request.transaction())
+      for key in get_request.key_list():
+        self.__enlist_entity_group(tx, key)
+      db = self.__db
+    elif _eventually_consistent(get_request):
+      db = self.__secondary_db
+    else:
+      db = self.__db
+
     for key in get_request.key_list():
       collection = self.__collection_for_key(key)
       _id = self.__id_for_key(key)
 
       group = get_response.add_entity()
-      document = self.__db[collection].find_one({"_id": _id})
+      document = db[collection].find_one({"_id": _id})
       if document is None:
         entity = None
       else:
-        entity = self.__entity_for_mongo_document(document)
+        entity = entity_for_mongo_document(
+            document, key.app(), key.name_space())
 
       if entity:
         group.mutable_entity().CopyFrom(entity)
 
   def _Dynamic_Delete(self, delete_request, delete_response):
     keys = delete_request.key_list()
+
+    tx = None
+    if delete_request.transaction().handle():
+      tx = self.__GetTransaction(delete_request.transaction())
+
     for key in keys:
       self.__ValidateAppId(key.app())
-      if delete_request.transaction().handle():
-        self.__tx_deletes.add(key)
-        self.__tx_writes.pop(key, None)
+      if tx:
+        self.__enlist_entity_group(tx, key)
+        tx.deletes.add(key)
+        tx.writes.pop(key, None)
 
-    if not delete_request.transaction().handle():
-      self.__DeleteEntities(delete_request.key_list())
+    if not tx:
+      self.__write_entity_groups(keys, lambda: self.__DeleteEntities(keys))
 
   def __special_props(self, value, direction):
     if isinstance(value, datastore_types.Category):
@@ -527,22 +1085,53 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
         mongo_ordering.append((key, value))
     return mongo_ordering
 
+  @staticmethod
+  def __implicit_orders(query):
+    """Returns the sort orders of unordered IN and != queries.
+
+    Like the merged results of the SDK, IN queries are sorted by key. !=
+    queries are sorted by their property first, like other inequality
+    filters.
+    """
+    orders = []
+    for filt in query.filter_list():
+      if filt.op() == typhoonae.multiquery.NOT_EQUAL and not orders:
+        order = datastore_pb.Query_Order()
+        order.set_property(filt.property(0).name())
+        orders.append(order)
+    if orders or [f for f in query.filter_list()
+                  if f.op() == datastore_pb.Query_Filter.IN]:
+      order = datastore_pb.Query_Order()
+      order.set_property('__key__')
+      orders.append(order)
+    return orders
+
   def __filter_suffix(self, value):
     if isinstance(value, types.ListType):
       return ".list"
     return ""
 
-  def __filter_binding(self, key, value, operation, prototype):
+  def __filter_binding(self, key, props, operation, prototype):
     if key in prototype:
       key += self.__filter_suffix(prototype[key])
 
     if key == "__key__":
       key = "_id"
-      value = self.__id_for_key(value._ToPb())
+      values = [_mongo_id_for_path(
+          prop.value().referencevalue().pathelement_list()) for prop in props]
     else:
-      value = self.__create_mongo_value_for_value(value)
-
-    if operation == "<":
+      values = [_mongo_value_for_property(prop) for prop in props]
+    value = values[0]
+
+    if operation == "IN":
+      return (key, {'$in': values})
+    elif operation == "!=":
+      if key.endswith(".list"):
+        # Matches lists with any other value, like the < and > queries the
+        # SDK would run.
+        return ('$or', [{key: {'$lt': value}}, {key: {'$gt': value}}])
+      return (key, {'$ne': value, '$exists': True})
+    elif operation == "<":
       return (key, {'$lt': value})
     elif operation == '<=':
       return (key, {'$lte': value})
@@ -555,6 +1144,128 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     raise apiproxy_errors.ApplicationError(
       datastore_pb.Error.BAD_REQUEST, "Can't handle operation %r." % operation)
 
+  def __ancestor_pattern(self, ancestor):
+    """Returns a regular expression matching an ancestor and its descendants.
+
+    The pattern is anchored and starts with the literal ancestor id, so that
+    MongoDB can turn it into a range scan on the _id index.
+    """
+    prefix = _REGEX_SPECIAL_CHARS.sub(r'\\\1', self.__id_for_key(ancestor))
+    return re.compile('^%s(?:%s|$)' % (prefix, _PATH_CONCAT_STR))
+
+  def __load_index_yaml(self, root_path):
+    """Reads composite index definitions from the app's index.yaml.
+
+    Args:
+      root_path: The app's root directory.
+    """
+    index_yaml_path = os.path.join(root_path, 'index.yaml')
+    if not os.path.isfile(index_yaml_path):
+      return
+
+    index_yaml = open(index_yaml_path, 'r')
+    try:
+      try:
+        definitions = datastore_index.ParseIndexDefinitions(index_yaml)
+      except yaml_errors.EventError, e:
+        logging.error('Error parsing %s:\n%s', index_yaml_path, e)
+        return
+    finally:
+      index_yaml.close()
+
+    if definitions is None or not definitions.indexes:
+      return
+
+    for index in datastore_index.IndexDefinitionsToProtos(
+        self.__app_id, definitions.indexes):
+      kind = index.definition().entity_type()
+      self.__composite_indexes.setdefault(kind, []).append(index)
+
+  def __mongo_field_for_property(self, name, prototype):
+    """Returns the document field which is filtered on for a property."""
+
+    if name == '__key__':
+      return '_id'
+    if name in prototype:
+      return name + self.__filter_suffix(prototype[name])
+    return name
+
+  def __ensure_index(self, collection, spec):
+    """Ensures that a secondary index exists on the given collection.
+
+    Each index is only ensured once per process.
+
+    Args:
+      collection: The name of the collection.
+      spec: A list of (field, direction) tuples.
+    """
+    if not spec or spec == [('_id', pymongo.ASCENDING)]:
+      return
+    index_key = (collection, tuple(spec))
+    if index_key in self.__ensured_indexes:
+      return
+    self.__index_lock.acquire()
+    try:
+      if index_key not in self.__ensured_indexes:
+        self.__db[collection].ensure_index(spec)
+        self.__ensured_indexes.add(index_key)
+    finally:
+      self.__index_lock.release()
+
+  def __ensure_indexes_for_query(self, collection, query, prototype):
+    """Ensures secondary indexes for a query's filters.
+
+    Creates a single-field index for every filtered property and compound
+    indexes for all composite indexes of the query's kind in index.yaml.
+
+    Args:
+      collection: The name of the collection.
+      query: A datastore_pb.Query instance.
+      prototype: A datastore.Entity holding the property types.
+    """
+    for filt in query.filter_list():
+      name = filt.property(0).name().decode('utf-8')
+      field = self.__mongo_field_for_property(name, prototype)
+      self.__ensure_index(collection, [(field, pymongo.ASCENDING)])
+
+    for index in self.__composite_indexes.get(query.kind(), []):
+      spec = []
+      for prop in index.definition().property_list():
+        name = prop.name().decode('utf-8')
+        if name in prototype and self.__unorderable(prototype[name]):
+          break
+        direction = pymongo.ASCENDING
+        if prop.direction() == datastore_pb.Query_Order.DESCENDING:
+          direction = pymongo.DESCENDING
+        spec.append(
+            (self.__mongo_field_for_property(name, prototype), direction))
+      else:
+        self.__ensure_index(collection, spec)
+
+  def __log_full_scan(self, collection, spec, order, cursor):
+    """Logs a warning if the query plan of a cursor is a collection scan.
+
+    Every distinct query shape is only explained once per process.
+    """
+    if not spec and not order:
+      return
+    shape = (collection, tuple(sorted(spec.keys())), tuple(order))
+    if shape in self.__explained_queries:
+      return
+    self.__explained_queries.add(shape)
+
+    try:
+      plan = cursor.explain()
+    except pymongo.errors.OperationFailure:
+      return
+
+    if (plan.get('cursor', '').startswith('BasicCursor') or
+        'COLLSCAN' in str(plan.get('queryPlanner', ''))):
+      logging.warning('Query on %s filtering on %s ordered by %s performs a '
+                      'full collection scan', collection,
+                      ', '.join(sorted(spec.keys())) or 'nothing',
+                      ', '.join(f for f, d in order) or 'nothing')
+
   def _MinimalQueryInfo(self, query):
     """Extract the minimal set of information for query matching.
 
@@ -624,12 +1335,25 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
 
     app = query.app()
 
+    if query.has_transaction() and query.has_ancestor():
+      self.__enlist_entity_group(
+          self.__GetTransaction(query.transaction()), query.ancestor())
+
+    # Ancestor queries are strongly consistent unless told otherwise.
+    if query.has_transaction():
+      db = self.__db
+    elif not query.has_ancestor() or _eventually_consistent(query):
+      db = self.__secondary_db
+    else:
+      db = self.__db
+
     query_result.mutable_cursor().set_cursor(0)
     query_result.set_more_results(False)
 
     if self.__require_indexes:
       (required, kind, ancestor, props, num_eq_filters) = (
-        datastore_index.CompositeIndexForQuery(query))
+        datastore_index.CompositeIndexForQuery(
+            typhoonae.multiquery.indexQuery(query)))
       if required:
         index = entity_pb.CompositeIndex()
         index.mutable_definition().set_entity_type(kind)
@@ -649,62 +1373,58 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     if query.has_name_space():
         collection = query.name_space() + _NAMESPACE_CONCAT_STR + collection
 
-    clone = datastore_pb.Query()
-    clone.CopyFrom(query)
-    clone.clear_hint()
-    if clone in self.__query_history:
-      self.__query_history[clone] += 1
+    shape = self.__query_shape(query)
+    entry = self.__query_history.get(shape)
+    if entry:
+      entry[1] += 1
     else:
-      self.__query_history[clone] = 1
+      clone = datastore_pb.Query()
+      clone.CopyFrom(query)
+      clone.clear_hint()
+      self.__query_history.put(shape, [clone, 1])
 
     # HACK we need to get one Entity from this collection so we know what the
     # property types are (because we need to construct queries that depend on
     # the types of the properties)...
     try:
-        prototype = self.__db[collection].find_one()
+        prototype = db[collection].find_one()
     except pymongo.errors.InvalidName:
         raise datastore_errors.BadRequestError('query without kind')
     if prototype is None:
       return
     prototype = datastore.Entity._FromPb(
-      self.__entity_for_mongo_document(prototype))
+      entity_for_mongo_document(prototype, app, query.name_space()))
 
     spec = {}
 
     if query.has_ancestor():
-      spec["_id"] = re.compile("^%s.*$" % self.__id_for_key(query.ancestor()))
-
-    operators = {datastore_pb.Query_Filter.LESS_THAN:             '<',
-                 datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
-                 datastore_pb.Query_Filter.GREATER_THAN:          '>',
-                 datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
-                 datastore_pb.Query_Filter.EQUAL:                 '==',
-                 }
+      spec["_id"] = self.__ancestor_pattern(query.ancestor())
 
     for filt in query.filter_list():
-      assert filt.op() != datastore_pb.Query_Filter.IN
-
       prop = filt.property(0).name().decode('utf-8')
-      op = operators[filt.op()]
-
-      filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-                         for filter_prop in filt.property_list()]
+      op = _OPERATORS[filt.op()]
 
       (key, value) = self.__filter_binding(prop,
-                                           filter_val_list[0],
+                                           filt.property_list(),
                                            op,
                                            prototype)
 
       if key in spec:
+        if key == '$or' or (isinstance(spec[key], types.DictType) and
+                            isinstance(value, types.DictType) and
+                            '$in' in spec[key] and '$in' in value):
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST,
+              "Only one IN or != filter per property is supported.")
         if (not isinstance(spec[key], types.DictType)
             and not isinstance(value, types.DictType)):
           if spec[key] != value:
             return
         elif not isinstance(spec[key], types.DictType):
-          value["$in"] = [spec[key]]
+          value['$in' in value and '$all' or '$in'] = [spec[key]]
           spec[key] = value
         elif not isinstance(value, types.DictType):
-          spec[key]["$in"] = [value]
+          spec[key]['$in' in spec[key] and '$all' or '$in'] = [value]
         else:
           spec[key].update(value)
       else:
@@ -716,14 +1436,23 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       offset, query_pb, unused_spec, incl = self._DecodeCompiledCursor(
         query.compiled_cursor())
 
-    cursor = self.__db[collection].find(spec)
+    self.__ensure_indexes_for_query(collection, query, prototype)
+
+    # Keys-only queries skip reading and converting the other fields.
+    if query.keys_only():
+      cursor = db[collection].find(spec, fields=['_id'])
+    else:
+      cursor = db[collection].find(spec)
 
-    order = self.__translate_order_for_mongo(query.order_list(), prototype)
+    order = self.__translate_order_for_mongo(
+        query.order_list() or self.__implicit_orders(query), prototype)
     if order is None:
       return
     if order:
       cursor = cursor.sort(order)
 
+    self.__log_full_scan(collection, spec, order, cursor)
+
     if query.offset() == datastore._MAX_INT_32:
       query.set_offset(0)
       query.set_limit(datastore._MAX_INT_32)
@@ -739,7 +1468,7 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     cursor_index = self.__next_cursor
     self.__next_cursor += 1
     self.__cursor_lock.release()
-    self.__queries[cursor_index] = cursor
+    self.__queries.put(cursor_index, cursor)
 
     # Cursor magic
     compiled_cursor = query_result.mutable_compiled_cursor()
@@ -751,12 +1480,14 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       start_key = _CURSOR_CONCAT_STR.join((
         str(len(results) + offset),
         query_info.Encode(),
-        self.__entity_for_mongo_document(results[-1]).Encode()
+        entity_for_mongo_document(
+            results[-1], app, query.name_space()).Encode()
       ))
       # Populate query result
       result_list = query_result.result_list()
       for doc in results:
-        result_list.append(self.__entity_for_mongo_document(doc))
+        result_list.append(
+            entity_for_mongo_document(doc, app, query.name_space()))
       query_result.set_skipped_results(len(results))
       position.set_start_key(str(start_key))
       position.set_start_inclusive(False)
@@ -772,9 +1503,7 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     if cursor == 0: # we exited early from the query w/ no results...
       return
 
-    try:
-      cursor = self.__queries[cursor]
-    except KeyError:
+    if self.__queries.get(cursor) is None:
       raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                              'Cursor %d not found' % cursor)
 
@@ -784,14 +1513,16 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
     self.__ValidateAppId(request.app())
 
     self.__tx_lock.acquire()
-    handle = self.__next_tx_handle
-    self.__next_tx_handle += 1
+    try:
+      handle = self.__next_tx_handle
+      self.__next_tx_handle += 1
+      self.__transactions[handle] = _Transaction(request.app(), handle)
+    finally:
+      self.__tx_lock.release()
 
     transaction.set_app(request.app())
     transaction.set_handle(handle)
 
-    self.__tx_actions = []
-
   def _Dynamic_AddActions(self, request, _):
     """Associates the creation of one or more tasks with a transaction.
 
@@ -799,7 +1530,12 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       request: A taskqueue_service_pb.TaskQueueBulkAddRequest containing the
           tasks that should be created when the transaction is comitted.
     """
-    if ((len(self.__tx_actions) + request.add_request_size()) >
+    if not request.add_request_size():
+      return
+
+    tx = self.__GetTransaction(request.add_request(0).transaction())
+
+    if ((len(tx.actions) + request.add_request_size()) >
         _MAX_ACTIONS_PER_TXN):
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST,
@@ -813,39 +1549,83 @@ class DatastoreMongoStub(apiproxy_stub.APIProxyStub):
       clone.clear_transaction()
       new_actions.append(clone)
 
-    self.__tx_actions.extend(new_actions)
+    tx.actions.extend(new_actions)
 
   def _Dynamic_Commit(self, transaction, transaction_response):
-    self.__ValidateTransaction(transaction)
+    tx = self.__GetTransaction(transaction)
 
+    self.__tx_lock.acquire()
     try:
-      self.__PutEntities(self.__tx_writes.values())
-      self.__DeleteEntities(self.__tx_deletes)
-      for action in self.__tx_actions:
-        try:
-          apiproxy_stub_map.MakeSyncCall(
-              'taskqueue', 'Add', action, api_base_pb.VoidProto())
-        except apiproxy_errors.ApplicationError, e:
-          logging.warning('Transactional task %s has been dropped, %s',
-                          action, e)
-          pass
+      del self.__transactions[tx.handle]
     finally:
-      self.__tx_writes = {}
-      self.__tx_deletes = set()
-      self.__tx_actions = []
       self.__tx_lock.release()
 
+    if tx.entity_group is not None and (tx.writes or tx.deletes):
+      token = self.__lock_entity_group(tx.entity_group, tx.version)
+      if token is None:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.CONCURRENT_TRANSACTION,
+            'Concurrency exception.')
+      try:
+        self.__PutEntities(tx.writes.values())
+        self.__DeleteEntities(tx.deletes)
+      finally:
+        self.__unlock_entity_group(tx.entity_group, token)
+    for action in tx.actions:
+      try:
+        apiproxy_stub_map.MakeSyncCall(
+            'taskqueue', 'Add', action, api_base_pb.VoidProto())
+      except apiproxy_errors.ApplicationError, e:
+        logging.warning('Transactional task %s has been dropped, %s',
+                        action, e)
+
   def _Dynamic_Rollback(self, transaction, transaction_response):
-    self.__ValidateTransaction(transaction)
+    tx = self.__GetTransaction(transaction)
+
+    self.__tx_lock.acquire()
+    try:
+      del self.__transactions[tx.handle]
+    finally:
+      self.__tx_lock.release()
 
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
-    self.__tx_actions = []
-    self.__tx_lock.release()
+  def __kind_collections(self):
+    """Returns (namespace, kind) tuples of the collections holding entities.
 
-  def _Dynamic_GetSchema(self, app_str, schema):
-    # TODO this is used for the admin viewer to introspect.
-    pass
+    Namespaces and kinds may both contain the separator, but any split names
+    the same collection again.
+    """
+    for name in self.__db.collection_names():
+      if name.startswith('system.') or name == 'datastore':
+        continue
+      name_space, sep, kind = name.partition(_NAMESPACE_CONCAT_STR)
+      if not sep:
+        name_space, kind = '', name
+      yield name_space.encode('utf-8'), kind.encode('utf-8')
+
+  def Namespaces(self):
+    """Returns the namespaces which hold entities, always including ''."""
+
+    return sorted(set(
+        [''] + [name_space for name_space, _ in self.__kind_collections()]))
+
+  def _Dynamic_GetSchema(self, req, schema):
+    """Reports the kinds of a namespace, without their properties."""
+
+    name_space = ''
+    if hasattr(req, 'name_space'):
+      name_space = req.name_space()
+    kinds = sorted(kind for ns, kind in self.__kind_collections()
+                   if ns == name_space)
+    for kind in kinds:
+      if ((req.has_start_kind() and kind < req.start_kind()) or
+          (req.has_end_kind() and kind > req.end_kind())):
+        continue
+      kind_pb = schema.add_kind()
+      kind_pb.mutable_key().set_app(req.app())
+      if name_space:
+        kind_pb.mutable_key().set_name_space(name_space)
+      kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
+      kind_pb.mutable_entity_group()
 
   def __collection_and_spec_for_index(self, index):
     def translate_name(ae_name):
@@ -25,6 +25,7 @@ from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.api import datastore_admin
 from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
 from google.appengine.runtime import apiproxy_errors
@@ -32,11 +33,27 @@ from nose.plugins.skip import SkipTest
 
 import datetime
 import os
+import pymongo
 import time
 import typhoonae.mongodb.datastore_mongo_stub
+import typhoonae.multiquery
 import unittest
 
 
+def putEntities(count, queue):
+    """Puts entities with a stub of its own and reports the allocated IDs."""
+
+    stub = typhoonae.mongodb.datastore_mongo_stub.DatastoreMongoStub(
+        'test', '')
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    ids = [datastore.Put(datastore.Entity('Counter')).id()
+           for i in xrange(count)]
+    start, end = db.allocate_ids(db.Key.from_path('Counter', 1), 10)
+    ids.extend(xrange(start, end + 1))
+    queue.put(ids)
+
+
 class TaskQueueServiceStubMock(apiproxy_stub.APIProxyStub):
     """Task queue service stub for testing purposes."""
 
@@ -88,6 +105,7 @@ class DatastoreMongoTestCaseBase(unittest.TestCase):
                                '(%s)' % e)
 
         self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        typhoonae.multiquery.install()
 
         apiproxy_stub_map.apiproxy.RegisterStub(
             'taskqueue', TaskQueueServiceStubMock())
@@ -222,6 +240,47 @@ class DatastoreMongoTestCase(DatastoreMongoTestCaseBase):
         history = self.stub.QueryHistory()
         assert history.keys().pop().kind() == 'TestModel'
 
+    def testTopQueries(self):
+        """Aggregates the query history by query shape."""
+
+        class TestModel(db.Model):
+            number = db.IntegerProperty()
+
+        for i in xrange(3):
+            TestModel(number=i).put()
+
+        for i in xrange(3):
+            TestModel.all().filter('number =', i).get()
+        TestModel.all().order('-number').get()
+
+        self.assertEqual(2, len(self.stub.QueryHistory()))
+        self.assertEqual(
+            [(3, 'SELECT * FROM TestModel WHERE number == ?'),
+             (1, 'SELECT * FROM TestModel ORDER BY number DESC')],
+            self.stub.TopQueries())
+
+    def testReadPreference(self):
+        """Reads from the primary if there is no secondary."""
+
+        stub = typhoonae.mongodb.datastore_mongo_stub
+
+        self.assertRaises(ValueError, stub.DatastoreMongoStub, 'test',
+                          read_preference='nearest')
+
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub(
+            'datastore_v3',
+            stub.DatastoreMongoStub('test', write_concern=1,
+                                    read_preference='secondary'))
+
+        class TestModel(db.Model):
+            number = db.IntegerProperty()
+
+        key = TestModel(number=1).put()
+        config = db.create_config(read_policy=db.EVENTUAL_CONSISTENCY)
+        self.assertEqual(1, TestModel.get(key, config=config).number)
+        self.assertEqual(1, TestModel.all().filter('number =', 1).count())
+
     def testGetPutMultiTypes(self):
         """Sets and Gets models with different entity groups."""
 
@@ -421,6 +480,66 @@ class DatastoreMongoTestCase(DatastoreMongoTestCaseBase):
         self.assertEqual(1, Author.all().count())
         self.assertEqual(0, Book.all().count())
 
+    def testConcurrentTransactions(self):
+        """Conflicting transactions on the same entity group must fail."""
+
+        class Counter(db.Model):
+            count = db.IntegerProperty()
+
+        first = Counter(key_name='first', count=0).put()
+        second = Counter(key_name='second', count=0).put()
+
+        def call(method, request, response):
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', method, request, response)
+            return response
+
+        def begin():
+            request = datastore_pb.BeginTransactionRequest()
+            request.set_app('test')
+            return call('BeginTransaction', request, datastore_pb.Transaction())
+
+        def increment(tx, key):
+            request = datastore_pb.GetRequest()
+            request.add_key().CopyFrom(key._ToPb())
+            request.mutable_transaction().CopyFrom(tx)
+            entity = datastore.Entity._FromPb(
+                call('Get', request, datastore_pb.GetResponse())
+                .entity(0).entity())
+            entity['count'] += 1
+            request = datastore_pb.PutRequest()
+            request.add_entity().CopyFrom(entity._ToPb())
+            request.mutable_transaction().CopyFrom(tx)
+            call('Put', request, datastore_pb.PutResponse())
+
+        def commit(tx):
+            call('Commit', tx, datastore_pb.CommitResponse())
+
+        tx1, tx2, tx3 = begin(), begin(), begin()
+        increment(tx1, first)
+        increment(tx2, first)
+        increment(tx3, second)
+
+        commit(tx1)
+        try:
+            commit(tx2)
+        except apiproxy_errors.ApplicationError, e:
+            self.assertEqual(
+                datastore_pb.Error.CONCURRENT_TRANSACTION, e.application_error)
+        else:
+            self.fail("Conflicting transaction was committed")
+        commit(tx3)
+
+        self.assertEqual(1, Counter.get(first).count)
+        self.assertEqual(1, Counter.get(second).count)
+
+        # A non-transactional put invalidates transactions which read before.
+        tx4 = begin()
+        increment(tx4, first)
+        Counter(key_name='first', count=10).put()
+        self.assertRaises(apiproxy_errors.ApplicationError, commit, tx4)
+        self.assertEqual(10, Counter.get(first).count)
+
     def testKindlessAncestorQueries(self):
         """Perform kindless queries for entities with a given ancestor."""
 
@@ -447,6 +566,45 @@ class DatastoreMongoTestCase(DatastoreMongoTestCaseBase):
 
         self.assertEqual(0, query.count())
 
+    def testAncestorQueries(self):
+        """Ancestor queries must not match siblings sharing a key prefix."""
+
+        class Author(db.Model):
+            name = db.StringProperty()
+
+        class Book(db.Model):
+            title = db.StringProperty()
+
+        mark = Author(name='Mark', key_name='mark').put()
+        marktwain = Author(name='Mark Twain', key_name='marktwain').put()
+
+        Book(parent=mark, title="Some Book").put()
+        Book(parent=marktwain, title="The Adventures Of Tom Sawyer").put()
+
+        self.assertEqual(
+            ["The Adventures Of Tom Sawyer"],
+            [b.title for b in Book.all().ancestor(marktwain)])
+        self.assertEqual(
+            ["Some Book"], [b.title for b in Book.all().ancestor(mark)])
+
+    def testAutomaticIndexes(self):
+        """Ensures secondary indexes for filtered properties."""
+
+        class Novel(db.Model):
+            title = db.StringProperty()
+            tags = db.StringListProperty()
+
+        Novel(title='Ulysses', tags=['modernism', 'stream']).put()
+
+        self.assertEqual(
+            'Ulysses', Novel.all().filter('title =', 'Ulysses').get().title)
+        self.assertEqual(
+            'Ulysses', Novel.all().filter('tags =', 'stream').get().title)
+
+        info = pymongo.Connection()['test']['Novel'].index_information()
+        self.assertTrue('title_1' in info)
+        self.assertTrue('tags.list_1' in info)
+
     def testRunQuery(self):
         """Runs some simple queries."""
 
@@ -1023,8 +1181,109 @@ class DatastoreMongoTestCase(DatastoreMongoTestCaseBase):
         self.assertEqual(1000, query.count())
 
         start, end = db.allocate_ids(key, 2000)
-        self.assertEqual(start, 1001)
-        self.assertEqual(end, 3000)
+        self.assertTrue(start > key.id())
+        self.assertEqual(2000, end - start + 1)
+        self.assertFalse(start <= EmptyModel().put().id() <= end)
+
+    def testAllocateIdsInProcesses(self):
+        """Processes sharing the database never allocate the same IDs."""
+
+        import multiprocessing
+
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=putEntities, args=(200, queue))
+            for i in xrange(4)]
+        for process in processes:
+            process.start()
+        ids = [datastore.Put(datastore.Entity('Counter')).id()
+               for i in xrange(200)]
+        for process in processes:
+            ids.extend(queue.get())
+        for process in processes:
+            process.join()
+
+        self.assertEqual(5 * 200 + 4 * 10, len(set(ids)))
+
+    def testAsyncRPC(self):
+        """Runs asynchronous gets in worker threads."""
+
+        keys = [datastore.Put(datastore.Entity('Async', name='e%i' % i))
+                for i in xrange(10)]
+        rpcs = []
+        for key in keys:
+            request = datastore_pb.GetRequest()
+            request.add_key().CopyFrom(key._ToPb())
+            response = datastore_pb.GetResponse()
+            rpc = apiproxy_stub_map.UserRPC('datastore_v3')
+            rpc.make_call('Get', request, response)
+            rpcs.append((rpc, response))
+
+        names = []
+        for rpc, response in rpcs:
+            rpc.check_success()
+            entity = response.entity(0).entity()
+            names.append(entity.key().path().element_list()[-1].name())
+        self.assertEqual(['e%i' % i for i in xrange(10)], names)
+
+    def testMultiValueFilters(self):
+        """Runs IN and != queries as single queries."""
+
+        class Ware(db.Model):
+            price = db.IntegerProperty()
+
+        for i in xrange(10):
+            Ware(key_name='w%i' % i, price=i % 5).put()
+
+        def runs():
+            return sum(self.stub.QueryHistory().values())
+
+        before = runs()
+        query = Ware.all().filter('price IN', [3, 1]).order('-price')
+        self.assertEqual([3, 3, 1, 1], [ware.price for ware in query])
+        self.assertEqual(before + 1, runs())
+
+        before = runs()
+        query = Ware.all().filter('price IN', [4, 0])
+        self.assertEqual(['w0', 'w4', 'w5', 'w9'],
+                         [ware.key().name() for ware in query])
+        self.assertEqual(before + 1, runs())
+
+        before = runs()
+        query = Ware.all().filter('price !=', 2)
+        self.assertEqual([0, 0, 1, 1, 3, 3, 4, 4],
+                         [ware.price for ware in query])
+        self.assertEqual(before + 1, runs())
+        self.assertEqual(8, query.count())
+
+    def testKeysOnlyQueries(self):
+        """Returns keys without reading the stored entities."""
+
+        class Note(db.Model):
+            rank = db.IntegerProperty()
+
+        parent = Note(key_name='parent', rank=0).put()
+        keys = [Note(key_name='user:1', rank=1).put(),
+                Note(parent=parent, rank=2).put(),
+                Note(key_name='note', rank=3).put()]
+
+        query = Note.all(keys_only=True).filter('rank >', 0).order('rank')
+        self.assertEqual(keys, query.fetch(10))
+
+        query = datastore_pb.Query()
+        query.set_app('test')
+        query.set_kind('Note')
+        query.set_keys_only(True)
+        result = datastore_pb.QueryResult()
+        self.stub.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+        self.assertTrue(result.keys_only())
+        self.assertEqual(
+            sorted([parent] + keys),
+            sorted(datastore_types.Key._FromPb(entity.key())
+                   for entity in result.result_list()))
+        self.assertEqual(
+            [0] * 4, [entity.property_size() + entity.raw_property_size()
+                      for entity in result.result_list()])
 
     def testBatching(self):
         """Counts in batches with __key__ as offset."""
@@ -1135,3 +1394,51 @@ class DatastoreMongoTestCase(DatastoreMongoTestCaseBase):
 
         for index in self.indices:
             datastore_admin.UpdateIndex(index)
+
+
+class EntityConversionTestCase(unittest.TestCase):
+    """Tests converting entities to MongoDB documents and back."""
+
+    def setUp(self):
+        """Sets required environment variables."""
+
+        os.environ['APPLICATION_ID'] = 'test'
+        os.environ['AUTH_DOMAIN'] = 'mydomain.local'
+
+    def testRoundTrip(self):
+        """Converts entities with mixed property types without loss."""
+
+        stub = typhoonae.mongodb.datastore_mongo_stub
+
+        entity = datastore.Entity('Mixed', name='mixed')
+        entity.update({
+            'string': u'Ünïcode',
+            'integer': 42,
+            'long': 1L << 40,
+            'float': 1.5,
+            'boolean': True,
+            'none': None,
+            'datetime': datetime.datetime(2011, 1, 1, 12, 30, 15, 123000),
+            'rating': datastore_types.Rating(50),
+            'category': datastore_types.Category('fiction'),
+            'key': datastore_types.Key.from_path('Parent', 1, 'Child', 'c'),
+            'user': users.User('tester@mydomain.local'),
+            'text': datastore_types.Text(u'Long text'),
+            'blob': datastore_types.Blob('\x00\x01binary'),
+            'bytes': datastore_types.ByteString('bytes'),
+            'geopt': datastore_types.GeoPt(52.5, 13.4),
+            'email': datastore_types.Email('mail@mydomain.local'),
+            'blobkey': datastore_types.BlobKey('blobkey'),
+            'integers': [3, 1, 2],
+            'strings': [u'b', u'a'],
+        })
+        pb = entity._ToPb()
+
+        document = stub.mongo_document_for_entity(pb)
+        self.assertEqual(u'Mixed\x08mixed', document['_id'])
+        self.assertEqual(
+            {'class': 'list', 'list': [3, 1, 2],
+             'ascending_sort_key': 1, 'descending_sort_key': 3},
+            document['integers'])
+
+        self.assertEqual(pb, stub.entity_for_mongo_document(document, 'test'))
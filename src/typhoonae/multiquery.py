@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs IN and != queries as single Datastore queries.
+
+The SDK splits a query with an IN or != filter into one query per value, or
+a < and a > query, and merges their results in the client. Backends which
+support these filters natively get a single query instead: an IN filter with
+one property per value, or a filter with the NOT_EQUAL operator, which the
+datastore_pb protocol lacks.
+"""
+
+import copy
+import logging
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_query
+
+# Filter operator for != queries, the next free datastore_pb.Query_Filter op.
+NOT_EQUAL = 8
+
+_EQUALITY_OPERATORS = ('=', '==')
+
+
+def indexQuery(query):
+    """Returns a query requiring the same indexes as the given one.
+
+    The SDK's index functions only know the operators of the split queries,
+    so IN filters become equality filters and != filters inequality filters.
+
+    Args:
+        query: A datastore_pb.Query.
+
+    Returns:
+        A datastore_pb.Query, the given one if it has no such filters.
+    """
+    ops = set(f.op() for f in query.filter_list())
+    if not ops & set([datastore_pb.Query_Filter.IN, NOT_EQUAL]):
+        return query
+    clone = datastore_pb.Query()
+    clone.CopyFrom(query)
+    for filt in clone.filter_list():
+        if filt.op() == datastore_pb.Query_Filter.IN:
+            filt.set_op(datastore_pb.Query_Filter.EQUAL)
+            del filt.property_list()[1:]
+        elif filt.op() == NOT_EQUAL:
+            filt.set_op(datastore_pb.Query_Filter.GREATER_THAN)
+    return clone
+
+
+def normalizeFilters(query):
+    """Returns the query's filters and orders normalized for index lookup.
+
+    Like datastore_index.Normalize(), but keeps IN filters with several
+    values and != filters.
+    """
+    native, others = [], []
+    for filt in query.filter_list():
+        if filt.op() == NOT_EQUAL or (
+                filt.op() == datastore_pb.Query_Filter.IN and
+                filt.property_size() > 1):
+            native.append(filt)
+        else:
+            others.append(filt)
+    filters, orders = datastore_index.Normalize(others, query.order_list())
+    return filters + native, orders
+
+
+class MultiValueFilter(datastore_query.FilterPredicate):
+    """An IN or != filter on a single property."""
+
+    def __init__(self, name, op, values):
+        super(MultiValueFilter, self).__init__()
+        self._name = name
+        self._op = op
+        self._values = values
+
+    def _get_prop_names(self):
+        return set([self._name])
+
+    def _apply(self, value_map):
+        """Returns whether one of the entity's values passes the filter.
+
+        Args:
+            value_map: Maps property names to the comparable values of an
+                entity, as returned by PropertyValueToKeyValue().
+        """
+        values = [datastore_types.PropertyValueToKeyValue(
+                      datastore_types.ToPropertyPb(self._name, v).value())
+                  for v in self._values]
+        for value in value_map.get(self._name, []):
+            if self._op == NOT_EQUAL:
+                if value != values[0]:
+                    return True
+            elif value in values:
+                return True
+        return False
+
+    def _to_pbs(self):
+        filt = datastore_pb.Query_Filter()
+        filt.set_op(self._op)
+        for value in self._values:
+            filt.add_property().CopyFrom(
+                datastore_types.ToPropertyPb(self._name, value))
+        return [filt]
+
+
+def _splitFilter(filter_str):
+    """Returns the property name and operator of a filter string."""
+
+    parts = filter_str.strip().rsplit(' ', 1)
+    if len(parts) == 1:
+        return parts[0], '='
+    return parts[0], parts[1]
+
+
+def _predicates(filters):
+    return [datastore_query.make_filter(name, op, value)
+            for (name, op), value in [(_splitFilter(f), v)
+                                      for f, v in filters.iteritems()]]
+
+
+def combine(bound_queries):
+    """Combines the queries of an IN or != filter into a single query.
+
+    Args:
+        bound_queries: The datastore.Query instances of a MultiQuery.
+
+    Returns:
+        A datastore.Query or None if the queries don't differ in a single
+        IN or != filter.
+    """
+    if len(bound_queries) < 2:
+        return None
+    filters = [dict(q) for q in bound_queries]
+    common = dict(filters[0])
+    for other in filters[1:]:
+        for filter_str, value in common.items():
+            if other.get(filter_str) != value:
+                del common[filter_str]
+    rest = [dict((f, v) for f, v in q.iteritems() if f not in common)
+            for q in filters]
+
+    if [len(r) for r in rest] != [1] * len(rest):
+        return None
+    names_ops = [_splitFilter(r.keys()[0]) for r in rest]
+    values = [r.values()[0] for r in rest]
+    names = set(name for name, op in names_ops)
+    if len(names) != 1:
+        return None
+    name = names.pop()
+    ops = [op for n, op in names_ops]
+
+    if [op for op in ops if op not in _EQUALITY_OPERATORS]:
+        if sorted(ops) != ['<', '>'] or values[0] != values[1]:
+            return None
+        predicate = MultiValueFilter(name, NOT_EQUAL, values[:1])
+    else:
+        if [v for v in values if isinstance(v, list)]:
+            return None
+        predicate = MultiValueFilter(
+            name, datastore_pb.Query_Filter.IN, values)
+
+    predicates = _predicates(common) + [predicate]
+    query = copy.copy(bound_queries[0])
+    query.GetFilterPredicate = lambda: datastore_query.CompositeFilter(
+        datastore_query.CompositeFilter.AND, predicates)
+    query.GetQuery()
+    return query
+
+
+_original_run = None
+
+
+def _run(self, **kwargs):
+    """Runs a MultiQuery as a single query if possible."""
+
+    try:
+        query = combine(self._MultiQuery__bound_queries)
+    except Exception, e:
+        logging.debug("Can't combine queries: %s", e)
+        query = None
+    if query is None:
+        return _original_run(self, **kwargs)
+    return query.Run(**kwargs)
+
+
+def install():
+    """Makes the SDK's MultiQuery send single queries."""
+
+    global _original_run
+    if _original_run is None:
+        _original_run = datastore.MultiQuery.Run
+        datastore.MultiQuery.Run = _run
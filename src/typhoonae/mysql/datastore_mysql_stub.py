@@ -30,6 +30,7 @@ import array
 import itertools
 import logging
 from hashlib import md5
+import operator
 import sys
 import threading
 import time
@@ -46,6 +47,12 @@ from google.appengine.runtime import apiproxy_errors
 
 import MySQLdb
 import MySQLdb.constants.CR
+import MySQLdb.constants.ER
+import MySQLdb.cursors
+import typhoonae.async_rpc
+import typhoonae.idallocator
+import typhoonae.lrucache
+import typhoonae.multiquery
 
 try:
   __import__('google.appengine.api.taskqueue.taskqueue_service_pb')
@@ -83,12 +90,109 @@ _MAX_ACTIONS_PER_TXN = 5
 _MAX_TIMEOUT = 5.0
 
 
+_POOL_SIZE = 10
+
+
+_POOL_TIMEOUT = 30.0
+
+
+_FETCH_SIZE = 100
+
+
+_DEDUP_WINDOW = 10000
+
+
+# Query cursors which haven't been used for this many seconds get closed.
+_CURSOR_TTL = 60
+
+
+# Results of queries limited to this many rows are read at once, so their
+# cursors don't keep a connection busy.
+_MAX_BUFFERED_ROWS = 1000
+
+
+_SCHEMA_CACHE_SIZE = 100
+
+
+# Schemas cached by other processes may be outdated for this many seconds.
+_SCHEMA_CACHE_TTL = 60
+
+
+# Queries may miss indexes created or deleted by other processes for this
+# many seconds. Writes always see the current indexes.
+_INDEX_REFRESH_INTERVAL = 5
+
+
+# Statistics changes are summed per process and written at most this often,
+# so concurrent writes of a kind don't wait for each other's statistics rows.
+# Other processes see them that much later.
+_STATS_FLUSH_INTERVAL = 5
+
+
+_STAT_KIND = '__Stat_Kind__'
+
+
+# InnoDB limits index keys to 3072 bytes and every key part to 767 bytes.
+_MAX_KEY_LENGTH = 3072
+
+
+_MAX_KEY_PART_LENGTH = 767
+
+
+# Key length of a VARCHAR(255) path column using utf8. Tables declare their
+# character set, since the 4 bytes per character of a utf8mb4 default would
+# exceed the key part limit.
+_PATH_KEY_LENGTH = 765
+
+
+# Bytes of max_allowed_packet reserved for the protocol.
+_PACKET_HEADROOM = 1024
+
+
+_CONNECTION_LOST_ERRORS = frozenset([
+    MySQLdb.constants.CR.SERVER_GONE_ERROR,
+    MySQLdb.constants.CR.SERVER_LOST,
+])
+
+
+_LOCK_ERRORS = frozenset([
+    MySQLdb.constants.ER.LOCK_WAIT_TIMEOUT,
+    MySQLdb.constants.ER.LOCK_DEADLOCK,
+])
+
+
 _OPERATOR_MAP = {
     datastore_pb.Query_Filter.LESS_THAN: '<',
     datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: '<=',
     datastore_pb.Query_Filter.EQUAL: '=',
     datastore_pb.Query_Filter.GREATER_THAN: '>',
     datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: '>=',
+    typhoonae.multiquery.NOT_EQUAL: '!=',
+}
+
+# Operators of filters matching one of several values.
+_EQUALITY_OPERATORS = frozenset([
+    datastore_pb.Query_Filter.EQUAL,
+    datastore_pb.Query_Filter.IN,
+])
+
+# Compares encoded property values the way filters do.
+_FILTER_FUNCTIONS = {
+    datastore_pb.Query_Filter.LESS_THAN: operator.lt,
+    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL: operator.le,
+    datastore_pb.Query_Filter.EQUAL: operator.eq,
+    datastore_pb.Query_Filter.GREATER_THAN: operator.gt,
+    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL: operator.ge,
+    datastore_pb.Query_Filter.IN: lambda value, values: value in values,
+    typhoonae.multiquery.NOT_EQUAL: operator.ne,
+}
+
+# Inclusive operators which compare truncated operands by their prefix.
+_INCLUSIVE_OPERATORS = {
+    datastore_pb.Query_Filter.LESS_THAN:
+        datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+    datastore_pb.Query_Filter.GREATER_THAN:
+        datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
 }
 
 
@@ -100,19 +204,59 @@ _ORDER_MAP = {
 _CORE_SCHEMA = ["""
 CREATE TABLE IF NOT EXISTS Apps (
   app_id VARCHAR(255) NOT NULL PRIMARY KEY,
-  indexes VARCHAR(255)
-) ENGINE=InnoDB;
+  indexes MEDIUMBLOB
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 ""","""
 CREATE TABLE IF NOT EXISTS Namespaces (
   app_id VARCHAR(255) NOT NULL,
   name_space VARCHAR(255) NOT NULL,
   PRIMARY KEY (app_id, name_space)
-) ENGINE=InnoDB;
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 ""","""
 CREATE TABLE IF NOT EXISTS IdSeq (
   prefix VARCHAR(255) NOT NULL PRIMARY KEY,
   next_id INT(100) NOT NULL
-) ENGINE=InnoDB;
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+""","""
+CREATE TABLE IF NOT EXISTS EntityGroups (
+  prefix VARCHAR(255) NOT NULL,
+  root VARCHAR(255) NOT NULL,
+  version BIGINT UNSIGNED NOT NULL,
+  PRIMARY KEY (prefix, root)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+"""]
+
+# The primary key clusters index rows in the order single property queries
+# read them. Values are truncated to the maximum length of a key part.
+_ENTITIES_BY_PROPERTY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS %(table)s (
+  kind VARCHAR(255) NOT NULL,
+  name VARCHAR(255) NOT NULL,
+  value VARBINARY(767) NOT NULL,
+  __path__ VARCHAR(255) NOT NULL,
+  PRIMARY KEY(kind, name, value, __path__),
+  INDEX(__path__)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+"""
+
+# Statistics which are updated along with every write. PropertyStats counts
+# the EntitiesByProperty rows per property and value type, the type being
+# the first byte of the encoded value.
+_STATS_SCHEMA = ["""
+CREATE TABLE IF NOT EXISTS %(prefix)s_KindStats (
+  kind VARCHAR(255) NOT NULL PRIMARY KEY,
+  count BIGINT NOT NULL,
+  bytes BIGINT NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+""","""
+CREATE TABLE IF NOT EXISTS %(prefix)s_PropertyStats (
+  kind VARCHAR(255) NOT NULL,
+  name VARCHAR(255) NOT NULL,
+  tag VARBINARY(1) NOT NULL,
+  count BIGINT NOT NULL,
+  sample VARBINARY(767) NOT NULL,
+  PRIMARY KEY(kind, name, tag)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 """]
 
 _NAMESPACE_SCHEMA = ["""
@@ -122,30 +266,267 @@ CREATE TABLE IF NOT EXISTS %(prefix)s_Entities (
   entity MEDIUMBLOB NOT NULL,
   INDEX(kind),
   INDEX(__path__)
-) ENGINE=InnoDB;
-""","""
-CREATE TABLE IF NOT EXISTS %(prefix)s_EntitiesByProperty (
-  kind VARCHAR(255) NOT NULL,
-  name VARCHAR(255) NOT NULL,
-  value BLOB NOT NULL,
-  __path__ VARCHAR(255) NOT NULL REFERENCES Entities,
-  hashed_index CHAR(32) NOT NULL,
-  PRIMARY KEY(hashed_index),
-  INDEX(value(32))
-) ENGINE=InnoDB;
-""","""
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+""",
+_ENTITIES_BY_PROPERTY_SCHEMA % {'table': '%(prefix)s_EntitiesByProperty'},
+] + _STATS_SCHEMA + ["""
 INSERT IGNORE INTO Apps (app_id) VALUES ('%(app_id)s');
 ""","""
-INSERT INTO Namespaces (app_id, name_space)
+INSERT IGNORE INTO Namespaces (app_id, name_space)
   VALUES ('%(app_id)s', '%(name_space)s');
 ""","""
 INSERT IGNORE INTO IdSeq VALUES ('%(prefix)s', 1);
 """]
 
+# The tables of _NAMESPACE_SCHEMA, without their namespace prefix.
+_NAMESPACE_TABLES = ('Entities', 'EntitiesByProperty', 'KindStats',
+                     'PropertyStats')
+
 def formatTableName(tableName):
     import re
     return re.sub("[^\w\d_]","",tableName)
 
+def _EncodeCursorPosition(values):
+  """Encodes the sort column values of a result as a cursor start key.
+
+  Args:
+    values: A list of strings.
+  Returns:
+    A string.
+  """
+  return ''.join('%d:%s' % (len(v), v) for v in values)
+
+
+def _DecodeCursorPosition(start_key):
+  """Decodes a cursor start key into a list of sort column values.
+
+  Args:
+    start_key: A string created by _EncodeCursorPosition.
+  Returns:
+    A list of strings.
+  Raises:
+    apiproxy_errors.ApplicationError: if the start key is invalid.
+  """
+  values = []
+  i = 0
+  try:
+    while i < len(start_key):
+      sep = start_key.index(':', i)
+      end = sep + 1 + int(start_key[i:sep])
+      if end > len(start_key):
+        raise ValueError
+      values.append(start_key[sep + 1:end])
+      i = end
+  except ValueError:
+    raise apiproxy_errors.ApplicationError(
+        datastore_pb.Error.BAD_REQUEST, 'Invalid query cursor.')
+  return values
+
+
+def _CursorValue(value):
+  """Converts a sort column value as returned by MySQLdb into a string."""
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return str(value)
+
+
+def _IsTruncated(value):
+  """Returns whether an encoded value or a list of them reaches the index
+  key part limit, so its index value is or may be truncated."""
+  if isinstance(value, list):
+    return bool([1 for v in value if _IsTruncated(v)])
+  return len(value) >= _MAX_KEY_PART_LENGTH
+
+
+class TruncatedValueCheck(object):
+  """Checks rows of index values which reach the key part limit.
+
+  Index values are truncated to _MAX_KEY_PART_LENGTH bytes, so query plans
+  compare truncated filter operands inclusively by their prefix and return
+  a superset of the results. Rows whose sort values share a truncated prefix
+  come in path order. The check drops the rows whose entities fail those
+  filters and sorts runs of rows sharing a truncated prefix by the full
+  values of their entities. The full values replace the truncated ones, so
+  cursors point at them.
+  """
+
+  def __init__(self, filter_sets, sort_columns, values, start=None,
+               end=None):
+    """Constructor.
+
+    Args:
+      filter_sets: A list of (name, filters) tuples. A single value of the
+        property must pass all (op, value) filters of a set.
+      sort_columns: A (name, direction) tuple for every sort column of the
+        rows. The name is None for columns which don't hold property values.
+      values: Callable returning the encoded values of a property of an
+        EntityProto.
+      start: The sort column values of the start cursor or None.
+      end: The sort column values of the end cursor or None.
+    """
+    self.__filter_sets = []
+    for name, filters in filter_sets:
+      if not [1 for _, value in filters if _IsTruncated(value)]:
+        continue
+      operands = []
+      for op, value in filters:
+        if isinstance(value, list):
+          operands.append((op, [str(v) for v in value]))
+        else:
+          operands.append((op, str(value)))
+      self.__filter_sets.append((name, operands))
+    self.__sort_columns = sort_columns
+    self.__values = values
+    self.__start = self.__TruncatedPosition(start)
+    self.__end = self.__TruncatedPosition(end)
+    self.__run = []
+    self.__next_row = None
+
+  @staticmethod
+  def __TruncatedPosition(values):
+    if values and _IsTruncated(values):
+      return values
+    return None
+
+  def IsNeeded(self):
+    """Returns whether rows may need to be checked."""
+    return bool(self.__filter_sets or [1 for n, _ in self.__sort_columns if n])
+
+  def HasFilters(self):
+    """Returns whether every row needs its entity to be checked."""
+    return bool(self.__filter_sets)
+
+  def HasPending(self):
+    """Returns whether rows were read ahead and not returned yet."""
+    return bool(self.__run) or self.__next_row is not None
+
+  def NextRow(self, fetch):
+    """Returns the next row or None.
+
+    Args:
+      fetch: Callable returning the next row of the database cursor or None.
+    """
+    while not self.__run:
+      row = self.__Fetch(fetch)
+      if row is None:
+        return None
+      truncated = [i for i, (name, _) in enumerate(self.__sort_columns)
+                   if name and _IsTruncated(_CursorValue(row[i + 2]))]
+      if not truncated:
+        return row
+      width = truncated[0] + 3
+      run = [row]
+      while True:
+        row = self.__Fetch(fetch)
+        if row is None:
+          break
+        if tuple(row[2:width]) != tuple(run[0][2:width]):
+          self.__next_row = row
+          break
+        run.append(row)
+      run = [self.__FullRow(r) for r in run]
+      run.sort(lambda a, b: self.__Compare(a[2:], b[2:]))
+      self.__run = [r for r in run if self.__InRange(r[2:])]
+    return self.__run.pop(0)
+
+  def __Fetch(self, fetch):
+    """Returns the next row passing the filters or None."""
+    while True:
+      row = self.__next_row
+      self.__next_row = None
+      if row is None:
+        row = fetch()
+      if row is None or self.__Matches(row):
+        return row
+
+  def __Matches(self, row):
+    if not self.__filter_sets or row[1] is None:
+      return True
+    entity = entity_pb.EntityProto(row[1])
+    for name, filters in self.__filter_sets:
+      for value in self.__values(entity, name):
+        if not [1 for op, operand in filters
+                if not _FILTER_FUNCTIONS[op](value, operand)]:
+          break
+      else:
+        return False
+    return True
+
+  def __FullRow(self, row):
+    """Replaces the truncated sort values of a row with full values."""
+    entity = None
+    if row[1] is not None:
+      entity = entity_pb.EntityProto(row[1])
+    sort_values = []
+    for (name, direction), value in zip(self.__sort_columns, row[2:]):
+      value = _CursorValue(value)
+      if name and entity is not None and _IsTruncated(value):
+        full_values = [v for v in self.__values(entity, name)
+                       if v.startswith(value)]
+        if full_values and direction == datastore_pb.Query_Order.DESCENDING:
+          value = max(full_values)
+        elif full_values:
+          value = min(full_values)
+      sort_values.append(value)
+    return tuple(row[:2]) + tuple(sort_values)
+
+  def __Compare(self, a, b):
+    """Compares sort column values in sort order."""
+    for (_, direction), x, y in zip(self.__sort_columns, a, b):
+      result = cmp(_CursorValue(x), _CursorValue(y))
+      if result:
+        if direction == datastore_pb.Query_Order.DESCENDING:
+          return -result
+        return result
+    return 0
+
+  def __InRange(self, values):
+    if self.__start and self.__Compare(values, self.__start) <= 0:
+      return False
+    if self.__end and self.__Compare(values, self.__end) > 0:
+      return False
+    return True
+
+
+# Matches the encoded paths which don't tell the key of an entity: paths of
+# several elements, as names may contain the separators, and IDs, as they look
+# like names of ten or more digits. Without a kind, names may contain ':'.
+_AMBIGUOUS_PATH = '!|:[0-9]{10,}$'
+_AMBIGUOUS_KINDLESS_PATH = _AMBIGUOUS_PATH + '|:.*:'
+
+
+def _DecodePath(path, kind=None):
+  """Decodes an entity path as stored in the __path__ columns.
+
+  Only paths which don't match _AMBIGUOUS_PATH, or _AMBIGUOUS_KINDLESS_PATH
+  without a kind, can be decoded.
+
+  Args:
+    path: A path encoded by DatastoreMySQLStub.__EncodeIndexPB.
+    kind: The kind of the entity or None if unknown.
+  Returns:
+    A (kind, name) tuple.
+  """
+  if kind:
+    return kind, path[len(kind) + 1:]
+  kind, _, name = path.partition(':')
+  return kind, name
+
+
+def _KeyOnlyEntity(key):
+  """Returns an EntityProto which only holds a key.
+
+  Args:
+    key: An entity_pb.Reference.
+  Returns:
+    An entity_pb.EntityProto.
+  """
+  entity = entity_pb.EntityProto()
+  entity.mutable_key().CopyFrom(key)
+  entity.mutable_entity_group().add_element().CopyFrom(key.path().element(0))
+  return entity
+
+
 def ReferencePropertyToReference(refprop):
   ref = entity_pb.Reference()
   ref.set_app(refprop.app())
@@ -157,9 +538,14 @@ def ReferencePropertyToReference(refprop):
 
 
 class QueryCursor(object):
-  """Encapsulates a database cursor and provides methods to fetch results."""
+  """Encapsulates a database cursor and provides methods to fetch results.
+
+  Rows are fetched from the database in batches, so unbuffered server-side
+  cursors never hold more than one batch in memory.
+  """
 
-  def __init__(self, query, db_cursor):
+  def __init__(self, query, db_cursor, dedup_window=_DEDUP_WINDOW,
+               on_close=None, check=None):
     """Constructor.
 
     Args:
@@ -167,22 +553,80 @@ class QueryCursor(object):
       db_cursor: An MySQL cursor returning n+2 columns. The first 2 columns
         must be the path of the entity and the entity itself, while the
         remaining columns must be the sort columns for the query.
+      dedup_window: Number of recently returned paths which are remembered to
+        skip duplicates, or None if the query cannot return duplicates.
+      on_close: Callable receiving whether all rows were read when the cursor
+        gets closed.
+      check: A TruncatedValueCheck for the rows or None.
     """
     self.__query = query
     self.app = query.app()
     self.__cursor = db_cursor
-    self.__num_results = db_cursor.rowcount
-    self.__seen = set()
+    self.__rows = []
+    self.__check = check
+    self.__num_results = 0
+    self.__on_close = on_close
+    if dedup_window:
+      self.__seen = typhoonae.lrucache.LRUCache(dedup_window)
+    else:
+      self.__seen = None
 
-    self.__position = ('', '')
+    # The sort column values of the last returned result.
+    self.__position = []
+    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
+      self.__position = _DecodeCursorPosition(
+          query.compiled_cursor().position(0).start_key())
 
-    self.__next_result = (None, None)
+    self.__next_result = (None, None, None)
 
     if query.has_limit():
       self.limit = query.limit() + query.offset()
     else:
       self.limit = None
 
+  def Close(self):
+    """Closes the database cursor.
+
+    A cursor which still has unread rows is closed along with its connection,
+    since reading the remaining rows might take a long time. Closing an
+    unbuffered cursor itself would read them, so it is detached from its
+    connection instead.
+    """
+    if not self.__cursor:
+      return
+    exhausted = not self.__rows and not self.__cursor.fetchmany(1)
+    db_cursor = self.__cursor
+    self.__cursor = None
+    self.__rows = []
+    if exhausted or not self.__on_close:
+      db_cursor.close()
+    if self.__on_close:
+      self.__on_close(exhausted)
+    if not exhausted:
+      db_cursor.connection = None
+
+  def __FetchRow(self):
+    """Returns the next row of the database cursor or None."""
+    if not self.__rows:
+      if not self.__cursor:
+        return None
+      self.__rows = list(self.__cursor.fetchmany(_FETCH_SIZE))
+      self.__rows.reverse()
+      if not self.__rows:
+        self.Close()
+        return None
+    return self.__rows.pop()
+
+  def __NextRow(self):
+    """Returns the next row which passed the check of the query plan."""
+    if self.__check is not None:
+      return self.__check.NextRow(self.__FetchRow)
+    return self.__FetchRow()
+
+  def __HasRows(self):
+    return self.__cursor is not None or (
+        self.__check is not None and self.__check.HasPending())
+
   def Count(self):
     """Counts results, up to the query's limit.
 
@@ -194,10 +638,11 @@ class QueryCursor(object):
     """
     count = 0
     while self.limit is None or count < self.limit:
-      row = self.__cursor.fetchone()
+      row = self.__NextRow()
       if not row:
         break
       count += 1
+    self.Close()
     return count
 
   def _EncodeCompiledCursor(self, cc):
@@ -207,45 +652,26 @@ class QueryCursor(object):
       cc: The compiled cursor to fill out.
     """
     position = cc.add_position()
-    start_key = self.__position[0] + '!' + str(self.__num_results).zfill(10)
-    position.set_start_key(start_key)
+    position.set_start_key(_EncodeCursorPosition(self.__position))
 
   def _GetResult(self):
     """Returns the next result from the result set, without deduplication.
 
     Returns:
-      (path, value): The path and value of the next result.
+      (path, value, position): The path, value and sort column values of the
+        next result.
     """
-    if self.__position[1]:
-      self.__position = (self.__position[1], None)
-
-    if not self.__cursor:
-      return None, None
-    row = self.__cursor.fetchone()
+    row = self.__NextRow()
     if not row:
-      self.__cursor = None
-      return None, None
-    path, data, position_parts = str(row[0]), row[1], row[2:]
-    position = ''.join(str(x) for x in position_parts)
+      return None, None, None
+    return self._MakeResult(row)
 
-    if self.__query.order_list():
-      direction = self.__query.order(0).direction()
-    else:
-      direction = datastore_pb.Query_Order.ASCENDING
-
-    if self.__query.has_end_compiled_cursor():
-      start_key = self.__query.end_compiled_cursor().position(0).start_key()
-      if direction == datastore_pb.Query_Order.ASCENDING:
-        if position > start_key:
-          self.__cursor = None
-          return None, None
-      elif direction == datastore_pb.Query_Order.DESCENDING:
-        if position < start_key:
-          self.__cursor = None
-          return None, None
-
-    self.__position = (self.__position[0], position)
-    return path, data
+  def _MakeResult(self, row):
+    """Returns the (path, value, position) tuple of a database row."""
+    return str(row[0]), row[1], [_CursorValue(x) for x in row[2:]]
+
+  def __IsDuplicate(self, path):
+    return self.__seen is not None and path in self.__seen
 
   def _Next(self):
     """Fetches the next unique result from the result set.
@@ -254,9 +680,12 @@ class QueryCursor(object):
       A datastore_pb.EntityProto instance.
     """
     if self._HasNext():
-      self.__seen.add(self.__next_result[0])
+      if self.__seen is not None:
+        self.__seen.put(self.__next_result[0], True)
+      self.__num_results += 1
+      self.__position = self.__next_result[2]
       entity = entity_pb.EntityProto(self.__next_result[1])
-      self.__next_result = None, None
+      self.__next_result = None, None, None
       return entity
     return None
 
@@ -266,8 +695,9 @@ class QueryCursor(object):
     Returns:
       A boolean that indicates if there are more results.
     """
-    while self.__cursor and (
-        not self.__next_result[0] or self.__next_result[0] in self.__seen):
+    while self.__HasRows() and (
+        not self.__next_result[0] or
+        self.__IsDuplicate(self.__next_result[0])):
       self.__next_result = self._GetResult()
     if self.__next_result[0]:
       return True
@@ -287,39 +717,6 @@ class QueryCursor(object):
         return i
     return count
 
-  def ResumeFromCompiledCursor(self, cc):
-    """Resumes a query from a compiled cursor.
-
-    Args:
-      cc: The compiled cursor to resume from.
-    """
-    target_position, _ = cc.position(0).start_key().split('!')
-
-    if self.__query.order_list():
-      direction = self.__query.order(0).direction()
-    else:
-      direction = datastore_pb.Query_Order.ASCENDING
-
-    if direction == datastore_pb.Query_Order.ASCENDING:
-      if (self.__query.has_end_compiled_cursor() and target_position >=
-          self.__query.end_compiled_cursor().position(0).start_key()):
-        self.__position = (target_position, target_position)
-        self.__cursor = None
-        return
-
-      while self.__position[1] <= target_position and self.__cursor:
-        self.__next_result = self._GetResult()
-
-    elif direction == datastore_pb.Query_Order.DESCENDING:
-      if (self.__query.has_end_compiled_cursor() and target_position <=
-          self.__query.end_compiled_cursor().position(0).start_key()):
-        self.__position = (target_position, target_position)
-        self.__cursor = None
-        return
-
-      while self.__position[1] >= target_position and self.__cursor:
-        self.__next_result = self._GetResult()
-
   def PopulateQueryResult(self, count, offset, result):
     """Populates a QueryResult PB with results from the cursor.
 
@@ -338,7 +735,7 @@ class QueryCursor(object):
 
       result_list = result.result_list()
       while len(result_list) < count:
-        if self.limit is not None and len(self.__seen) >= self.limit:
+        if self.limit is not None and self.__num_results >= self.limit:
           break
         entity = self._Next()
         if entity is None:
@@ -350,6 +747,202 @@ class QueryCursor(object):
     self._EncodeCompiledCursor(result.mutable_compiled_cursor())
 
 
+class StatKindCursor(QueryCursor):
+  """Builds __Stat_Kind__ entities from the rows of a KindStats table.
+
+  The database cursor must return the kind, the number of entities and their
+  total size in bytes.
+  """
+
+  def __init__(self, query, *args, **kwds):
+    QueryCursor.__init__(self, query, *args, **kwds)
+    self.__name_space = query.name_space()
+    self.__timestamp = long(time.time() * 1000000)
+
+  def _MakeResult(self, row):
+    kind, count, size = row
+    entity = entity_pb.EntityProto()
+    key = entity.mutable_key()
+    key.set_app(self.app)
+    if self.__name_space:
+      key.set_name_space(self.__name_space)
+    element = key.mutable_path().add_element()
+    element.set_type(_STAT_KIND)
+    element.set_name(kind)
+    entity.mutable_entity_group().add_element().CopyFrom(element)
+
+    prop = entity.add_property()
+    prop.set_name('kind_name')
+    prop.set_multiple(False)
+    prop.mutable_value().set_stringvalue(kind)
+    for name, value in (('count', count), ('bytes', size),
+                        ('timestamp', self.__timestamp)):
+      prop = entity.add_property()
+      prop.set_name(name)
+      prop.set_multiple(False)
+      prop.mutable_value().set_int64value(long(value))
+    prop.set_meaning(entity_pb.Property.GD_WHEN)
+    return kind, entity.Encode(), [_CursorValue(kind)]
+
+
+class KeysOnlyCursor(QueryCursor):
+  """Builds the results of keys-only queries from entity paths.
+
+  The database cursor must return the path of the entity, the stored entity
+  or NULL if the path can be decoded, and the sort columns. So query plans
+  only read stored entities of ambiguous paths.
+  """
+
+  def __init__(self, query, db_cursor, dedup_window=_DEDUP_WINDOW,
+               on_close=None, check=None):
+    """Constructor.
+
+    Args:
+      query: A Query PB.
+      db_cursor: An MySQL cursor returning n+2 columns.
+      dedup_window: See QueryCursor.
+      on_close: See QueryCursor.
+      check: See QueryCursor.
+    """
+    QueryCursor.__init__(self, query, db_cursor, dedup_window, on_close,
+                         check)
+    self.__name_space = query.name_space()
+    self.__kind = query.kind()
+
+  def _MakeResult(self, row):
+    path = _CursorValue(row[0])
+    if row[1] is not None:
+      key = entity_pb.EntityProto(row[1]).key()
+    else:
+      key = entity_pb.Reference()
+      key.set_app(self.app)
+      if self.__name_space:
+        key.set_name_space(self.__name_space)
+      kind, name = _DecodePath(path, self.__kind)
+      element = key.mutable_path().add_element()
+      element.set_type(kind)
+      element.set_name(name)
+    entity = _KeyOnlyEntity(key)
+    return path, entity.Encode(), [_CursorValue(x) for x in row[2:]]
+
+
+class ConnectionPool(object):
+  """A bounded pool of MySQL connections.
+
+  Connections are opened lazily up to the maximum size. Callers which find the
+  pool exhausted wait until another caller releases or discards a connection.
+  """
+
+  def __init__(self, connect_args, max_size=_POOL_SIZE, timeout=_POOL_TIMEOUT):
+    """Constructor.
+
+    Args:
+      connect_args: Keyword arguments for MySQLdb.connect.
+      max_size: Maximum number of open connections.
+      timeout: Number of seconds to wait for a connection.
+    """
+    assert max_size > 0
+    self.__connect_args = connect_args
+    self.__max_size = max_size
+    self.__timeout = timeout
+    self.__idle = []
+    self.__size = 0
+    self.__condition = threading.Condition()
+
+  def Connect(self):
+    """Opens a new connection which is not managed by the pool."""
+    return MySQLdb.connect(**self.__connect_args)
+
+  def Acquire(self):
+    """Borrows an idle connection or opens a new one.
+
+    Returns:
+      A MySQL connection.
+
+    Raises:
+      apiproxy_errors.ApplicationError: if no connection becomes available
+        within the timeout.
+    """
+    deadline = time.time() + self.__timeout
+    self.__condition.acquire()
+    try:
+      while not self.__idle and self.__size >= self.__max_size:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.TIMEOUT,
+              'Timed out waiting for a MySQL connection.')
+        self.__condition.wait(remaining)
+      if self.__idle:
+        return self.__idle.pop()
+      self.__size += 1
+    finally:
+      self.__condition.release()
+
+    try:
+      return self.Connect()
+    except:
+      self.__Forget()
+      raise
+
+  def Release(self, conn):
+    """Returns a connection to the pool."""
+    self.__condition.acquire()
+    try:
+      self.__idle.append(conn)
+      self.__condition.notify()
+    finally:
+      self.__condition.release()
+
+  def Discard(self, conn):
+    """Closes a broken connection instead of returning it to the pool."""
+    try:
+      conn.close()
+    except MySQLdb.Error:
+      pass
+    self.__Forget()
+
+  def DiscardIdle(self):
+    """Closes all idle connections, e.g. after the server went away."""
+    self.__condition.acquire()
+    try:
+      idle, self.__idle = self.__idle, []
+    finally:
+      self.__condition.release()
+    for conn in idle:
+      self.Discard(conn)
+
+  def __Forget(self):
+    self.__condition.acquire()
+    try:
+      self.__size -= 1
+      self.__condition.notify()
+    finally:
+      self.__condition.release()
+
+
+def _NewLockStats():
+  """Returns a dict of zeroed entity group lock statistics."""
+  return {'locks': 0, 'lock_wait_time': 0.0, 'max_lock_wait_time': 0.0,
+          'conflicts': 0}
+
+
+class _Transaction(object):
+  """Holds the state of a single transaction.
+
+  Every transaction keeps the connection it was started on until it is
+  committed or rolled back.
+  """
+
+  def __init__(self, conn):
+    self.connection = conn
+    self.entity_group = None
+    self.version = None
+    self.writes = {}
+    self.deletes = set()
+    self.actions = []
+
+
 class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
   """Persistent stub for the Python datastore API.
 
@@ -375,7 +968,8 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
                require_indexes=False,
                verbose=False,
                service_name='datastore_v3',
-               trusted=False):
+               trusted=False,
+               pool_size=_POOL_SIZE):
     """Constructor.
 
     Args:
@@ -387,6 +981,7 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       service_name: Service name expected for all calls.
       trusted: bool, default False. If True, this stub allows an app to access
           the data of another app.
+      pool_size: Maximum number of MySQL connections.
     """
     apiproxy_stub.APIProxyStub.__init__(self, service_name)
 
@@ -395,40 +990,62 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     self.__database_info_dict = database_info_dict
     self.SetTrusted(trusted)
 
-    self.__tx_actions = []
     self.__transactions = {}
-    self.__inside_tx = False
+    self.__next_tx_handle = 1
     self.__tx_lock = threading.Lock()
 
     self.__require_indexes = require_indexes
     self.__verbose = verbose
 
-    self.__id_map = {}
-    self.__id_lock = threading.Lock()
-
-    self.__connection = MySQLdb.connect(
-        host=database_info_dict.get('host', '127.0.0.1'),
-        user=database_info_dict.get('user', 'root'),
-        passwd=database_info_dict.get('passwd', ''),
-        db='mysql')
-    self.__connection_lock = threading.RLock()
-    self.__current_transaction = None
-    self.__next_tx_handle = 1
+    self.__id_allocator = typhoonae.idallocator.IdAllocator(
+        self.__ReserveIds)
 
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
+    self.__pool = ConnectionPool(database_info_dict, pool_size)
 
     self.__next_cursor_id = 1
     self.__cursor_lock = threading.Lock()
-    self.__cursors = {}
+    # Open cursors keep a pooled connection busy, so at most half of the pool
+    # serves them. New queries close the least recently used cursor when the
+    # registry is full, and cursors expire when they are not used.
+    self.__cursors = typhoonae.lrucache.LRUCache(
+        max(1, pool_size / 2), ttl=_CURSOR_TTL,
+        on_evict=lambda unused_id, cursor: cursor.Close())
+
+    # Maps (app_id, name_space) tuples to table prefixes.
+    self.__namespaces = {}
+    self.__namespace_lock = threading.Lock()
+
+    self.__max_packet = 1024 * 1024
 
-    self.__namespaces = set()
+    # EntitiesByProperty tables which still have the layout of earlier
+    # versions, see typhoonae.mysql.upgrade.
+    self.__legacy_tables = set()
 
     self.__indexes = {}
+    # Map app IDs to the MD5 digests of their stored indexes and to the times
+    # they were last compared, see __RefreshIndexes.
+    self.__index_digests = {}
+    self.__index_checks = {}
     self.__index_lock = threading.Lock()
 
     self.__query_history = {}
 
+    # Maps GetSchema requests to the rows of the statistics tables.
+    self.__schema_cache = typhoonae.lrucache.LRUCache(
+        _SCHEMA_CACHE_SIZE, ttl=_SCHEMA_CACHE_TTL)
+
+    self.__lock_stats = _NewLockStats()
+    self.__lock_stats_lock = threading.Lock()
+
+    # Maps namespace prefixes to the unwritten statistics changes of
+    # committed writes, see __AddStats.
+    self.__stats = {}
+    self.__stats_flushed = time.time()
+    self.__stats_lock = threading.Lock()
+
+    # Runs the calls of asynchronous RPCs, see CreateRPC.
+    self.__rpc_pool = typhoonae.async_rpc.ThreadPool(pool_size)
+
     try:
       self.__Init()
     except Exception, e:
@@ -436,32 +1053,93 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
 
   def __Init(self):
     """Initializes MySQL database and creates required tables."""
-    cursor = self.__connection.cursor()
-    cursor.execute(
-      'CREATE DATABASE IF NOT EXISTS %s' % self.__database_info_dict['db'])
-    cursor.close()
-    self.__connection.commit()
+    database_info_dict = self.__database_info_dict
+    conn = MySQLdb.connect(
+        host=database_info_dict.get('host', '127.0.0.1'),
+        user=database_info_dict.get('user', 'root'),
+        passwd=database_info_dict.get('passwd', ''),
+        db='mysql')
+    try:
+      cursor = conn.cursor()
+      cursor.execute(
+        'CREATE DATABASE IF NOT EXISTS %s' % database_info_dict['db'])
+      cursor.close()
+      conn.commit()
+    finally:
+      conn.close()
 
-    self.__connection = MySQLdb.connect(**self.__database_info_dict)
-    cursor = self.__connection.cursor()
-    for sql_command in _CORE_SCHEMA:
-      cursor.execute(sql_command)
-    self.__connection.commit()
+    conn = self.__pool.Acquire()
+    try:
+      cursor = conn.cursor()
+      for sql_command in _CORE_SCHEMA:
+        cursor.execute(sql_command)
+      conn.commit()
 
-    cursor.execute('SELECT app_id, name_space FROM Namespaces')
-    self.__namespaces = set(cursor.fetchall())
+      # Older databases store index definitions in a column which is too
+      # small for more than a single index.
+      cursor.execute(
+          "SELECT DATA_TYPE FROM information_schema.COLUMNS "
+          "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'Apps' "
+          "AND COLUMN_NAME = 'indexes'", (database_info_dict['db'],))
+      row = cursor.fetchone()
+      if row and row[0].lower() == 'varchar':
+        cursor.execute('ALTER TABLE Apps MODIFY indexes MEDIUMBLOB')
 
-    cursor.execute('SELECT app_id, indexes FROM Apps')
-    for app_id, index_proto in cursor.fetchall():
-      index_map = self.__indexes.setdefault(app_id, {})
-      if not index_proto:
-        continue
-      indexes = datastore_pb.CompositeIndices(index_proto)
-      for index in indexes.index_list():
-        index_map.setdefault(index.definition().entity_type(), []).append(index)
+      cursor.execute('SELECT @@max_allowed_packet')
+      self.__max_packet = int(cursor.fetchone()[0])
+
+      cursor.execute('SELECT app_id, name_space FROM Namespaces')
+      self.__namespaces = dict(
+          (namespace, self.__FormatTablePrefix(namespace))
+          for namespace in cursor.fetchall())
+
+      cursor.execute(
+          "SELECT TABLE_NAME FROM information_schema.COLUMNS "
+          "WHERE TABLE_SCHEMA = %s AND COLUMN_NAME = 'hashed_index'",
+          (database_info_dict['db'],))
+      self.__legacy_tables = set(row[0] for row in cursor.fetchall())
+      for table in sorted(self.__legacy_tables):
+        logging.warning('Table %s needs to be upgraded, run the '
+                        'datastore_mysql_upgrade tool.', table)
+
+      # Namespaces of earlier versions lack the statistics tables.
+      cursor.execute(
+          "SELECT TABLE_NAME FROM information_schema.TABLES "
+          "WHERE TABLE_SCHEMA = %s", (database_info_dict['db'],))
+      tables = set(row[0] for row in cursor.fetchall())
+      for prefix in sorted(set(self.__namespaces.values())):
+        if '%s_KindStats' % prefix not in tables:
+          logging.info('Building statistics of %s', prefix)
+          self.__BuildStats(conn, prefix)
+
+      cursor.execute('SELECT app_id, indexes, MD5(indexes) FROM Apps')
+      index_rows = cursor.fetchall()
+      conn.commit()
+    finally:
+      self.__pool.Release(conn)
+
+    for app_id, index_proto, digest in index_rows:
+      self.__SetIndexes(app_id, index_proto, digest)
+
+    # Namespaces may lack tables, e.g. those of a composite index created
+    # by another process along with them.
+    conn = self.__pool.Connect()
+    try:
+      tables = self.__GetTables(conn)
+      for (app_id, name_space), prefix in sorted(self.__namespaces.items()):
+        if self.__NamespaceTables(prefix, app_id) - tables:
+          self.__ConfigureNamespace(conn, prefix, app_id, name_space)
+    finally:
+      conn.close()
+
+    # Creates the tables of the default namespace now instead of on the
+    # first request.
+    self.__GetTablePrefix((self.__app_id, ''))
 
   def Clear(self):
     """Clears the datastore."""
+    self.__cursors.clear()
+
     conn = self.__GetConnection(None)
     cursor = conn.cursor()
     try:
@@ -475,12 +1153,16 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       self.__ReleaseConnection(conn, None)
 
     self.__transactions = {}
-    self.__inside_tx = False
-    self.__namespaces = set()
+    self.__namespaces = {}
+    self.__legacy_tables = set()
     self.__indexes = {}
-    self.__cursors = {}
+    self.__index_digests = {}
+    self.__index_checks = {}
     self.__query_history = {}
-    self.__id_map = {}
+    self.__schema_cache.clear()
+    self.__lock_stats = _NewLockStats()
+    self.__stats = {}
+    self.__id_allocator.clear()
 
     self.__Init()
 
@@ -554,30 +1236,94 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     elif isinstance(pb, entity_pb.Path):
       return buffer(_encode_path(pb))
 
+  @staticmethod
+  def __EncodeIndexValue(value):
+    """Truncates an encoded property value to fit into an index key.
+
+    Args:
+      value: A value encoded by __EncodeIndexPB or a list of such values.
+    Returns:
+      A buffer or a list of buffers.
+    """
+    if isinstance(value, list):
+      return [buffer(str(v)[:_MAX_KEY_PART_LENGTH]) for v in value]
+    return buffer(str(value)[:_MAX_KEY_PART_LENGTH])
+
+  def __IndexFilters(self, column, op, value):
+    """Returns the filters comparing an index value column with an operand.
+
+    Truncated operands are compared inclusively by their prefix, so the
+    filters return a superset of the matching rows, see TruncatedValueCheck.
+
+    Args:
+      column: The index value column.
+      op: The operator of the filter.
+      value: A value encoded by __EncodeIndexPB or a list of such values.
+    Returns:
+      A list of (column, operator, value) filters.
+    """
+    if _IsTruncated(value):
+      if op == typhoonae.multiquery.NOT_EQUAL:
+        return []
+      op = _INCLUSIVE_OPERATORS.get(op, op)
+    return [(column, op, self.__EncodeIndexValue(value))]
+
+  def __PropertyValues(self, entity, name):
+    """Returns the encoded values of an entity's property."""
+    return [str(self.__EncodeIndexPB(p.value()))
+            for p in entity.property_list() if p.name() == name]
+
+  def __TruncatedValueCheck(self, query, filter_sets, sort_columns):
+    """Returns a TruncatedValueCheck for the rows of a query plan or None.
+
+    Args:
+      query: The datastore_pb.Query PB.
+      filter_sets: See TruncatedValueCheck.
+      sort_columns: See TruncatedValueCheck.
+    """
+    start, end = self.__CursorPositions(query)
+    check = TruncatedValueCheck(filter_sets, sort_columns,
+                                self.__PropertyValues, start, end)
+    if check.IsNeeded():
+      return check
+    return None
+
   @staticmethod
   def __AddQueryParam(params, param):
     params.append(param)
     return len(params)
 
   @staticmethod
-  def __CreateFilterString(filter_list, params):
+  def __CreateFilterString(filter_list, params, extra_clauses=()):
     """Transforms a filter list into an SQL WHERE clause.
 
     Args:
       filter_list: The list of (property, operator, value) filters
         to transform. A value_type of -1 indicates no value type comparison
-        should be done.
+        should be done. The value of an IN filter is a list.
       params: out: A list of parameters to pass to the query.
+      extra_clauses: A list of (clause, params) tuples to AND with the
+        filters.
     Returns:
       An SQL 'where' clause.
     """
     clauses = []
     for prop, operator, value in filter_list:
+      if operator == datastore_pb.Query_Filter.IN:
+        params.extend(value)
+        clauses.append('%s IN (%s)' % (
+            prop, DatastoreMySQLStub.__MakeParamList(len(value))))
+        continue
+
       sql_op = _OPERATOR_MAP[operator]
 
       value_index = DatastoreMySQLStub.__AddQueryParam(params, value)
       clauses.append('%s %s %%s' % (prop, sql_op))
 
+    for clause, clause_params in extra_clauses:
+      params.extend(clause_params)
+      clauses.append(clause)
+
     filters = ' AND '.join(clauses)
     if filters:
       filters = 'WHERE ' + filters
@@ -597,6 +1343,42 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       orders = 'ORDER BY ' + orders
     return orders
 
+  def __CreateSelectList(self, query, path_column, order_list, check=None):
+    """Returns the columns a query plan selects.
+
+    Keys-only queries read the stored entity only for paths which don't tell
+    the key and for rows the TruncatedValueCheck of the plan compares with
+    full values, see KeysOnlyCursor.
+
+    Args:
+      query: The datastore_pb.Query PB.
+      path_column: The column holding the path of the entity.
+      order_list: A list of (field, order) tuples.
+      check: The TruncatedValueCheck of the query plan or None.
+    Returns:
+      A comma separated list of columns.
+    """
+    columns = [path_column]
+    if not query.keys_only():
+      columns.append('Entities.entity')
+    else:
+      pattern = _AMBIGUOUS_PATH
+      if not query.kind():
+        pattern = _AMBIGUOUS_KINDLESS_PATH
+      conditions = ["%s REGEXP '%s'" % (path_column, pattern)]
+      if check is not None and check.HasFilters():
+        conditions = ['TRUE']
+      elif check is not None:
+        conditions.extend('LENGTH(%s) >= %d' % (x[0], _MAX_KEY_PART_LENGTH)
+                          for x in order_list if x[0].endswith('value'))
+      columns.append(
+          "IF(%s, (SELECT entity FROM %s_Entities AS KeyEntities "
+          "WHERE KeyEntities.__path__ = %s), NULL)" %
+          (' OR '.join(conditions), self.__GetTablePrefix(query),
+           path_column))
+    columns.extend(x[0] for x in order_list)
+    return ', '.join(columns)
+
   def __ValidateAppId(self, app_id):
     """Verify that this is the stub for app_id.
 
@@ -622,10 +1404,22 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     """
     assert isinstance(tx, datastore_pb.Transaction)
     self.__ValidateAppId(tx.app())
-    if tx.handle() != self.__current_transaction:
+    if tx.handle() not in self.__transactions:
       raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                              'Transaction %s not found' % tx)
 
+  def __GetTransaction(self, tx):
+    """Returns the state of a running transaction.
+
+    Args:
+      tx: datastore_pb.Transaction
+
+    Returns:
+      A _Transaction instance.
+    """
+    self.__ValidateTransaction(tx)
+    return self.__transactions[tx.handle()]
+
   def __ValidateKey(self, key):
     """Validate this key.
 
@@ -645,26 +1439,25 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
             'each key path element should have id or name but not both: %r'
             % key)
 
+  @staticmethod
+  def __InTransaction(transaction):
+    """Returns whether a Transaction PB refers to a transaction."""
+    return bool(transaction and transaction.handle())
+
   def __GetConnection(self, transaction):
     """Retrieves a connection to the MySQL DB.
 
     If a transaction is supplied, the transaction's connection is returned;
-    otherwise a fresh connection is returned.
+    otherwise an idle connection is borrowed from the pool.
 
     Args:
       transaction: A Transaction PB.
     Returns:
       An MySQL connection object.
     """
-    self.__connection_lock.acquire()
-    request_tx = transaction and transaction.handle()
-    if request_tx == 0:
-      request_tx = None
-    if request_tx != self.__current_transaction:
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Only one concurrent transaction per thread is permitted.')
-    return self.__connection
+    if self.__InTransaction(transaction):
+      return self.__GetTransaction(transaction).connection
+    return self.__pool.Acquire()
 
   def __ReleaseConnection(self, conn, transaction, rollback=False):
     """Releases a connection for use by other operations.
@@ -676,12 +1469,47 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       transaction: A Transaction PB.
       rollback: If True, roll back the database TX instead of committing it.
     """
-    if not transaction or not transaction.has_handle():
+    if self.__InTransaction(transaction):
+      return
+    try:
       if rollback:
         conn.rollback()
       else:
         conn.commit()
-    self.__connection_lock.release()
+    except MySQLdb.OperationalError:
+      self.__pool.Discard(conn)
+      raise
+    self.__pool.Release(conn)
+
+  def __GetTables(self, conn, prefix=None):
+    """Returns the names of existing tables.
+
+    Args:
+      conn: An MySQL connection.
+      prefix: Only returns the tables of this namespace prefix, if given.
+    """
+    statement = ('SELECT TABLE_NAME FROM information_schema.TABLES '
+                 'WHERE TABLE_SCHEMA = %s')
+    params = [self.__database_info_dict['db']]
+    if prefix is not None:
+      statement += ' AND TABLE_NAME LIKE %s'
+      params.append(prefix.replace('_', '\\_') + '\\_%')
+    cursor = conn.cursor()
+    cursor.execute(statement, params)
+    return set(row[0] for row in cursor.fetchall())
+
+  def __NamespaceTables(self, prefix, app_id):
+    """Returns the names of the tables a namespace needs.
+
+    Args:
+      prefix: The namespace prefix.
+      app_id: The app ID.
+    """
+    tables = set('%s_%s' % (prefix, name) for name in _NAMESPACE_TABLES)
+    for indexes in self.__indexes.get(app_id, {}).values():
+      for index in indexes:
+        tables.add(self.__CompositeIndexTable(prefix, index))
+    return tables
 
   def __ConfigureNamespace(self, conn, prefix, app_id, name_space):
     """Ensures the relevant tables and indexes exist.
@@ -699,8 +1527,307 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
         cursor.execute(sql_command % format_args)
       except MySQLdb.IntegrityError, e:
         logging.warn(str(e))
+    for indexes in self.__indexes.get(app_id, {}).values():
+      for index in indexes:
+        self.__CreateCompositeIndexTable(conn, prefix, index)
     conn.commit()
 
+  @staticmethod
+  def __CompositeIndexTable(prefix, index):
+    """Returns the name of the table which materializes a composite index.
+
+    Args:
+      prefix: The namespace prefix.
+      index: An entity_pb.CompositeIndex PB.
+    Returns:
+      A table name.
+    """
+    return '%s_CompositeIndex%d' % (prefix, index.id())
+
+  @staticmethod
+  def __CompositeIndexValueWidth(index):
+    """Returns the width of the value columns of a composite index table.
+
+    All columns of the primary key have to fit into InnoDB's key length
+    limit, so longer values get truncated to this width.
+
+    Args:
+      index: An entity_pb.CompositeIndex PB.
+    Returns:
+      The maximum length of a value in bytes.
+    """
+    definition = index.definition()
+    available = _MAX_KEY_LENGTH - _PATH_KEY_LENGTH
+    if definition.ancestor():
+      available -= _PATH_KEY_LENGTH
+    return min(_MAX_KEY_PART_LENGTH,
+               available / max(1, definition.property_size()))
+
+  @staticmethod
+  def __CompositeIndexColumns(index):
+    """Returns the column names of a composite index table.
+
+    Args:
+      index: An entity_pb.CompositeIndex PB.
+    Returns:
+      A list of column names in primary key order.
+    """
+    definition = index.definition()
+    columns = []
+    if definition.ancestor():
+      columns.append('ancestor')
+    columns.extend('p%d' % i for i in range(definition.property_size()))
+    columns.append('__path__')
+    return columns
+
+  def __CreateCompositeIndexTable(self, conn, prefix, index):
+    """Creates the table of a composite index in a namespace.
+
+    The table holds a row for every combination of indexed property values of
+    an entity (and every ancestor of the entity for ancestor indexes). Its
+    primary key is ordered like the index, so queries served by the index
+    read a single range of it.
+
+    Args:
+      conn: An MySQL connection.
+      prefix: The namespace prefix.
+      index: An entity_pb.CompositeIndex PB.
+    """
+    width = self.__CompositeIndexValueWidth(index)
+    columns = self.__CompositeIndexColumns(index)
+    column_defs = []
+    for column in columns:
+      if column in ('ancestor', '__path__'):
+        column_defs.append('%s VARCHAR(255) NOT NULL' % column)
+      else:
+        column_defs.append('%s VARBINARY(%d) NOT NULL' % (column, width))
+    cursor = conn.cursor()
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS %s (%s, PRIMARY KEY (%s), '
+        'INDEX(__path__)) ENGINE=InnoDB DEFAULT CHARSET=utf8' % (
+            self.__CompositeIndexTable(prefix, index),
+            ', '.join(column_defs), ', '.join(columns)))
+
+  def __CompositeIndexRows(self, entity, index):
+    """Returns the rows of a composite index table for an entity.
+
+    Args:
+      entity: An entity_pb.EntityProto.
+      index: An entity_pb.CompositeIndex PB.
+    Returns:
+      A list of rows, empty if the entity lacks an indexed property.
+    """
+    definition = index.definition()
+    width = self.__CompositeIndexValueWidth(index)
+    values = {}
+    for prop in entity.property_list():
+      values.setdefault(prop.name(), []).append(prop.value())
+
+    rows = [[]]
+    for index_prop in definition.property_list():
+      prop_values = values.get(index_prop.name())
+      if not prop_values:
+        return []
+      encoded = [buffer(str(self.__EncodeIndexPB(v))[:width])
+                 for v in prop_values]
+      rows = [row + [value] for row in rows for value in encoded]
+
+    path = entity.key().path()
+    encoded_path = self.__EncodeIndexPB(path)
+    if not definition.ancestor():
+      return [row + [encoded_path] for row in rows]
+
+    ancestors = []
+    ancestor = entity_pb.Path()
+    for element in path.element_list():
+      ancestor.add_element().CopyFrom(element)
+      ancestors.append(self.__EncodeIndexPB(ancestor))
+    return [[a] + row + [encoded_path] for a in ancestors for row in rows]
+
+  def __InsertCompositeIndexRows(self, conn, table, rows):
+    """Inserts rows into a composite index table.
+
+    Args:
+      conn: An MySQL connection.
+      table: The table name.
+      rows: A list of rows as returned by __CompositeIndexRows.
+    """
+    self.__InsertRows(conn, 'INSERT IGNORE INTO %s VALUES ' % table, rows)
+
+  def __UpdateCompositeIndexEntries(self, conn, prefix, changes):
+    """Writes the composite index rows which changed with entities.
+
+    Args:
+      conn: A database connection.
+      prefix: The namespace prefix of the entities.
+      changes: A list of (stored, entity) tuples as returned by
+        __GetStoredEntities.
+    """
+    groups = {}
+    for stored, entity in changes:
+      app_id = entity.key().app()
+      kind = self.__GetEntityKind(entity)
+      if self.__indexes.get(app_id, {}).get(kind):
+        groups.setdefault((app_id, kind), []).append((stored, entity))
+
+    for (app_id, kind), group in groups.items():
+      for index in self.__indexes[app_id].get(kind, []):
+        deletes, inserts = [], []
+        for stored, entity in group:
+          new_rows = set(tuple(row) for row in
+                         self.__CompositeIndexRows(entity, index))
+          old_rows = set()
+          if stored is not None:
+            old_rows.update(tuple(row) for row in
+                            self.__CompositeIndexRows(stored, index))
+          deletes.extend(old_rows - new_rows)
+          inserts.extend(new_rows - old_rows)
+        table = self.__CompositeIndexTable(prefix, index)
+        columns = self.__CompositeIndexColumns(index)
+        self.__DeleteRowsByValues(conn, table, columns, deletes, columns[-2])
+        self.__InsertCompositeIndexRows(conn, table, inserts)
+
+  def __DeleteCompositeIndexEntries(self, conn, prefix, keys):
+    """Deletes composite index entries of entities.
+
+    Args:
+      conn: An MySQL connection.
+      prefix: The namespace prefix of the keys.
+      keys: A list of keys to delete index entries for.
+    """
+    groups = {}
+    for key in keys:
+      app_id = key.app()
+      kind = self.__GetEntityKind(key)
+      if self.__indexes.get(app_id, {}).get(kind):
+        groups.setdefault((app_id, kind), []).append(
+            self.__EncodeIndexPB(key.path()))
+
+    for (app_id, kind), paths in groups.items():
+      for index in self.__indexes[app_id].get(kind, []):
+        self.__DeleteRows(
+            conn, paths, self.__CompositeIndexTable(prefix, index))
+
+  def __AppTablePrefixes(self, app_id):
+    """Returns the table prefixes of all namespaces of an app.
+
+    Reads the namespaces from the database, so it includes those which
+    other processes created.
+    """
+    conn = self.__GetConnection(None)
+    try:
+      cursor = conn.cursor()
+      cursor.execute('SELECT name_space FROM Namespaces WHERE app_id = %s',
+                     (app_id,))
+      namespaces = [(app_id, str(row[0])) for row in cursor.fetchall()]
+    finally:
+      self.__ReleaseConnection(conn, None)
+    return [self.__GetTablePrefix(namespace) for namespace in namespaces]
+
+  def __BuildCompositeIndex(self, index):
+    """Fills the tables of a new composite index with existing entities.
+
+    The index must already be registered, so writes maintain it meanwhile.
+    Entities are read in batches LOCK IN SHARE MODE, so a batch sees the
+    latest version of entities which are written concurrently.
+
+    Args:
+      index: An entity_pb.CompositeIndex PB.
+    """
+    kind = index.definition().entity_type()
+    for prefix in self.__AppTablePrefixes(index.app_id()):
+      table = self.__CompositeIndexTable(prefix, index)
+      last_path = ''
+      while True:
+        conn = self.__GetConnection(None)
+        try:
+          cursor = conn.cursor()
+          cursor.execute(
+              'SELECT __path__, entity FROM %s_Entities '
+              'WHERE kind = %%s AND __path__ > %%s ORDER BY __path__ '
+              'LIMIT %d LOCK IN SHARE MODE' % (prefix, _FETCH_SIZE),
+              (kind, last_path))
+          rows = cursor.fetchall()
+          index_rows = []
+          for unused_path, entity in rows:
+            index_rows.extend(self.__CompositeIndexRows(
+                entity_pb.EntityProto(entity), index))
+          self.__InsertCompositeIndexRows(conn, table, index_rows)
+        finally:
+          self.__ReleaseConnection(conn, None)
+        if len(rows) < _FETCH_SIZE:
+          break
+        last_path = rows[-1][0]
+
+  def __DropCompositeIndex(self, index):
+    """Drops the tables of a composite index in all namespaces.
+
+    Args:
+      index: An entity_pb.CompositeIndex PB.
+    """
+    prefixes = self.__AppTablePrefixes(index.app_id())
+    conn = self.__pool.Acquire()
+    try:
+      cursor = conn.cursor()
+      for prefix in prefixes:
+        cursor.execute('DROP TABLE IF EXISTS %s' %
+                       self.__CompositeIndexTable(prefix, index))
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+  def __SetIndexes(self, app_id, index_proto, digest):
+    """Replaces the indexes of an app with stored ones.
+
+    Args:
+      app_id: The app ID.
+      index_proto: An encoded datastore_pb.CompositeIndices PB or None.
+      digest: The MD5 digest of index_proto as computed by MySQL.
+    """
+    index_map = {}
+    if index_proto:
+      for index in datastore_pb.CompositeIndices(index_proto).index_list():
+        kind = index.definition().entity_type()
+        index_map.setdefault(kind, []).append(index)
+    self.__indexes[app_id] = index_map
+    self.__index_digests[app_id] = digest
+
+  def __RefreshIndexes(self, conn, app_id, lock=''):
+    """Reloads the indexes of an app if another process changed them.
+
+    Args:
+      conn: An MySQL connection.
+      app_id: The app ID.
+      lock: A locking clause for reading the Apps row. Writes read it LOCK IN
+        SHARE MODE, so index changes wait for them and later writes see the
+        changes. Index changes read it FOR UPDATE.
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT MD5(indexes) FROM Apps WHERE app_id = %s' + lock,
+                   (app_id,))
+    row = cursor.fetchone()
+    digest = row and row[0]
+    self.__index_checks[app_id] = time.time()
+    if digest != self.__index_digests.get(app_id):
+      cursor.execute('SELECT indexes FROM Apps WHERE app_id = %s', (app_id,))
+      row = cursor.fetchone()
+      self.__SetIndexes(app_id, row and row[0], digest)
+
+  def __MaybeRefreshIndexes(self, app_id):
+    """Reloads the indexes of an app for queries, see __RefreshIndexes."""
+    checked = self.__index_checks.get(app_id, 0)
+    if time.time() - checked < _INDEX_REFRESH_INTERVAL:
+      return
+    conn = self.__GetConnection(None)
+    try:
+      self.__RefreshIndexes(conn, app_id)
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+  def __LockIndexes(self, conn, keys):
+    """Reloads the indexes of the apps of keys for a write."""
+    for app_id in set(key.app() for key in keys):
+      self.__RefreshIndexes(conn, app_id, ' LOCK IN SHARE MODE')
+
   def __WriteIndexData(self, conn, app):
     """Writes index data to disk.
 
@@ -712,9 +1839,11 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     for indexes in self.__indexes[app].values():
       indices.index_list().extend(indexes)
 
+    encoded = indices.Encode()
     cursor = conn.cursor()
     cursor.execute('UPDATE Apps SET indexes = %s WHERE app_id = %s',
-                   (app, indices.Encode()))
+                   (buffer(encoded), app))
+    self.__index_digests[app] = md5(encoded).hexdigest()
 
   def __GetTablePrefix(self, data):
     """Returns the namespace prefix for a query.
@@ -728,13 +1857,38 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       data = data.key()
     if not isinstance(data, tuple):
       data = (data.app(), data.name_space())
-    prefix = ('%s_%s' % data).replace('"', '""')
-    prefix = formatTableName(prefix)
-    if data not in self.__namespaces:
-      self.__namespaces.add(data)
-      self.__ConfigureNamespace(self.__connection, prefix, *data)
+    prefix = self.__namespaces.get(data)
+    if prefix is not None:
+      return prefix
+
+    self.__namespace_lock.acquire()
+    try:
+      prefix = self.__namespaces.get(data)
+      if prefix is None:
+        prefix = self.__FormatTablePrefix(data)
+        # Uses a connection of its own, since DDL statements implicitly
+        # commit the transaction of the connection they are executed on.
+        conn = self.__pool.Connect()
+        try:
+          cursor = conn.cursor()
+          cursor.execute('SELECT COUNT(*) FROM Namespaces '
+                         'WHERE app_id = %s AND name_space = %s', data)
+          registered = cursor.fetchone()[0]
+          if (not registered or self.__NamespaceTables(prefix, data[0]) -
+              self.__GetTables(conn, prefix)):
+            self.__ConfigureNamespace(conn, prefix, *data)
+        finally:
+          conn.close()
+        self.__namespaces[data] = prefix
+    finally:
+      self.__namespace_lock.release()
     return prefix
 
+  @staticmethod
+  def __FormatTablePrefix(namespace):
+    """Returns the table prefix for an (app_id, name_space) tuple."""
+    return formatTableName(('%s_%s' % namespace).replace('"', '""'))
+
   def __DeleteRows(self, conn, paths, table):
     """Deletes rows from a table.
 
@@ -750,168 +1904,626 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     cursor.execute(sql_command, paths)
     return cursor.rowcount
 
-  def __DeleteEntityRows(self, conn, keys, table):
-    """Deletes rows from the specified table that index the keys provided.
+  def __DeleteRowsByValues(self, conn, table, columns, rows, in_column,
+                           condition=''):
+    """Deletes rows matching all of the given column values.
+
+    Rows which only differ in one column are matched by comparing the other
+    columns for equality and that column with IN, and the comparisons of all
+    groups are ORed. Unlike row constructors compared with IN, MySQL reads a
+    range of the primary key for every comparison. Statements are split like
+    those of __InsertRows.
 
     Args:
-      conn: A database connection.
-      keys: A list of keys to delete index entries for.
+      conn: An MySQL connection.
       table: The table to delete from.
+      columns: A list of column names.
+      rows: A list of tuples with a value for every column.
+      in_column: The column compared with IN.
+      condition: An SQL condition ANDed with the comparisons, e.g.
+        'count <= 0'.
     Returns:
-      The number of rows deleted.
+      The number of deleted rows.
+    """
+    if not rows:
+      return 0
+    index = list(columns).index(in_column)
+    groups = {}
+    for row in rows:
+      key = tuple(row[:index]) + tuple(row[index + 1:])
+      groups.setdefault(key, []).append(row[index])
+
+    statement = 'DELETE FROM %s WHERE (' % table
+    suffix = ')'
+    if condition:
+      suffix += ' AND ' + condition
+    limit = self.__max_packet - len(statement) - len(suffix) - _PACKET_HEADROOM
+    other_columns = list(columns[:index]) + list(columns[index + 1:])
+    comparisons = []
+    for key, values in sorted(groups.items()):
+      terms = ['%s = %s' % (column, conn.literal(value))
+               for column, value in zip(other_columns, key)]
+      terms.append('%s IN (' % in_column)
+      prefix = '(' + ' AND '.join(terms)
+      literals = []
+      size = len(prefix) + 2
+      for value in sorted(values):
+        literal = conn.literal(value)
+        if literals and size + len(literal) > limit:
+          comparisons.append(prefix + ','.join(literals) + '))')
+          literals = []
+          size = len(prefix) + 2
+        literals.append(literal)
+        size += len(literal) + 1
+      comparisons.append(prefix + ','.join(literals) + '))')
+    return self.__ExecuteSplit(conn, statement, comparisons, ' OR ', suffix)
+
+  def __GroupByNamespace(self, items):
+    """Groups entities or keys by namespace.
+
+    Args:
+      items: A list of entity_pb.EntityProto or entity_pb.Reference.
+    Returns:
+      A list of (prefix, items) tuples with the table prefix of every
+      namespace.
+    """
+    groups = {}
+    for item in items:
+      key = item
+      if isinstance(item, entity_pb.EntityProto):
+        key = item.key()
+      groups.setdefault((key.app(), key.name_space()), []).append(item)
+    return [(self.__GetTablePrefix(namespace), group)
+            for namespace, group in groups.items()]
+
+  def __InsertRows(self, conn, statement, rows, suffix=''):
+    """Inserts rows with as few multi-row statements as possible.
+
+    Statements are split so that none exceeds the server's
+    max_allowed_packet.
+
+    Args:
+      conn: An MySQL connection.
+      statement: An INSERT or REPLACE statement up to and including VALUES.
+      rows: A list of rows.
+      suffix: Appended to every statement, e.g. an ON DUPLICATE KEY UPDATE
+        clause.
+    Returns:
+      The number of affected rows.
     """
-    keys = sorted((x.app(), x.name_space(), x) for x in keys)
-    for (app_id, ns), group in itertools.groupby(keys, lambda x: x[:2]):
-      path_strings = [self.__EncodeIndexPB(x[2].path()) for x in group]
-      prefix = self.__GetTablePrefix((app_id, ns))
-      return self.__DeleteRows(conn, path_strings, '%s_%s' % (prefix, table))
+    if not rows:
+      return 0
+    return self.__ExecuteSplit(
+        conn, statement,
+        ['(%s)' % ','.join(conn.literal(tuple(row))) for row in rows], ',',
+        suffix)
+
+  def __ExecuteSplit(self, conn, statement, parts, separator, suffix=''):
+    """Executes a statement whose parts are split across statements.
 
-  def __DeleteIndexEntries(self, conn, keys):
-    """Deletes entities from the index.
+    Statements are split so that none exceeds the server's
+    max_allowed_packet.
 
     Args:
       conn: An MySQL connection.
-      keys: A list of keys to delete.
+      statement: The statement up to the first part.
+      parts: A list of SQL strings.
+      separator: Joins the parts of a statement.
+      suffix: Appended to every statement.
+    Returns:
+      The number of affected rows.
+    """
+    limit = self.__max_packet - len(statement) - len(suffix) - _PACKET_HEADROOM
+    cursor = conn.cursor()
+    affected = 0
+    values = []
+    size = 0
+    for value in parts:
+      if values and size + len(value) > limit:
+        cursor.execute(statement + separator.join(values) + suffix)
+        affected += cursor.rowcount
+        values = []
+        size = 0
+      values.append(value)
+      size += len(value) + len(separator)
+    cursor.execute(statement + separator.join(values) + suffix)
+    return affected + cursor.rowcount
+
+  def __InsertEntities(self, conn, prefix, entities):
+    """Inserts or updates entities in the DB.
+
+    Args:
+      conn: A database connection.
+      prefix: The namespace prefix of the entities.
+      entities: A list of entities to store.
+    """
+    rows = [(self.__EncodeIndexPB(e.key().path()),
+             self.__GetEntityKind(e),
+             buffer(e.Encode())) for e in entities]
+    self.__InsertRows(
+        conn, 'REPLACE INTO %s_Entities VALUES ' % prefix, rows)
+
+  def __GetStoredEntities(self, conn, prefix, entities):
+    """Reads the stored versions of entities which are about to be written.
+
+    The rows stay locked until the end of the transaction, so concurrent
+    writes of the same entities can't interleave with the index update.
+
+    Args:
+      conn: A database connection.
+      prefix: The namespace prefix of the entities.
+      entities: A list of entities to be written or keys to be deleted.
+    Returns:
+      A list of (stored, entity) tuples where stored is None for new
+      entities. Entities written more than once only appear in their last
+      version.
+    """
+    latest = {}
+    for entity in entities:
+      key = entity
+      if isinstance(entity, entity_pb.EntityProto):
+        key = entity.key()
+      latest[str(self.__EncodeIndexPB(key.path()))] = entity
+
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT __path__, entity FROM %s_Entities '
+        'WHERE __path__ IN (%s) FOR UPDATE' % (
+            prefix, self.__MakeParamList(len(latest))),
+        latest.keys())
+    stored = dict((path, entity_pb.EntityProto(entity))
+                  for path, entity in cursor.fetchall())
+
+    return [(stored.get(path), entity) for path, entity in latest.items()]
+
+  def __PropertyRows(self, entity):
+    """Returns the set of EntitiesByProperty rows for an entity."""
+    kind = self.__GetEntityKind(entity)
+    path = self.__EncodeIndexPB(entity.key().path())
+    return set((kind, p.name(),
+                self.__EncodeIndexValue(self.__EncodeIndexPB(p.value())),
+                path)
+               for p in entity.property_list())
+
+  def __UpdateIndexEntries(self, conn, prefix, changes):
+    """Writes the index rows which changed with entities.
+
+    Only the rows of property values which were removed or added get
+    deleted or inserted.
+
+    Args:
+      conn: A database connection.
+      prefix: The namespace prefix of the entities.
+      changes: A list of (stored, entity) tuples as returned by
+        __GetStoredEntities.
+    Returns:
+      A (deletes, inserts) tuple with the lists of removed and added rows.
+    """
+    table = '%s_EntitiesByProperty' % prefix
+    deletes, inserts = [], []
+    for stored, entity in changes:
+      new_rows = self.__PropertyRows(entity)
+      old_rows = set()
+      if stored is not None:
+        old_rows = self.__PropertyRows(stored)
+      deletes.extend(old_rows - new_rows)
+      inserts.extend(new_rows - old_rows)
+
+    if table in self.__legacy_tables:
+      # Rows of earlier versions may hold untruncated values.
+      paths = [self.__EncodeIndexPB(entity.key().path())
+               for stored, entity in changes if stored is not None]
+      if paths:
+        self.__DeleteRows(conn, paths, table)
+      rows = []
+      for stored, entity in changes:
+        rows.extend(self.__PropertyRows(entity))
+      self.__InsertPropertyRows(conn, table, rows)
+    else:
+      self.__DeleteRowsByValues(
+          conn, table, ('kind', 'name', 'value', '__path__'), deletes, 'value')
+      self.__InsertPropertyRows(conn, table, inserts)
+    return deletes, inserts
+
+  def __InsertPropertyRows(self, conn, table, rows):
+    """Inserts rows into an EntitiesByProperty table.
+
+    Tables of earlier versions are keyed by an md5 hash of the row. They may
+    get upgraded by another process at any time, so inserting a hash falls
+    back to the current layout once the table lost its hash column.
+
+    Args:
+      conn: A database connection.
+      table: The table name.
+      rows: A list of (kind, name, value, __path__) tuples.
+    """
+    if not rows:
+      return
+    if table in self.__legacy_tables:
+      hashed_rows = []
+      for row in rows:
+        hashed_index = md5(''.join(row[:2]))
+        hashed_index.update(row[2])
+        hashed_index.update(row[3])
+        hashed_rows.append(tuple(row) + (hashed_index.hexdigest(),))
+      try:
+        self.__InsertRows(
+            conn, 'INSERT IGNORE INTO %s '
+            '(kind, name, value, __path__, hashed_index) VALUES ' % table,
+            hashed_rows)
+        return
+      except MySQLdb.OperationalError, e:
+        if e.args[0] != MySQLdb.constants.ER.BAD_FIELD_ERROR:
+          raise
+        self.__legacy_tables.discard(table)
+    self.__InsertRows(
+        conn, 'INSERT IGNORE INTO %s (kind, name, value, __path__) VALUES '
+        % table, rows)
+
+  def __BuildStats(self, conn, prefix):
+    """Creates and fills the statistics tables of an existing namespace.
+
+    Counts are overwritten rather than added, so processes starting at the
+    same time may both fill the tables.
+
+    Args:
+      conn: An MySQL connection.
+      prefix: The namespace prefix.
+    """
+    format_args = {'prefix': prefix, 'length': _MAX_KEY_PART_LENGTH}
+    cursor = conn.cursor()
+    for sql_command in _STATS_SCHEMA:
+      cursor.execute(sql_command % format_args)
+    cursor.execute(
+        'INSERT INTO %(prefix)s_KindStats (kind, count, bytes) '
+        'SELECT kind, COUNT(*), SUM(LENGTH(entity)) '
+        'FROM %(prefix)s_Entities GROUP BY kind '
+        'ON DUPLICATE KEY UPDATE count = VALUES(count), '
+        'bytes = VALUES(bytes)' % format_args)
+    cursor.execute(
+        'INSERT INTO %(prefix)s_PropertyStats '
+        '(kind, name, tag, count, sample) '
+        'SELECT kind, name, LEFT(value, 1), COUNT(*), '
+        "IFNULL(MIN(IF(LENGTH(value) < %(length)d, value, NULL)), '') "
+        'FROM %(prefix)s_EntitiesByProperty '
+        'GROUP BY kind, name, LEFT(value, 1) '
+        'ON DUPLICATE KEY UPDATE count = VALUES(count)' % format_args)
+    conn.commit()
+
+  def __DeleteEmptyStats(self, conn, table, columns, keys):
+    """Deletes the rows of a statistics table whose count dropped to zero.
+
+    Args:
+      conn: An MySQL connection.
+      table: The table name.
+      columns: The primary key columns.
+      keys: A list of primary key tuples.
+    Returns:
+      The number of deleted rows.
+    """
+    return self.__DeleteRowsByValues(
+        conn, table, columns, keys, columns[-1], 'count <= 0')
+
+  def __StatsChanges(self, prefix, changes, deletes, inserts):
+    """Returns the statistics changes of written entities.
+
+    Args:
+      prefix: The namespace prefix of the entities.
+      changes: A list of (stored, entity) tuples, stored is None for new
+        and entity is None for deleted entities.
+      deletes: A list of removed EntitiesByProperty rows.
+      inserts: A list of added EntitiesByProperty rows.
+    Returns:
+      A (prefix, kinds, properties) tuple. kinds maps kinds to (count,
+      bytes) and properties maps (kind, name, tag) tuples to (count, sample)
+      changes.
+    """
+    kinds = {}
+    for stored, entity in changes:
+      for pb, sign in ((stored, -1), (entity, 1)):
+        if pb is not None:
+          kind = self.__GetEntityKind(pb)
+          count, size = kinds.get(kind, (0, 0))
+          kinds[kind] = (count + sign, size + sign * pb.ByteSize())
+
+    properties = {}
+    for rows, sign in ((deletes, -1), (inserts, 1)):
+      for kind, name, value, _ in rows:
+        key = (kind, name, value[:1])
+        if _IsTruncated(value):
+          # Truncated values can't be decoded by GetSchema.
+          value = ''
+        count, sample = properties.get(key, (0, value))
+        properties[key] = (count + sign, sample or value)
+    return prefix, kinds, properties
+
+  def __AddStats(self, changes, flush=True):
+    """Adds the statistics changes of committed writes.
+
+    Args:
+      changes: A list of tuples as returned by __StatsChanges.
+      flush: Whether to write the summed changes if they are due.
+    """
+    self.__stats_lock.acquire()
+    try:
+      for prefix, kinds, properties in changes:
+        pending_kinds, pending_properties = self.__stats.setdefault(
+            prefix, ({}, {}))
+        for kind, (count, size) in kinds.items():
+          old_count, old_size = pending_kinds.get(kind, (0, 0))
+          pending_kinds[kind] = (old_count + count, old_size + size)
+        for key, (count, sample) in properties.items():
+          old_count, old_sample = pending_properties.get(key, (0, sample))
+          pending_properties[key] = (old_count + count,
+                                     old_sample or sample)
+      due = time.time() - self.__stats_flushed >= _STATS_FLUSH_INTERVAL
+    finally:
+      self.__stats_lock.release()
+
+    if flush and due:
+      try:
+        self.__FlushStats()
+      except MySQLdb.Error, e:
+        logging.warning('Failed to write statistics: %s', e)
+
+  def __FlushStats(self):
+    """Writes the summed statistics changes in a transaction of their own.
+
+    Changes which couldn't be written are kept for the next flush.
+    """
+    self.__stats_lock.acquire()
+    try:
+      pending = self.__stats
+      self.__stats = {}
+      self.__stats_flushed = time.time()
+    finally:
+      self.__stats_lock.release()
+    if not pending:
+      return
+
+    changed = False
+    conn = self.__GetConnection(None)
+    try:
+      for prefix in sorted(pending):
+        kinds, properties = pending[prefix]
+        changed |= self.__WriteStats(conn, prefix, kinds, properties)
+    except:
+      self.__ReleaseConnection(conn, None, rollback=True)
+      self.__AddStats([(prefix, kinds, properties)
+                       for prefix, (kinds, properties) in pending.items()],
+                      flush=False)
+      raise
+    self.__ReleaseConnection(conn, None)
+
+    if changed:
+      self.__schema_cache.clear()
+
+  def __WriteStats(self, conn, prefix, kinds, properties):
+    """Adds statistics changes to the statistics tables.
+
+    Rows are updated in primary key order, so concurrent flushes don't
+    deadlock.
+
+    Args:
+      conn: A database connection.
+      prefix: The namespace prefix.
+      kinds: Maps kinds to (count, bytes) changes.
+      properties: Maps (kind, name, tag) tuples to (count, sample) changes.
+    Returns:
+      True if a kind, a property or a value type appeared or disappeared.
+    """
+    kind_rows = sorted((kind, count, size)
+                       for kind, (count, size) in kinds.items()
+                       if count or size)
+    property_rows = sorted(key + value for key, value in properties.items()
+                           if value[0])
+
+    changed = self.__InsertRows(
+        conn, 'INSERT INTO %s_KindStats (kind, count, bytes) VALUES ' % prefix,
+        kind_rows, ' ON DUPLICATE KEY UPDATE count = count + VALUES(count), '
+        'bytes = bytes + VALUES(bytes)') < 2 * len(kind_rows)
+    changed |= self.__InsertRows(
+        conn, 'INSERT INTO %s_PropertyStats (kind, name, tag, count, sample) '
+        'VALUES ' % prefix, property_rows,
+        ' ON DUPLICATE KEY UPDATE count = count + VALUES(count), '
+        "sample = IF(sample = '', VALUES(sample), sample)"
+        ) < 2 * len(property_rows)
+
+    changed |= self.__DeleteEmptyStats(
+        conn, '%s_KindStats' % prefix, ('kind',),
+        [row[:1] for row in kind_rows if row[1] < 0]) > 0
+    changed |= self.__DeleteEmptyStats(
+        conn, '%s_PropertyStats' % prefix, ('kind', 'name', 'tag'),
+        [row[:3] for row in property_rows if row[3] < 0]) > 0
+    return changed
+
+  def __ReserveIds(self, prefix, size):
+    """Atomically reserves a block of IDs in a namespace's shared counter.
+
+    Uses a connection of its own, so the counter row isn't locked until the
+    end of the calling transaction, and a rolled back transaction can't hand
+    out the block a second time.
+
+    Args:
+      prefix: A table namespace prefix.
+      size: Number of IDs to reserve.
+
+    Returns:
+      The first reserved ID.
+    """
+    conn = self.__GetConnection(None)
+    try:
+      cursor = conn.cursor()
+      cursor.execute(
+          'UPDATE IdSeq SET next_id = LAST_INSERT_ID(next_id + %s) '
+          'WHERE prefix = %s', (size, prefix))
+      assert int(cursor.rowcount) == 1
+      return int(conn.insert_id()) - size
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+  def __AllocateIds(self, prefix, size=None, max=None):
+    """Allocates IDs.
+
+    Args:
+      prefix: A table namespace prefix.
+      size: Number of IDs to allocate.
+      max: Upper bound of IDs to allocate.
+
+    Returns:
+      int: The beginning of a range of size IDs
     """
-    self.__DeleteEntityRows(conn, keys, 'EntitiesByProperty')
+    if size is not None:
+      return self.__id_allocator.allocate(prefix, size)
 
-  def __InsertEntities(self, conn, entities):
-    """Inserts or updates entities in the DB.
+    # Unused IDs of this process' block may not exceed max.
+    self.__id_allocator.discard(prefix)
+    conn = self.__GetConnection(None)
+    try:
+      cursor = conn.cursor()
+      cursor.execute(
+          'UPDATE IdSeq SET next_id = GREATEST(LAST_INSERT_ID(next_id), %s) '
+          'WHERE prefix = %s', (max + 1, prefix))
+      cursor.execute('SELECT LAST_INSERT_ID()')
+      return int(cursor.fetchone()[0])
+    finally:
+      self.__ReleaseConnection(conn, None)
+
+  def __GetEntityGroup(self, key):
+    """Returns the (prefix, root) tuple identifying the entity group of a key.
 
     Args:
-      conn: A database connection.
-      entities: A list of entities to store.
+      key: An entity_pb.Reference.
     """
+    root = entity_pb.Path()
+    root.add_element().CopyFrom(key.path().element(0))
+    return (self.__GetTablePrefix(key), str(self.__EncodeIndexPB(root)))
 
-    def RowGenerator(entities):
-      for unused_prefix, e in entities:
-        yield (self.__EncodeIndexPB(e.key().path()),
-               self.__GetEntityKind(e),
-               buffer(e.Encode()))
-
-    entities = sorted((self.__GetTablePrefix(x), x) for x in entities)
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      cursor = conn.cursor()
-      group_rows = RowGenerator(group)
-      cursor.executemany(
-          'REPLACE INTO %s_Entities VALUES (%%s, %%s, %%s)' % prefix,
-          group_rows)
+  def __EnlistEntityGroup(self, tx, keys):
+    """Joins a transaction to the entity group of the keys.
 
-  def __InsertIndexEntries(self, conn, entities):
-    """Inserts index entries for the supplied entities.
+    The first call of a transaction reads the version of the entity group,
+    which is checked and incremented when the transaction commits. It has
+    to precede all other reads of the transaction, which then see the same
+    snapshot.
 
     Args:
-      conn: A database connection.
-      entities: A list of entities to create index entries for.
+      tx: A _Transaction instance.
+      keys: A list of entity_pb.Reference instances.
+    Raises:
+      apiproxy_errors.ApplicationError: if the keys belong to another entity
+        group than the transaction.
     """
+    for key in keys:
+      entity_group = self.__GetEntityGroup(key)
+      if tx.entity_group is None:
+        cursor = tx.connection.cursor()
+        cursor.execute(
+            'SELECT version FROM EntityGroups '
+            'WHERE prefix = %s AND root = %s', entity_group)
+        row = cursor.fetchone()
+        tx.entity_group = entity_group
+        tx.version = row and row[0] or 0
+      elif entity_group != tx.entity_group:
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            'Cannot operate on different entity groups in a transaction.')
 
-    def RowGenerator(entities):
-      for unused_prefix, e in entities:
-        for p in e.property_list():
-          p_vals = [self.__GetEntityKind(e), p.name(), self.__EncodeIndexPB(p.value()), self.__EncodeIndexPB(e.key().path())]
-
-          hashed_index = md5(''.join(p_vals[:2]))
-          hashed_index.update(p_vals[2]) #buffer values cannot be joined into a string
-          hashed_index.update(p_vals[3])
-          p_vals.append( hashed_index.hexdigest() )
+  def __LockEntityGroup(self, tx):
+    """Locks the version row of a transaction's entity group for the commit.
 
-          yield p_vals
-    entities = sorted((self.__GetTablePrefix(x), x) for x in entities)
-    for prefix, group in itertools.groupby(entities, lambda x: x[0]):
-      cursor = conn.cursor()
-      cursor.executemany(
-        'INSERT IGNORE INTO %s_EntitiesByProperty '
-        '(kind, name, value, __path__, hashed_index)  '
-        'VALUES '
-        '(%%s, %%s, %%s, %%s, %%s)' % prefix,
-        RowGenerator(group))
-
-  def __AllocateIds(self, conn, prefix, size=None, max=None):
-    """Allocates IDs.
+    Transactions of the same entity group wait for each other here, while
+    all others proceed. The version must not have changed since the
+    transaction read it, otherwise another transaction committed meanwhile.
 
     Args:
-      conn: A MySQL connection object.
-      prefix: A table namespace prefix.
-      size: Number of IDs to allocate.
-      max: Upper bound of IDs to allocate.
-
-    Returns:
-      int: The beginning of a range of size IDs
+      tx: A _Transaction instance.
+    Raises:
+      apiproxy_errors.ApplicationError: if the entity group was modified
+        concurrently or the lock couldn't be acquired.
     """
-    self.__id_lock.acquire()
-    ret = None
-    cursor = conn.cursor()
-    if size is not None:
-      assert size > 0
-      next_id, block_size = self.__id_map.get(prefix, (0, 0))
-      if not block_size:
-        block_size = (size / 1000 + 1) * 1000
-        cursor.execute('SELECT next_id FROM IdSeq WHERE prefix = %s LIMIT 1',
-                       (prefix,))
-        next_id = cursor.fetchone()[0]
-        cursor.execute(
-            'UPDATE IdSeq SET next_id = next_id + %s WHERE prefix = %s',
-            (block_size, prefix))
-        assert int(cursor.rowcount) == 1
-
-      if size > block_size:
-        cursor.execute('SELECT next_id FROM IdSeq WHERE prefix = %s LIMIT 1',
-                       (prefix,))
-        ret = cursor.fetchone()[0]
-        cursor.execute(
-            'UPDATE IdSeq SET next_id = next_id + %s WHERE prefix = %s',
-            (size, prefix))
-        assert int(cursor.rowcount) == 1
-      else:
-        ret = next_id;
-        next_id += size
-        block_size -= size
-        self.__id_map[prefix] = (next_id, block_size)
-    else:
-      cursor.execute('SELECT next_id FROM IdSeq WHERE prefix = %s LIMIT 1',
-                       (prefix,))
-      ret = cursor.fetchone()[0]
-      if max and max >= ret:
+    cursor = tx.connection.cursor()
+    start = time.time()
+    try:
+      cursor.execute(
+          'SELECT version FROM EntityGroups '
+          'WHERE prefix = %s AND root = %s FOR UPDATE', tx.entity_group)
+      row = cursor.fetchone()
+      conflict = (row and row[0] or 0) != tx.version
+      if not conflict:
         cursor.execute(
-            'UPDATE IdSeq SET next_id = %s WHERE prefix = %s',
-            (max + 1, prefix))
-        assert int(cursor.rowcount) == 1
-    self.__id_lock.release()
-    return ret
+            'INSERT INTO EntityGroups VALUES (%s, %s, 1) '
+            'ON DUPLICATE KEY UPDATE version = version + 1', tx.entity_group)
+    except MySQLdb.OperationalError, e:
+      if e.args[0] not in _LOCK_ERRORS:
+        raise
+      conflict = True
+    self.__RecordLockWait(tx.entity_group, time.time() - start, conflict)
+    if conflict:
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.CONCURRENT_TRANSACTION,
+          'Concurrency exception.')
+
+  def __TouchEntityGroups(self, conn, keys):
+    """Increments the versions of the entity groups of the keys.
 
-  def __AcquireLockForEntityGroup(self, conn, entity_group='', timeout=30):
-    """Acquire a lock for a specified entity group.
+    Non-transactional writes call this within their database transaction, so
+    that transactions which read the entity groups before fail on commit.
 
     Args:
-      conn: A MySQL connection.
-      entity_group: An entity group.
-      timeout: Number of seconds till a lock expires.
+      conn: The connection of the write.
+      keys: A list of entity_pb.Reference instances.
     """
+    entity_groups = sorted(set(self.__GetEntityGroup(key) for key in keys))
+    if not entity_groups:
+      return
+    params = []
+    for entity_group in entity_groups:
+      params.extend(entity_group)
     cursor = conn.cursor()
-    lock_str = self.__app_id + '_' + entity_group
-    cursor.execute("SELECT GET_LOCK('%s', %i);" % (lock_str, timeout))
-    conn.commit()
+    cursor.execute(
+        'INSERT INTO EntityGroups VALUES %s '
+        'ON DUPLICATE KEY UPDATE version = version + 1' % ','.join(
+            ['(%s, %s, 1)'] * len(entity_groups)), params)
+    cursor.close()
 
-  def __ReleaseLockForEntityGroup(self, conn, entity_group=''):
-    """Release transaction lock if present.
+  def __RecordLockWait(self, entity_group, seconds, conflict):
+    """Adds an entity group lock to the lock statistics.
 
     Args:
-      conn: A MySQL connection.
-      entity_group: An entity group.
+      entity_group: The (prefix, root) tuple of the entity group.
+      seconds: Number of seconds spent acquiring the lock.
+      conflict: Whether the transaction failed.
     """
-    cursor = conn.cursor()
-    lock_str = self.__app_id + '_' + entity_group
-    cursor.execute("SELECT RELEASE_LOCK('%s');" % lock_str)
-    conn.commit()
-
-  @staticmethod
-  def __ExtractEntityGroupFromKeys(keys):
-    """Extracts entity group."""
+    self.__lock_stats_lock.acquire()
+    try:
+      stats = self.__lock_stats
+      stats['locks'] += 1
+      stats['lock_wait_time'] += seconds
+      stats['max_lock_wait_time'] = max(stats['max_lock_wait_time'], seconds)
+      if conflict:
+        stats['conflicts'] += 1
+    finally:
+      self.__lock_stats_lock.release()
+    if self.__verbose:
+      logging.debug('Waited %.3fs for entity group %s in %s%s', seconds,
+                    entity_group[1], entity_group[0],
+                    conflict and ', concurrent transaction' or '')
 
-    types = set([k.path().element_list()[-1].type() for k in keys])
-    assert len(types) == 1
+  def LockStats(self):
+    """Returns statistics about the entity group locks of commits.
 
-    return types.pop()
+    Returns:
+      A dict with the number of locks taken ('locks'), the total and the
+      maximum number of seconds spent waiting for them ('lock_wait_time',
+      'max_lock_wait_time') and the number of commits which failed with
+      CONCURRENT_TRANSACTION ('conflicts').
+    """
+    self.__lock_stats_lock.acquire()
+    try:
+      return dict(self.__lock_stats)
+    finally:
+      self.__lock_stats_lock.release()
 
   def MakeSyncCall(self, service, call, request, response):
     """The main RPC entry point. service must be 'datastore_v3'."""
@@ -922,15 +2534,32 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       super(DatastoreMySQLStub, self).MakeSyncCall(
         service, call, request, response)
     except MySQLdb.OperationalError, e:
-      err_code, msg = e
+      err_code, msg = e.args[:2]
+      if err_code not in _CONNECTION_LOST_ERRORS:
+        raise
+      # The server went away, so the other idle connections are gone as well.
+      self.__pool.DiscardIdle()
+      if isinstance(request, datastore_pb.Transaction) or (
+          hasattr(request, 'transaction') and
+          self.__InTransaction(request.transaction())):
+        # The transaction's connection is lost along with its state.
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.INTERNAL_ERROR, msg)
       # Automatically try reconnect when connection is lost.
-      if err_code == MySQLdb.constants.CR.SERVER_GONE_ERROR:
-        logging.error("%s. Trying to reconnect." % msg)
-        self.__connection = MySQLdb.connect(**self.__database_info_dict)
-        self.MakeSyncCall(service, call, request, response)
+      logging.error("%s. Trying to reconnect." % msg)
+      response.Clear()
+      super(DatastoreMySQLStub, self).MakeSyncCall(
+        service, call, request, response)
 
     self.AssertPbIsInitialized(response)
 
+  def CreateRPC(self):
+    """Returns an RPC which runs its call in a worker thread.
+
+    Calls of the same transaction run one after another on its connection.
+    """
+    return typhoonae.async_rpc.AsyncRPC(self.__rpc_pool, stub=self)
+
   def AssertPbIsInitialized(self, pb):
     """Raises an exception if the given PB is not initialized and valid."""
     explanation = []
@@ -942,27 +2571,52 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     return dict((pb, times) for pb, times in self.__query_history.items() if
                 pb.app() == self.__app_id)
 
-  def __PutEntities(self, conn, entities):
-    self.__DeleteIndexEntries(conn, [e.key() for e in entities])
-    self.__InsertEntities(conn, entities)
-    self.__InsertIndexEntries(conn, entities)
+  def Namespaces(self):
+    """Returns the namespaces of the app, always including ''."""
+    conn = self.__GetConnection(None)
+    cursor = conn.cursor()
+    try:
+      cursor.execute('SELECT name_space FROM Namespaces WHERE app_id = %s',
+                     (self.__app_id,))
+      return sorted(set([''] + [str(row[0]) for row in cursor.fetchall()]))
+    finally:
+      self.__ReleaseConnection(conn, None)
 
-  def __DeleteEntities(self, conn, keys):
-    self.__DeleteIndexEntries(conn, keys)
-    self.__DeleteEntityRows(conn, keys, 'Entities')
+  def __PutEntities(self, conn, entities, stats):
+    """Writes entities and appends their statistics changes to stats."""
+    self.__LockIndexes(conn, [entity.key() for entity in entities])
+    for prefix, group in self.__GroupByNamespace(entities):
+      changes = self.__GetStoredEntities(conn, prefix, group)
+      self.__InsertEntities(conn, prefix, [entity for _, entity in changes])
+      deletes, inserts = self.__UpdateIndexEntries(conn, prefix, changes)
+      self.__UpdateCompositeIndexEntries(conn, prefix, changes)
+      stats.append(self.__StatsChanges(prefix, changes, deletes, inserts))
+
+  def __DeleteEntities(self, conn, keys, stats):
+    """Deletes entities and appends their statistics changes to stats."""
+    self.__LockIndexes(conn, keys)
+    for prefix, group in self.__GroupByNamespace(keys):
+      changes = [(stored, None) for stored, _ in
+                 self.__GetStoredEntities(conn, prefix, group)
+                 if stored is not None]
+      deletes = []
+      for stored, _ in changes:
+        deletes.extend(self.__PropertyRows(stored))
+      paths = [self.__EncodeIndexPB(key.path()) for key in group]
+      self.__DeleteRows(conn, paths, '%s_EntitiesByProperty' % prefix)
+      self.__DeleteCompositeIndexEntries(conn, prefix, group)
+      self.__DeleteRows(conn, paths, '%s_Entities' % prefix)
+      stats.append(self.__StatsChanges(prefix, changes, deletes, []))
 
   def _Dynamic_Put(self, put_request, put_response):
+    stats = []
     conn = self.__GetConnection(put_request.transaction())
     try:
       entities = put_request.entity_list()
       keys = [e.key() for e in entities]
-      if put_request.has_transaction():
-        if (put_request.transaction() in self.__transactions
-            and not self.__inside_tx):
-          entity_group = self.__ExtractEntityGroupFromKeys(keys)
-          self.__inside_tx = True
-          self.__transactions[put_request.transaction()] = entity_group
-          self.__AcquireLockForEntityGroup(self.__connection, entity_group)
+      tx = None
+      if self.__InTransaction(put_request.transaction()):
+        tx = self.__GetTransaction(put_request.transaction())
       for entity in entities:
         self.__ValidateKey(entity.key())
 
@@ -978,7 +2632,7 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
 
         last_path = entity.key().path().element_list()[-1]
         if last_path.id() == 0 and not last_path.has_name():
-          id_ = self.__AllocateIds(conn, self.__GetTablePrefix(entity.key()), 1)
+          id_ = self.__AllocateIds(self.__GetTablePrefix(entity.key()), 1)
           last_path.set_id(id_)
 
           assert entity.entity_group().element_size() == 0
@@ -990,62 +2644,74 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
           assert (entity.has_entity_group() and
                   entity.entity_group().element_size() > 0)
 
-        if put_request.transaction().handle():
-          self.__tx_writes[entity.key()] = entity
-          self.__tx_deletes.discard(entity.key())
-
-      if not put_request.transaction().handle():
-        self.__PutEntities(conn, entities)
+      if tx:
+        # Enlists after allocating IDs, new root entities form new groups.
+        self.__EnlistEntityGroup(tx, keys)
+        for entity in entities:
+          tx.writes[entity.key()] = entity
+          tx.deletes.discard(entity.key())
+      else:
+        self.__TouchEntityGroups(conn, keys)
+        self.__PutEntities(conn, entities, stats)
       put_response.key_list().extend([e.key() for e in entities])
     finally:
       self.__ReleaseConnection(conn, put_request.transaction())
+    self.__AddStats(stats)
 
   def _Dynamic_Get(self, get_request, get_response):
     conn = self.__GetConnection(get_request.transaction())
     try:
       keys = get_request.key_list()
-      if get_request.has_transaction():
-        if (get_request.transaction() in self.__transactions
-            and not self.__inside_tx):
-          entity_group = self.__ExtractEntityGroupFromKeys(keys)
-          self.__inside_tx = True
-          self.__transactions[get_request.transaction()] = entity_group
-          self.__AcquireLockForEntityGroup(self.__connection, entity_group)
       for key in keys:
         self.__ValidateAppId(key.app())
-        prefix = self.__GetTablePrefix(key)
-        cursor = conn.cursor()
+      if self.__InTransaction(get_request.transaction()):
+        self.__EnlistEntityGroup(
+            self.__GetTransaction(get_request.transaction()), keys)
+
+      # Fetches the entities of every namespace with a single statement.
+      entities = {}
+      cursor = conn.cursor()
+      for prefix, group in self.__GroupByNamespace(keys):
+        paths = list(set(str(self.__EncodeIndexPB(key.path()))
+                         for key in group))
         cursor.execute(
-            'SELECT entity FROM %s_Entities WHERE __path__ = %%s'%prefix,
-            (self.__EncodeIndexPB(key.path()),))
+            'SELECT __path__, entity FROM %s_Entities '
+            'WHERE __path__ IN (%s)' % (
+                prefix, self.__MakeParamList(len(paths))),
+            paths)
+        for path, entity in cursor.fetchall():
+          entities[(prefix, path)] = entity
+
+      for key in keys:
         group = get_response.add_entity()
-        row = cursor.fetchone()
-        if row:
-          group.mutable_entity().ParseFromString(row[0])
+        entity = entities.get((self.__GetTablePrefix(key),
+                               str(self.__EncodeIndexPB(key.path()))))
+        if entity is not None:
+          group.mutable_entity().ParseFromString(entity)
     finally:
       self.__ReleaseConnection(conn, get_request.transaction())
 
   def _Dynamic_Delete(self, delete_request, delete_response):
+    stats = []
     conn = self.__GetConnection(delete_request.transaction())
     try:
       keys = delete_request.key_list()
-      if delete_request.has_transaction():
-        if (delete_request.transaction() in self.__transactions
-            and not self.__inside_tx):
-          entity_group = self.__ExtractEntityGroupFromKeys(keys)
-          self.__inside_tx = True
-          self.__transactions[request.transaction()] = entity_group
-          self.__AcquireLockForEntityGroup(self.__connection, entity_group)
+      tx = None
+      if self.__InTransaction(delete_request.transaction()):
+        tx = self.__GetTransaction(delete_request.transaction())
+        self.__EnlistEntityGroup(tx, keys)
       for key in keys:
         self.__ValidateAppId(key.app())
-        if delete_request.transaction().handle():
-          self.__tx_deletes.add(key)
-          self.__tx_writes.pop(key, None)
+        if tx:
+          tx.deletes.add(key)
+          tx.writes.pop(key, None)
 
-      if not delete_request.transaction().handle():
-        self.__DeleteEntities(conn, delete_request.key_list())
+      if not tx:
+        self.__TouchEntityGroups(conn, keys)
+        self.__DeleteEntities(conn, keys, stats)
     finally:
       self.__ReleaseConnection(conn, delete_request.transaction())
+    self.__AddStats(stats)
 
   def __GenerateFilterInfo(self, filters, query):
     """Transform a list of filters into a more usable form.
@@ -1054,20 +2720,25 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       filters: A list of filter PBs.
       query: The query to generate filter info for.
     Returns:
-      A dict mapping property names to lists of (op, value) tuples.
+      A dict mapping property names to lists of (op, value) tuples. The
+      value of an IN filter is a list.
     """
     filter_info = {}
     for filt in filters:
-      assert filt.property_size() == 1
-      prop = filt.property(0)
-      value = prop.value()
-      if prop.name() == '__key__':
-        value = ReferencePropertyToReference(value.referencevalue())
-        assert value.app() == query.app()
-        assert value.name_space() == query.name_space()
-        value = value.path()
-      filter_info.setdefault(prop.name(), []).append(
-          (filt.op(), self.__EncodeIndexPB(value)))
+      values = []
+      for prop in filt.property_list():
+        value = prop.value()
+        if prop.name() == '__key__':
+          value = ReferencePropertyToReference(value.referencevalue())
+          assert value.app() == query.app()
+          assert value.name_space() == query.name_space()
+          value = value.path()
+        values.append(self.__EncodeIndexPB(value))
+      if filt.op() != datastore_pb.Query_Filter.IN:
+        assert len(values) == 1
+        values = values[0]
+      filter_info.setdefault(filt.property(0).name(), []).append(
+          (filt.op(), values))
     return filter_info
 
   def __GenerateOrderInfo(self, orders):
@@ -1096,6 +2767,127 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     ancestor_max = buffer(str(ancestor_min) + '\xfb\xff\xff\xff\x89')
     return ancestor_min, ancestor_max
 
+  @staticmethod
+  def __KeysetClause(orders, values, after, truncated=False):
+    """Returns a clause which compares rows with a position in sort order.
+
+    Args:
+      orders: A list of (column, direction) tuples.
+      values: The sort column values of the position.
+      after: If True, matches rows sorted after the position, otherwise rows
+        sorted before or at the position.
+      truncated: Whether the position may hold full values of truncated index
+        columns. Those get compared inclusively by their prefix, and the
+        TruncatedValueCheck of the query plan compares the full values.
+    Returns:
+      A (clause, params) tuple.
+    """
+    if len(values) != len(orders):
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.BAD_REQUEST,
+          'Cursor does not match query.')
+    inclusive = False
+    long_columns = [i for i, v in enumerate(values) if _IsTruncated(v)]
+    if truncated and long_columns:
+      orders = orders[:long_columns[0] + 1]
+      values = [v[:_MAX_KEY_PART_LENGTH] for v in values[:len(orders)]]
+      inclusive = True
+    values = [buffer(v) for v in values]
+
+    alternatives = []
+    params = []
+    for i, (column, direction) in enumerate(orders):
+      if after == (direction == datastore_pb.Query_Order.ASCENDING):
+        op = '>'
+      else:
+        op = '<'
+      terms = ['%s = %%s' % c for c, _ in orders[:i]]
+      terms.append('%s %s %%s' % (column, op))
+      alternatives.append('(%s)' % ' AND '.join(terms))
+      params.extend(values[:i + 1])
+    if not after or inclusive:
+      alternatives.append(
+          '(%s)' % ' AND '.join('%s = %%s' % c for c, _ in orders))
+      params.extend(values)
+
+    # Bounding the first column lets MySQL seek in the index.
+    column, direction = orders[0]
+    if after == (direction == datastore_pb.Query_Order.ASCENDING):
+      op = '>='
+    else:
+      op = '<='
+    clause = '%s %s %%s AND (%s)' % (column, op, ' OR '.join(alternatives))
+    return clause, [values[0]] + params
+
+  def __CursorPositions(self, query):
+    """Returns the sort column values of the start and end cursors of a
+    query, None for missing cursors."""
+    start = end = None
+    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
+      start = _DecodeCursorPosition(
+          query.compiled_cursor().position(0).start_key()) or None
+    if (query.has_end_compiled_cursor() and
+        query.end_compiled_cursor().position_size()):
+      end = _DecodeCursorPosition(
+          query.end_compiled_cursor().position(0).start_key()) or None
+    return start, end
+
+  def __CursorClauses(self, query, orders, truncated=False):
+    """Returns clauses which restrict a query to the range of its cursors.
+
+    Resuming from a cursor seeks past the last result it points at instead of
+    reading and skipping all rows before it.
+
+    Args:
+      query: A datastore_pb.Query PB.
+      orders: The (column, direction) tuples of the sort columns selected by
+        the query plan.
+      truncated: See __KeysetClause.
+    Returns:
+      A list of (clause, params) tuples.
+    """
+    clauses = []
+    start, end = self.__CursorPositions(query)
+    if start:
+      clauses.append(self.__KeysetClause(orders, start, True, truncated))
+    if end:
+      clauses.append(self.__KeysetClause(orders, end, False, truncated))
+    return clauses
+
+  def __StatKindQuery(self, query, filter_info, order_info):
+    """Serves __Stat_Kind__ queries from the KindStats table."""
+    if query.kind() != _STAT_KIND:
+      return None
+    self.__FlushStats()
+
+    filters = []
+    for filt in query.filter_list():
+      prop = filt.property(0)
+      if (prop.name() != 'kind_name' or filt.op() not in _OPERATOR_MAP or
+          not prop.value().has_stringvalue()):
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            '%s queries only support filters on kind_name.' % _STAT_KIND)
+      filters.append(('kind', filt.op(), prop.value().stringvalue()))
+
+    direction = datastore_pb.Query_Order.ASCENDING
+    if order_info:
+      if (len(order_info) > 1 or
+          order_info[0][0] not in ('kind_name', '__key__')):
+        raise apiproxy_errors.ApplicationError(
+            datastore_pb.Error.BAD_REQUEST,
+            '%s queries can only be sorted by kind_name.' % _STAT_KIND)
+      direction = order_info[0][1]
+    orders = [('kind', direction)]
+
+    params = []
+    query = ('SELECT kind, count, bytes FROM %s_KindStats %s %s' % (
+        self.__GetTablePrefix(query),
+        self.__CreateFilterString(
+            filters, params, self.__CursorClauses(query, orders)),
+        self.__CreateOrderString(orders)))
+    return query, params
+
   def  __KindQuery(self, query, filter_info, order_info):
     """Performs kind only, kind and ancestor, and ancestor only queries."""
     if not (set(filter_info.keys()) |
@@ -1121,11 +2913,11 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       orders = [('__path__', datastore_pb.Query_Order.ASCENDING)]
 
     params = []
-    query = ('SELECT Entities.__path__, Entities.entity, %s '
-             'FROM %s_Entities AS Entities %s %s' % (
-                 ','.join(x[0] for x in orders),
+    query = ('SELECT %s FROM %s_Entities AS Entities %s %s' % (
+                 self.__CreateSelectList(query, 'Entities.__path__', orders),
                  self.__GetTablePrefix(query),
-                 self.__CreateFilterString(filters, params),
+                 self.__CreateFilterString(
+                     filters, params, self.__CursorClauses(query, orders)),
                  self.__CreateOrderString(orders)))
     return query, params
 
@@ -1140,8 +2932,7 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     property_name = property_names.pop()
     filter_ops = filter_info.get(property_name, [])
 
-    if len([1 for o, _ in filter_ops
-            if o == datastore_pb.Query_Filter.EQUAL]) > 1:
+    if len([1 for o, _ in filter_ops if o in _EQUALITY_OPERATORS]) > 1:
       return None
 
     if len(order_info) > 1 or (order_info and order_info[0][0] == '__key__'):
@@ -1162,28 +2953,43 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       if property_name == '__key__':
         filters.append(('EntitiesByProperty.__path__', op, value))
       else:
-        filters.append(('value', op, value))
+        filters.extend(self.__IndexFilters('value', op, value))
 
     orders = [('EntitiesByProperty.kind', datastore_pb.Query_Order.ASCENDING),
               ('name', datastore_pb.Query_Order.ASCENDING)]
     if order_info:
       orders.append(('value', order_info[0][1]))
-    else:
+    elif datastore_pb.Query_Filter.IN not in [o for o, _ in filter_ops]:
       orders.append(('value', datastore_pb.Query_Order.ASCENDING))
     orders.append(('EntitiesByProperty.__path__',
                    datastore_pb.Query_Order.ASCENDING))
 
+    sort_columns = []
+    for column, direction in orders[2:]:
+      if column == 'value':
+        sort_columns.append((property_name, direction))
+      else:
+        sort_columns.append((None, direction))
+    check = self.__TruncatedValueCheck(
+        query, [(property_name, filter_ops)], sort_columns)
+
+    # Keys-only queries are answered from the index table alone.
+    if query.keys_only():
+      tables = '%s_EntitiesByProperty AS EntitiesByProperty' % prefix
+    else:
+      tables = ('%s_EntitiesByProperty AS EntitiesByProperty INNER JOIN '
+                '%s_Entities AS Entities USING (__path__)' % (prefix, prefix))
+
     params = []
     format_args = (
-        ','.join(x[0] for x in orders[2:]),
-        prefix,
-        prefix,
-        self.__CreateFilterString(filters, params),
+        self.__CreateSelectList(
+            query, 'EntitiesByProperty.__path__', orders[2:], check),
+        tables,
+        self.__CreateFilterString(
+            filters, params, self.__CursorClauses(query, orders[2:], True)),
         self.__CreateOrderString(orders))
-    query = ('SELECT Entities.__path__, Entities.entity, %s '
-             'FROM %s_EntitiesByProperty AS EntitiesByProperty INNER JOIN '
-             "%s_Entities AS Entities USING (__path__) %s %s" % format_args)
-    return query, params
+    query = 'SELECT %s FROM %s %s %s' % format_args
+    return query, params, check
 
   def __StarSchemaQueryPlan(self, query, filter_info, order_info):
     """Executes a query using a 'star schema' based on EntitiesByProperty.
@@ -1199,14 +3005,15 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       filter_info: A dict mapping properties filtered on to (op, value) tuples.
       order_info: A list of (property, direction) tuples.
     Returns:
-      (query, params): An SQL query string and list of parameters for it.
+      (query, params, check): An SQL query string, list of parameters for it
+      and the TruncatedValueCheck of its rows or None.
     """
     filter_sets = []
     for name, filter_ops in filter_info.items():
       filter_sets.extend((name, [x]) for x in filter_ops
-                         if x[0] == datastore_pb.Query_Filter.EQUAL)
+                         if x[0] in _EQUALITY_OPERATORS)
       ineq_ops = [x for x in filter_ops
-                  if x[0] != datastore_pb.Query_Filter.EQUAL]
+                  if x[0] not in _EQUALITY_OPERATORS]
       if ineq_ops:
         filter_sets.append((name, ineq_ops))
 
@@ -1233,7 +3040,8 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       filters.append(('%s.name' % join_name, datastore_pb.Query_Filter.EQUAL,
                       name))
       for op, value in filter_ops:
-        filters.append(('%s.value' % join_name, op, buffer(value)))
+        filters.extend(
+            self.__IndexFilters('%s.value' % join_name, op, value))
       if query.has_ancestor():
         amin, amax = self.__GetPrefixRange(query.ancestor().path())
         filters.append(('%s.__path__' % join_name,
@@ -1242,24 +3050,116 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
                         datastore_pb.Query_Filter.LESS_THAN, amax))
 
     orders = []
+    sort_columns = []
     for prop, order in order_info:
       if prop == '__key__':
         orders.append(('Entities.__path__', order))
+        sort_columns.append((None, order))
       else:
-        prop = '%s.value' % (join_name_map[prop],)
-        orders.append((prop, order))
+        orders.append(('%s.value' % (join_name_map[prop],), order))
+        sort_columns.append((prop, order))
     if not order_info or order_info[-1][0] != '__key__':
       orders.append(('Entities.__path__', datastore_pb.Query_Order.ASCENDING))
+      sort_columns.append((None, datastore_pb.Query_Order.ASCENDING))
+    check = self.__TruncatedValueCheck(query, filter_sets, sort_columns)
 
     params = []
     format_args = (
-        ','.join(x[0] for x in orders),
+        self.__CreateSelectList(query, 'Entities.__path__', orders, check),
         prefix,
         ' '.join(joins),
-        self.__CreateFilterString(filters, params),
+        self.__CreateFilterString(
+            filters, params, self.__CursorClauses(query, orders, True)),
+        self.__CreateOrderString(orders))
+    query = ('SELECT %s FROM %s_Entities AS Entities %s %s %s' % format_args)
+    return query, params, check
+
+  def __CompositeIndexQuery(self, query, filter_info, order_info):
+    """Performs queries satisfiable by a composite index table.
+
+    Filters and sort orders of the query map onto a prefix of the index
+    table's primary key, so the query reads a single range of it.
+
+    Args:
+      query: The datastore_pb.Query PB.
+      filter_info: A dict mapping properties filtered on to (op, value) tuples.
+      order_info: A list of (property, direction) tuples.
+    Returns:
+      (query, params): An SQL query string and list of parameters for it.
+    """
+    if not query.has_kind():
+      return None
+
+    index = self.__FindIndexForQuery(query)
+    if index is None or index.state() != self.READ_WRITE:
+      return None
+
+    definition = index.definition()
+    names = [p.name() for p in definition.property_list()]
+    if '__key__' in names or len(set(names)) != len(names):
+      return None
+    columns = dict((name, 'CompositeIndex.p%d' % i)
+                   for i, name in enumerate(names))
+    width = self.__CompositeIndexValueWidth(index)
+
+    filters = []
+    if definition.ancestor():
+      filters.append(('CompositeIndex.ancestor',
+                      datastore_pb.Query_Filter.EQUAL,
+                      self.__EncodeIndexPB(query.ancestor().path())))
+    inequalities = []
+    for name, filter_ops in filter_info.items():
+      for op, value in filter_ops:
+        if name == '__key__':
+          filters.append(('CompositeIndex.__path__', op, value))
+          continue
+        if name not in columns:
+          return None
+        # The index holds values truncated to its width, so only shorter
+        # values compare like the stored ones.
+        values = value
+        if op != datastore_pb.Query_Filter.IN:
+          values = [value]
+        if [v for v in values if len(str(v)) >= width]:
+          return None
+        if op == datastore_pb.Query_Filter.IN:
+          value = [buffer(str(v)) for v in value]
+        else:
+          value = buffer(str(value))
+        filters.append((columns[name], op, value))
+        if op not in _EQUALITY_OPERATORS and name not in inequalities:
+          inequalities.append(name)
+
+    orders = []
+    ordered = [prop for prop, _ in order_info]
+    for name in inequalities:
+      if name not in ordered:
+        orders.append((columns[name], datastore_pb.Query_Order.ASCENDING))
+    for prop, direction in order_info:
+      if prop == '__key__':
+        orders.append(('CompositeIndex.__path__', direction))
+      elif prop in columns:
+        orders.append((columns[prop], direction))
+      else:
+        return None
+    if not order_info or order_info[-1][0] != '__key__':
+      orders.append(('CompositeIndex.__path__',
+                     datastore_pb.Query_Order.ASCENDING))
+
+    prefix = self.__GetTablePrefix(query)
+    # Keys-only queries are answered from the index table alone.
+    tables = '%s AS CompositeIndex' % self.__CompositeIndexTable(prefix, index)
+    if not query.keys_only():
+      tables += ' INNER JOIN %s_Entities AS Entities USING (__path__)' % prefix
+
+    params = []
+    format_args = (
+        self.__CreateSelectList(query, 'CompositeIndex.__path__', orders),
+        tables,
+        self.__CreateFilterString(
+            filters, params, self.__CursorClauses(query, orders)),
         self.__CreateOrderString(orders))
-    query = ('SELECT Entities.__path__, Entities.entity, %s '
-             'FROM %s_Entities AS Entities %s %s %s' % format_args)
+    query = 'SELECT %s FROM %s %s %s' % format_args
     return query, params
 
   def __MergeJoinQuery(self, query, filter_info, order_info):
@@ -1271,7 +3171,7 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       return None
     for filter_ops in filter_info.values():
       for op, _ in filter_ops:
-        if op != datastore_pb.Query_Filter.EQUAL:
+        if op not in _EQUALITY_OPERATORS:
           return None
 
     return self.__StarSchemaQueryPlan(query, filter_info, order_info)
@@ -1303,8 +3203,10 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     Returns:
       An entity_pb.CompositeIndex PB, if a suitable index exists; otherwise None
     """
+    self.__MaybeRefreshIndexes(query.app())
     unused_required, kind, ancestor, props, num_eq_filters = (
-        datastore_index.CompositeIndexForQuery(query))
+        datastore_index.CompositeIndexForQuery(
+            typhoonae.multiquery.indexQuery(query)))
     required_key = (kind, ancestor, props)
     indexes = self.__indexes.get(query.app(), {}).get(kind, [])
 
@@ -1324,17 +3226,46 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
           return index
 
   _QUERY_STRATEGIES = [
+      __StatKindQuery,
       __KindQuery,
       __SinglePropertyQuery,
+      __CompositeIndexQuery,
       __MergeJoinQuery,
       __LastResortQuery,
   ]
 
-  def __GetQueryCursor(self, conn, query):
-    """Returns an MySQL query cursor for the provided query.
+  # Strategies which return every entity at most once. __KindQuery also runs
+  # ancestor queries without other filters.
+  _DISTINCT_STRATEGIES = frozenset([__StatKindQuery, __KindQuery])
+
+  # Strategies whose rows aren't stored entities.
+  _CURSOR_CLASSES = {__StatKindQuery: StatKindCursor}
+
+  def __CloseQueryConnection(self, conn, exhausted):
+    """Returns the connection of a closed query cursor to the pool.
 
     Args:
       conn: The MySQL connection.
+      exhausted: Whether all rows of the query were read.
+    """
+    if not exhausted:
+      self.__pool.Discard(conn)
+      return
+    try:
+      conn.commit()
+    except MySQLdb.OperationalError:
+      self.__pool.Discard(conn)
+      raise
+    self.__pool.Release(conn)
+
+  def __GetQueryCursor(self, query):
+    """Returns an MySQL query cursor for the provided query.
+
+    Queries outside of transactions are streamed from an unbuffered cursor on
+    a connection of their own, which is returned to the pool when the cursor
+    gets closed. Results of queries with a small limit are read at once.
+
+    Args:
       query: A datastore_pb.Query protocol buffer.
     Returns:
       A QueryCursor object.
@@ -1356,8 +3287,7 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     app_id = query.app()
     self.__ValidateAppId(app_id)
 
-    filters, orders = datastore_index.Normalize(query.filter_list(),
-                                                query.order_list())
+    filters, orders = typhoonae.multiquery.normalizeFilters(query)
 
     filter_info = self.__GenerateFilterInfo(filters, query)
     order_info = self.__GenerateOrderInfo(orders)
@@ -1371,15 +3301,24 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
           datastore_pb.Error.BAD_REQUEST,
           'No strategy found to satisfy query.')
 
-    sql_stmt, params = result
+    sql_stmt, params = result[:2]
+    check = None
+    if len(result) > 2:
+      check = result[2]
 
-    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
-      start_key, n = query.compiled_cursor().position(0).start_key().split('!')
-      new_offset = int(n)
-      query.set_offset(new_offset)
-      query.set_limit(query.limit() + new_offset)
+    if strategy in self._DISTINCT_STRATEGIES:
+      dedup_window = None
+    else:
+      dedup_window = _DEDUP_WINDOW
+
+    buffered = (check is None and query.has_limit() and
+                0 < query.limit() <= _MAX_BUFFERED_ROWS)
 
-    if query.has_limit() and query.limit() and query.has_offset():
+    # Checked rows may get dropped or reordered, so the cursor applies the
+    # limit and offset of their query.
+    if check is not None:
+      pass
+    elif query.has_limit() and query.limit() and query.has_offset():
       sql_stmt += ' LIMIT %i, %i' % (query.offset(), query.limit())
       query.set_offset(0)
     elif query.has_limit() and query.limit() and not query.has_offset():
@@ -1388,16 +3327,43 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     if self.__verbose:
       logging.debug("Executing statement '%s' with arguments %r",
                     sql_stmt, [str(x) for x in params])
-    db_cursor = conn.cursor()
+    in_transaction = self.__InTransaction(query.transaction())
+    if in_transaction:
+      tx = self.__GetTransaction(query.transaction())
+      self.__EnlistEntityGroup(tx, [query.ancestor()])
+      conn = tx.connection
+      db_cursor = conn.cursor()
+      on_close = None
+    elif buffered:
+      conn = self.__pool.Acquire()
+      db_cursor = conn.cursor()
+      on_close = None
+    else:
+      # Returns the connections of abandoned cursors to the pool, so the new
+      # cursor gets a connection without waiting.
+      self.__cursors.expire()
+      self.__cursors.trim(self.__cursors.max_size - 1)
+      conn = self.__pool.Acquire()
+      db_cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+      on_close = lambda exhausted: self.__CloseQueryConnection(conn, exhausted)
     if self.__verbose:
       start_time = time.time()
-    db_cursor.execute(sql_stmt, params)
+    try:
+      db_cursor.execute(sql_stmt, params)
+    except:
+      if not in_transaction:
+        self.__pool.Discard(conn)
+      raise
+    if buffered and not in_transaction:
+      self.__ReleaseConnection(conn, None)
     if self.__verbose:
       time_delta_ms = (time.time() - start_time) * 1000
       logging.debug("Statement execution time (ms): %s" % time_delta_ms)
-    cursor = QueryCursor(query, db_cursor)
-    if query.has_compiled_cursor() and query.compiled_cursor().position_size():
-      cursor.ResumeFromCompiledCursor(query.compiled_cursor())
+    cursor_class = self._CURSOR_CLASSES.get(strategy, QueryCursor)
+    if cursor_class is QueryCursor and query.keys_only():
+      cursor = KeysOnlyCursor(query, db_cursor, dedup_window, on_close, check)
+    else:
+      cursor = cursor_class(query, db_cursor, dedup_window, on_close, check)
 
     clone = datastore_pb.Query()
     clone.CopyFrom(query)
@@ -1410,10 +3376,8 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     return cursor
 
   def _Dynamic_RunQuery(self, query, query_result):
-    conn = self.__GetConnection(query.transaction())
+    cursor = self.__GetQueryCursor(query)
     try:
-      cursor = self.__GetQueryCursor(conn, query)
-
       self.__cursor_lock.acquire()
       cursor_id = self.__next_cursor_id
       self.__next_cursor_id += 1
@@ -1431,16 +3395,23 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
         count = _BATCH_SIZE
 
       cursor.PopulateQueryResult(count, query.offset(), query_result)
-      self.__cursors[cursor_pb] = cursor
-    finally:
-      self.__ReleaseConnection(conn, query.transaction())
+    except:
+      cursor.Close()
+      raise
+    if not query_result.more_results():
+      cursor.Close()
+      return
+    self.__cursors.put(cursor_pb, cursor)
 
   def _Dynamic_Next(self, next_request, query_result):
     self.__ValidateAppId(next_request.cursor().app())
 
-    try:
-      cursor = self.__cursors[next_request.cursor()]
-    except KeyError:
+    # Takes the cursor out of the registry while it is in use, so it can't
+    # be evicted meanwhile. Putting it back refreshes its time to live.
+    cursor = self.__cursors.get(next_request.cursor())
+    if cursor is not None:
+      cursor = self.__cursors.pop(next_request.cursor())
+    if cursor is None:
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST,
           'Cursor %d not found' % next_request.cursor().cursor())
@@ -1450,7 +3421,15 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     count = _BATCH_SIZE
     if next_request.has_count():
       count = next_request.count()
-    cursor.PopulateQueryResult(count, next_request.offset(), query_result)
+    try:
+      cursor.PopulateQueryResult(count, next_request.offset(), query_result)
+    except:
+      cursor.Close()
+      raise
+    if not query_result.more_results():
+      cursor.Close()
+      return
+    self.__cursors.put(next_request.cursor(), cursor)
 
   def _Dynamic_Count(self, query, integer64proto):
     if query.has_limit():
@@ -1458,31 +3437,37 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     else:
       query.set_limit(_MAXIMUM_RESULTS)
 
-    conn = self.__GetConnection(query.transaction())
+    cursor = self.__GetQueryCursor(query)
     try:
-      cursor = self.__GetQueryCursor(conn, query)
       integer64proto.set_value(cursor.Count())
     finally:
-      self.__ReleaseConnection(conn, query.transaction())
+      cursor.Close()
 
   def _Dynamic_BeginTransaction(self, request, transaction):
     self.__ValidateAppId(request.app())
 
-    self.__connection_lock.acquire()
-    assert self.__current_transaction is None
-    handle = self.__next_tx_handle
-    self.__next_tx_handle += 1
+    conn = self.__pool.Acquire()
+
+    self.__tx_lock.acquire()
+    try:
+      handle = self.__next_tx_handle
+      self.__next_tx_handle += 1
+      assert handle not in self.__transactions
+      self.__transactions[handle] = _Transaction(conn)
+    finally:
+      self.__tx_lock.release()
 
     transaction.set_app(request.app())
     transaction.set_handle(handle)
-    self.__current_transaction = handle
-    assert transaction not in self.__transactions
-    self.__transactions[transaction] = None
-    self.__tx_lock.acquire()
 
   def _Dynamic_AddActions(self, request, _):
 
-    if ((len(self.__tx_actions) + request.add_request_size()) >
+    if not request.add_request_size():
+      return
+
+    tx = self.__GetTransaction(request.add_request(0).transaction())
+
+    if ((len(tx.actions) + request.add_request_size()) >
         _MAX_ACTIONS_PER_TXN):
       raise apiproxy_errors.ApplicationError(
           datastore_pb.Error.BAD_REQUEST,
@@ -1496,128 +3481,172 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       clone.clear_transaction()
       new_actions.append(clone)
 
-    self.__tx_actions.extend(new_actions)
+    tx.actions.extend(new_actions)
 
-  def _Dynamic_Commit(self, transaction, _):
-    assert self.__current_transaction == transaction.handle()
-    conn = self.__connection
+  def __EndTransaction(self, transaction, rollback):
+    """Forgets a transaction and returns its connection to the pool.
 
-    try:
-      self.__PutEntities(conn, self.__tx_writes.values())
-      self.__DeleteEntities(conn, self.__tx_deletes)
+    Args:
+      transaction: A Transaction PB.
+      rollback: If True, roll back the database TX instead of committing it.
 
-      for action in self.__tx_actions:
-        try:
-          apiproxy_stub_map.MakeSyncCall(
-              'taskqueue', 'Add', action, api_base_pb.VoidProto())
-        except apiproxy_errors.ApplicationError, e:
-          logging.warning('Transactional task %s has been dropped, %s',
-                          action, e)
+    Returns:
+      The _Transaction instance.
+    """
+    self.__tx_lock.acquire()
+    try:
+      tx = self.__transactions.pop(transaction.handle())
     finally:
-      self.__current_transaction = None
-      self.__tx_actions = []
-      self.__tx_writes = {}
-      self.__tx_deletes = set()
-      self.__ReleaseConnection(conn, None)
-      self.__ReleaseLockForEntityGroup(self.__connection,
-                                       self.__transactions[transaction] or '')
-      del self.__transactions[transaction]
-      self.__inside_tx = False
       self.__tx_lock.release()
 
-  def _Dynamic_Rollback(self, transaction, _):
-    conn = self.__GetConnection(transaction)
-    self.__current_transaction = None
-    self.__tx_actions = []
-    self.__tx_writes = {}
-    self.__tx_deletes = set()
-    self.__ReleaseConnection(conn, None, True)
-    self.__ReleaseLockForEntityGroup(self.__connection,
-                                     self.__transactions[transaction] or '')
-    del self.__transactions[transaction]
-    self.__inside_tx = False
-    self.__tx_lock.release()
+    conn = tx.connection
+    try:
+      if rollback:
+        conn.rollback()
+      else:
+        conn.commit()
+    except MySQLdb.OperationalError:
+      self.__pool.Discard(conn)
+      if not rollback:
+        raise
+      logging.warning('Lost connection while rolling back transaction %s',
+                      transaction.handle())
+    else:
+      self.__pool.Release(conn)
+    return tx
 
-  def _Dynamic_GetSchema(self, req, schema):
-    conn = self.__GetConnection(None)
+  def _Dynamic_Commit(self, transaction, _):
+    tx = self.__GetTransaction(transaction)
+    conn = tx.connection
+
+    stats = []
     try:
-      prefix = self.__GetTablePrefix(req)
+      if tx.writes or tx.deletes:
+        self.__LockEntityGroup(tx)
+      self.__PutEntities(conn, tx.writes.values(), stats)
+      self.__DeleteEntities(conn, tx.deletes, stats)
+    except:
+      self.__EndTransaction(transaction, True)
+      raise
+    self.__EndTransaction(transaction, False)
+    self.__AddStats(stats)
+
+    for action in tx.actions:
+      try:
+        apiproxy_stub_map.MakeSyncCall(
+            'taskqueue', 'Add', action, api_base_pb.VoidProto())
+      except apiproxy_errors.ApplicationError, e:
+        logging.warning('Transactional task %s has been dropped, %s',
+                        action, e)
 
-      filters = []
-      if req.has_start_kind():
-        filters.append(('kind', datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
-                        req.start_kind()))
-      if req.has_end_kind():
-        filters.append(('kind', datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
-                        req.end_kind()))
+  def _Dynamic_Rollback(self, transaction, _):
+    self.__ValidateTransaction(transaction)
+    self.__EndTransaction(transaction, True)
 
-      params = []
-      if req.properties():
-        sql_stmt = ('SELECT kind, name, value FROM %s_EntitiesByProperty %s '
-                    'GROUP BY kind, name, substr(value, 1, 1) ORDER BY kind'
-                    % (prefix, self.__CreateFilterString(filters, params)))
-      else:
-        sql_stmt = ('SELECT kind FROM %s_Entities %s GROUP BY kind'
-                    % (prefix, self.__CreateFilterString(filters, params)))
+  def __GetSchemaRows(self, req):
+    """Returns the statistics rows answering a GetSchema request.
+
+    Args:
+      req: A datastore_pb.GetSchemaRequest.
+    Returns:
+      A sequence of (kind,) or, if properties are requested, of (kind, name,
+      sample value) tuples sorted by kind and name.
+    """
+    self.__FlushStats()
+    prefix = self.__GetTablePrefix(req)
+    cache_key = (prefix,
+                 req.has_start_kind() and req.start_kind() or None,
+                 req.has_end_kind() and req.end_kind() or None,
+                 req.properties())
+    rows = self.__schema_cache.get(cache_key)
+    if rows is not None:
+      return rows
+
+    filters = []
+    if req.has_start_kind():
+      filters.append(('kind', datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL,
+                      req.start_kind()))
+    if req.has_end_kind():
+      filters.append(('kind', datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+                      req.end_kind()))
+
+    params = []
+    if req.properties():
+      sql_stmt = ('SELECT kind, name, sample FROM %s_PropertyStats %s '
+                  'ORDER BY kind, name, tag'
+                  % (prefix, self.__CreateFilterString(filters, params)))
+    else:
+      sql_stmt = ('SELECT kind FROM %s_KindStats %s ORDER BY kind'
+                  % (prefix, self.__CreateFilterString(filters, params)))
+
+    conn = self.__GetConnection(None)
+    try:
       cursor = conn.cursor()
       cursor.execute(sql_stmt, params)
-
-      kind = None
-      current_name = None
-      kind_pb = None
-      for row in cursor.fetchall():
-        if row[0] != kind:
-          if kind_pb:
-            schema.kind_list().append(kind_pb)
-          kind = row[0].encode('utf-8')
-          kind_pb = entity_pb.EntityProto()
-          kind_pb.mutable_key().set_app(req.app())
-          kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
-          kind_pb.mutable_entity_group()
-
-        if req.properties():
-          name, value_data = row[1:]
-          if current_name != name:
-            current_name = name
-            prop_pb = kind_pb.add_property()
-            prop_pb.set_name(name.encode('utf-8'))
-            prop_pb.set_multiple(False)
-          value_decoder = sortable_pb_encoder.Decoder(
-              array.array('B', str(value_data)))
-          value_pb = prop_pb.mutable_value()
-          value_pb.Merge(value_decoder)
-
-          if value_pb.has_int64value():
-            value_pb.set_int64value(0)
-          if value_pb.has_booleanvalue():
-            value_pb.set_booleanvalue(False)
-          if value_pb.has_stringvalue():
-            value_pb.set_stringvalue('none')
-          if value_pb.has_doublevalue():
-            value_pb.set_doublevalue(0.0)
-          if value_pb.has_pointvalue():
-            value_pb.mutable_pointvalue().set_x(0.0)
-            value_pb.mutable_pointvalue().set_y(0.0)
-          if value_pb.has_uservalue():
-            value_pb.mutable_uservalue().set_gaiaid(0)
-            value_pb.mutable_uservalue().set_email('none')
-            value_pb.mutable_uservalue().set_auth_domain('none')
-            value_pb.mutable_uservalue().clear_nickname()
-            value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
-          if value_pb.has_referencevalue():
-            value_pb.clear_referencevalue()
-            value_pb.mutable_referencevalue().set_app('none')
-            pathelem = value_pb.mutable_referencevalue().add_pathelement()
-            pathelem.set_type('none')
-            pathelem.set_name('none')
-
-      if kind_pb:
-        schema.kind_list().append(kind_pb)
+      rows = tuple(cursor.fetchall())
     finally:
       self.__ReleaseConnection(conn, None)
+    self.__schema_cache.put(cache_key, rows)
+    return rows
+
+  def _Dynamic_GetSchema(self, req, schema):
+    kind = None
+    current_name = None
+    kind_pb = None
+    for row in self.__GetSchemaRows(req):
+      if row[0] != kind:
+        if kind_pb:
+          schema.kind_list().append(kind_pb)
+        kind = row[0].encode('utf-8')
+        current_name = None
+        kind_pb = entity_pb.EntityProto()
+        kind_pb.mutable_key().set_app(req.app())
+        kind_pb.mutable_key().mutable_path().add_element().set_type(kind)
+        kind_pb.mutable_entity_group()
+
+      if req.properties():
+        name, value_data = row[1:]
+        if not value_data:
+          # Only truncated values of the type were written so far.
+          continue
+        if current_name != name:
+          current_name = name
+          prop_pb = kind_pb.add_property()
+          prop_pb.set_name(name.encode('utf-8'))
+          prop_pb.set_multiple(False)
+        value_decoder = sortable_pb_encoder.Decoder(
+            array.array('B', str(value_data)))
+        value_pb = prop_pb.mutable_value()
+        value_pb.Merge(value_decoder)
+
+        if value_pb.has_int64value():
+          value_pb.set_int64value(0)
+        if value_pb.has_booleanvalue():
+          value_pb.set_booleanvalue(False)
+        if value_pb.has_stringvalue():
+          value_pb.set_stringvalue('none')
+        if value_pb.has_doublevalue():
+          value_pb.set_doublevalue(0.0)
+        if value_pb.has_pointvalue():
+          value_pb.mutable_pointvalue().set_x(0.0)
+          value_pb.mutable_pointvalue().set_y(0.0)
+        if value_pb.has_uservalue():
+          value_pb.mutable_uservalue().set_gaiaid(0)
+          value_pb.mutable_uservalue().set_email('none')
+          value_pb.mutable_uservalue().set_auth_domain('none')
+          value_pb.mutable_uservalue().clear_nickname()
+          value_pb.mutable_uservalue().clear_obfuscated_gaiaid()
+        if value_pb.has_referencevalue():
+          value_pb.clear_referencevalue()
+          value_pb.mutable_referencevalue().set_app('none')
+          pathelem = value_pb.mutable_referencevalue().add_pathelement()
+          pathelem.set_type('none')
+          pathelem.set_name('none')
+
+    if kind_pb:
+      schema.kind_list().append(kind_pb)
 
   def _Dynamic_AllocateIds(self, allocate_ids_request, allocate_ids_response):
-    conn = self.__GetConnection(None)
     model_key = allocate_ids_request.model_key()
     self.__ValidateAppId(model_key.app())
     if allocate_ids_request.has_size() and allocate_ids_request.has_max():
@@ -1628,7 +3657,7 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
       if allocate_ids_request.size() < 1:
         raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
                                                'Size must be greater than 0.')
-      first_id = self.__AllocateIds(conn, self.__GetTablePrefix(model_key),
+      first_id = self.__AllocateIds(self.__GetTablePrefix(model_key),
                                     size=allocate_ids_request.size())
       allocate_ids_response.set_start(first_id)
       allocate_ids_response.set_end(first_id + allocate_ids_request.size() - 1)
@@ -1637,14 +3666,12 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
         raise apiproxy_errors.ApplicationError(
             datastore_pb.Error.BAD_REQUEST,
             'Max must be greater than or equal to 0.')
-      first_id = self.__AllocateIds(conn, self.__GetTablePrefix(model_key),
+      first_id = self.__AllocateIds(self.__GetTablePrefix(model_key),
                                     max=allocate_ids_request.max())
       allocate_ids_response.set_start(first_id)
       allocate_ids_response.set_end(max(allocate_ids_request.max(),
                                         first_id - 1))
 
-    self.__ReleaseConnection(conn, None)
-
   def __FindIndex(self, index):
     """Finds an existing index by definition.
 
@@ -1672,22 +3699,46 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
 
     self.__index_lock.acquire()
     try:
-      if self.__FindIndex(index):
-        raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                               'Index already exists.')
-
-      next_id = max([idx.id() for x in self.__indexes.get(app_id, {}).values()
-                     for idx in x] + [0]) + 1
-      index.set_id(next_id)
-      id_response.set_value(next_id)
+      # Registers the index for writes first, then adds existing entities
+      # and finally serves queries from it.
+      conn = self.__GetConnection(None)
+      try:
+        self.__RefreshIndexes(conn, app_id, ' FOR UPDATE')
+        if self.__FindIndex(index):
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST, 'Index already exists.')
+
+        next_id = max([idx.id()
+                       for x in self.__indexes.get(app_id, {}).values()
+                       for idx in x] + [0]) + 1
+        index.set_id(next_id)
+        id_response.set_value(next_id)
+
+        clone = entity_pb.CompositeIndex()
+        clone.CopyFrom(index)
+        clone.set_state(self.WRITE_ONLY)
+        self.__indexes.setdefault(app_id, {}).setdefault(
+            kind, []).append(clone)
+        for prefix in self.__AppTablePrefixes(app_id):
+          # DDL statements implicitly commit, see __GetTablePrefix.
+          table_conn = self.__pool.Connect()
+          try:
+            self.__CreateCompositeIndexTable(table_conn, prefix, clone)
+          finally:
+            table_conn.close()
+        self.__WriteIndexData(conn, app_id)
+      finally:
+        self.__ReleaseConnection(conn, None)
 
-      clone = entity_pb.CompositeIndex()
-      clone.CopyFrom(index)
-      self.__indexes.setdefault(app_id, {}).setdefault(kind, []).append(clone)
+      self.__BuildCompositeIndex(clone)
 
       conn = self.__GetConnection(None)
       try:
-        self.__WriteIndexData(conn, app_id)
+        self.__RefreshIndexes(conn, app_id, ' FOR UPDATE')
+        built = self.__FindIndex(clone)
+        if built is not None and built.state() == self.WRITE_ONLY:
+          built.set_state(self.READ_WRITE)
+          self.__WriteIndexData(conn, app_id)
       finally:
         self.__ReleaseConnection(conn, None)
     finally:
@@ -1695,28 +3746,41 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
 
   def _Dynamic_GetIndices(self, app_str, composite_indices):
     self.__ValidateAppId(app_str.value())
+    self.__MaybeRefreshIndexes(app_str.value())
 
     index_list = composite_indices.index_list()
     for indexes in self.__indexes.get(app_str.value(), {}).values():
       index_list.extend(indexes)
 
   def _Dynamic_UpdateIndex(self, index, _):
-    self.__ValidateAppId(index.app_id())
-    my_index = self.__FindIndex(index)
-    if not my_index:
-      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                             "Index doesn't exist.")
-    elif (index.state() != my_index.state() and
-          index.state() not in self._INDEX_STATE_TRANSITIONS[my_index.state()]):
-      raise apiproxy_errors.ApplicationError(
-          datastore_pb.Error.BAD_REQUEST,
-          'Cannot move index state from %s to %s' %
-          (entity_pb.CompositeIndex.State_Name(my_index.state()),
-           (entity_pb.CompositeIndex.State_Name(index.state()))))
+    app_id = index.app_id()
+    self.__ValidateAppId(app_id)
 
     self.__index_lock.acquire()
     try:
-      my_index.set_state(index.state())
+      conn = self.__GetConnection(None)
+      try:
+        self.__RefreshIndexes(conn, app_id, ' FOR UPDATE')
+        my_index = self.__FindIndex(index)
+        if not my_index:
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST, "Index doesn't exist.")
+        # Indexes become READ_WRITE once they are built, which the definitions
+        # of clients don't know.
+        if (index.state() == self.WRITE_ONLY and
+            my_index.state() == self.READ_WRITE):
+          return
+        if (index.state() != my_index.state() and index.state() not in
+            self._INDEX_STATE_TRANSITIONS[my_index.state()]):
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST,
+              'Cannot move index state from %s to %s' %
+              (entity_pb.CompositeIndex.State_Name(my_index.state()),
+               (entity_pb.CompositeIndex.State_Name(index.state()))))
+        my_index.set_state(index.state())
+        self.__WriteIndexData(conn, app_id)
+      finally:
+        self.__ReleaseConnection(conn, None)
     finally:
       self.__index_lock.release()
 
@@ -1725,18 +3789,19 @@ class DatastoreMySQLStub(apiproxy_stub.APIProxyStub):
     kind = index.definition().entity_type()
     self.__ValidateAppId(app_id)
 
-    my_index = self.__FindIndex(index)
-    if not my_index:
-      raise apiproxy_errors.ApplicationError(datastore_pb.Error.BAD_REQUEST,
-                                             "Index doesn't exist.")
-
-    conn = self.__GetConnection(None)
-    try:
-      self.__WriteIndexData(conn, app_id)
-    finally:
-      self.__ReleaseConnection(conn, None)
     self.__index_lock.acquire()
     try:
-      self.__indexes[app_id][kind].remove(my_index)
+      conn = self.__GetConnection(None)
+      try:
+        self.__RefreshIndexes(conn, app_id, ' FOR UPDATE')
+        my_index = self.__FindIndex(index)
+        if not my_index:
+          raise apiproxy_errors.ApplicationError(
+              datastore_pb.Error.BAD_REQUEST, "Index doesn't exist.")
+        self.__indexes[app_id][kind].remove(my_index)
+        self.__WriteIndexData(conn, app_id)
+      finally:
+        self.__ReleaseConnection(conn, None)
     finally:
       self.__index_lock.release()
+    self.__DropCompositeIndex(my_index)
@@ -15,6 +15,7 @@
 # limitations under the License.
 """Unit tests for the Datastore MySQL stub."""
 
+from google.appengine.api import api_base_pb
 from google.appengine.api import apiproxy_stub
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore
@@ -23,6 +24,7 @@ from google.appengine.api import datastore_types
 from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
 from google.appengine.runtime import apiproxy_errors
@@ -33,9 +35,25 @@ import datetime
 import os
 import time
 import typhoonae.mysql.datastore_mysql_stub
+import typhoonae.multiquery
 import unittest
 
 
+def putEntities(count, queue):
+    """Puts entities with a stub of its own and reports the allocated IDs."""
+
+    stub = typhoonae.mysql.datastore_mysql_stub.DatastoreMySQLStub(
+        'test', {"host": "127.0.0.1", "user": "root", "passwd": "",
+                 "db": "testdb"})
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    ids = [datastore.Put(datastore.Entity('Counter')).id()
+           for i in xrange(count)]
+    start, end = db.allocate_ids(db.Key.from_path('Counter', 1), 10)
+    ids.extend(xrange(start, end + 1))
+    queue.put(ids)
+
+
 class TaskQueueServiceStubMock(apiproxy_stub.APIProxyStub):
     """Task queue service stub for testing purposes."""
 
@@ -97,6 +115,7 @@ class DatastoreMySQLTestCaseBase(unittest.TestCase):
                                '(%s)' % e)
 
         self.stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        typhoonae.multiquery.install()
 
         apiproxy_stub_map.apiproxy.RegisterStub(
             'taskqueue', TaskQueueServiceStubMock())
@@ -181,6 +200,23 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
         self.assertRaises(
             datastore_errors.EntityNotFoundError, datastore.Get, key)
 
+    def testBatchGet(self):
+        """Gets many entities at once in the order of the keys."""
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        keys = db.put([Item(number=i) for i in xrange(200)])
+        missing = db.Key.from_path('Item', 'missing')
+
+        batch = list(reversed(keys[:100])) + [missing, keys[0]]
+        items = db.get(batch)
+
+        self.assertEqual(102, len(items))
+        self.assertEqual(range(99, -1, -1), [i.number for i in items[:100]])
+        self.assertEqual(None, items[100])
+        self.assertEqual(0, items[101].number)
+
     def testGetPutMultiTypes(self):
         """Sets and Gets models with different entity groups."""
 
@@ -229,6 +265,32 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
         query = Book.all().filter("title =", "Last Chance to See")
         self.assertEqual(query.get(), None)
 
+    def testBatchesAcrossNamespaces(self):
+        """Writes and deletes entities of several namespaces in one batch."""
+
+        from google.appengine.api import namespace_manager
+
+        class Note(db.Model):
+            text = db.StringProperty()
+
+        keys = []
+        for namespace in ('', 'one', 'two'):
+            namespace_manager.set_namespace(namespace)
+            note = Note(key_name='note', text=namespace or 'default')
+            keys.append(note.put())
+        namespace_manager.set_namespace('')
+
+        self.assertEqual(['default', 'one', 'two'],
+                         [note.text for note in db.get(keys)])
+
+        db.delete(keys)
+        self.assertEqual([None, None, None], db.get(keys))
+
+        for namespace in ('', 'one', 'two'):
+            namespace_manager.set_namespace(namespace)
+            self.assertEqual(0, Note.all().filter('text >', '').count())
+        namespace_manager.set_namespace('')
+
     def testExpando(self):
         """Test the Expando superclass."""
 
@@ -378,6 +440,112 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
         self.assertEqual(1, Author.all().count())
         self.assertEqual(0, Book.all().count())
 
+    def testInterleavedTransactions(self):
+        """Runs transactions side by side on their own connections."""
+
+        class Author(db.Model):
+            name = db.StringProperty()
+
+        class Book(db.Model):
+            title = db.StringProperty()
+
+        def call(method, request, response):
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', method, request, response)
+            return response
+
+        def begin():
+            request = datastore_pb.BeginTransactionRequest()
+            request.set_app('test')
+            return call('BeginTransaction', request, datastore_pb.Transaction())
+
+        def put(tx, model):
+            request = datastore_pb.PutRequest()
+            request.add_entity().CopyFrom(db.model_to_protobuf(model))
+            request.mutable_transaction().CopyFrom(tx)
+            call('Put', request, datastore_pb.PutResponse())
+
+        tx1, tx2 = begin(), begin()
+        put(tx1, Author(key_name='marktwain', name='Mark Twain'))
+        put(tx2, Book(key_name='tomsawyer', title='Tom Sawyer'))
+
+        self.assertEqual(0, Author.all().count())
+
+        call('Commit', tx2, datastore_pb.CommitResponse())
+        self.assertEqual(1, Book.all().count())
+        self.assertEqual(0, Author.all().count())
+
+        call('Rollback', tx1, api_base_pb.VoidProto())
+        self.assertEqual(0, Author.all().count())
+
+        self.assertRaises(apiproxy_errors.ApplicationError,
+                          call, 'Commit', tx1, datastore_pb.CommitResponse())
+
+    def testConcurrentTransactions(self):
+        """Fails the second of two transactions on the same entity group."""
+
+        class Counter(db.Model):
+            count = db.IntegerProperty()
+
+        key = Counter(key_name='c', count=0).put()
+
+        def call(method, request, response):
+            apiproxy_stub_map.MakeSyncCall(
+                'datastore_v3', method, request, response)
+            return response
+
+        def begin():
+            request = datastore_pb.BeginTransactionRequest()
+            request.set_app('test')
+            return call('BeginTransaction', request, datastore_pb.Transaction())
+
+        def increment(tx):
+            request = datastore_pb.GetRequest()
+            request.add_key().CopyFrom(key._ToPb())
+            request.mutable_transaction().CopyFrom(tx)
+            entity = call('Get', request, datastore_pb.GetResponse()).entity(0)
+            counter = db.model_from_protobuf(entity.entity())
+            counter.count += 1
+            request = datastore_pb.PutRequest()
+            request.add_entity().CopyFrom(db.model_to_protobuf(counter))
+            request.mutable_transaction().CopyFrom(tx)
+            call('Put', request, datastore_pb.PutResponse())
+
+        tx1, tx2 = begin(), begin()
+        increment(tx1)
+        increment(tx2)
+
+        call('Commit', tx1, datastore_pb.CommitResponse())
+        try:
+            call('Commit', tx2, datastore_pb.CommitResponse())
+            self.fail('Expected CONCURRENT_TRANSACTION')
+        except apiproxy_errors.ApplicationError, e:
+            self.assertEqual(datastore_pb.Error.CONCURRENT_TRANSACTION,
+                             e.application_error)
+
+        self.assertEqual(1, Counter.get(key).count)
+
+        stats = self.stub.LockStats()
+        self.assertEqual(2, stats['locks'])
+        self.assertEqual(1, stats['conflicts'])
+
+        # Retrying transactions succeed.
+        def txn():
+            counter = Counter.get(key)
+            counter.count += 1
+            counter.put()
+
+        db.run_in_transaction(txn)
+        self.assertEqual(2, Counter.get(key).count)
+
+        # A non-transactional put invalidates transactions which read before.
+        tx3 = begin()
+        increment(tx3)
+        Counter(key_name='c', count=10).put()
+        self.assertRaises(apiproxy_errors.ApplicationError,
+                          call, 'Commit', tx3, datastore_pb.CommitResponse())
+        self.assertEqual(10, Counter.get(key).count)
+
     def testKindlessAncestorQueries(self):
         """Perform kindless queries for entities with a given ancestor."""
 
@@ -788,6 +956,92 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
 
         self.assertEqual(0, query.count())
 
+    def testIncrementalIndexUpdates(self):
+        """Updates only the index rows of changed property values."""
+
+        class Post(db.Model):
+            tags = db.StringListProperty()
+            title = db.StringProperty()
+
+        def keyNames(query):
+            return [p.key().name() for p in query]
+
+        Post(key_name='p1', tags=['a', 'b'], title='One').put()
+        Post(key_name='p2', tags=['b'], title='Two').put()
+        Post(key_name='p1', tags=['b', 'c'], title='One').put()
+
+        self.assertEqual([], keyNames(Post.all().filter('tags =', 'a')))
+        self.assertEqual(['p1', 'p2'],
+                         keyNames(Post.all().filter('tags =', 'b')))
+        self.assertEqual(['p1'], keyNames(Post.all().filter('tags =', 'c')))
+        self.assertEqual(['p1'], keyNames(Post.all().filter('title =', 'One')))
+
+        # The last version of an entity written twice in a batch wins.
+        db.put([Post(key_name='p2', tags=['x'], title='Two'),
+                Post(key_name='p2', tags=['y'], title='Three')])
+        self.assertEqual([], keyNames(Post.all().filter('tags =', 'x')))
+        self.assertEqual(['p2'], keyNames(Post.all().filter('tags =', 'y')))
+        self.assertEqual([], keyNames(Post.all().filter('title =', 'Two')))
+
+        def txn():
+            post = Post.get_by_key_name('p1')
+            post.tags = ['d']
+            post.put()
+
+        db.run_in_transaction(txn)
+        self.assertEqual([], keyNames(Post.all().filter('tags =', 'b')))
+        self.assertEqual(['p1'], keyNames(Post.all().filter('tags =', 'd')))
+
+        # Deletes changed values of several list properties and entities.
+        entities = []
+        for i in xrange(3):
+            entity = db.Expando(key_name='e%i' % i)
+            for p in xrange(5):
+                setattr(entity, 'p%i' % p, range(i, i + 10))
+            entities.append(entity)
+        db.put(entities)
+        for entity in entities:
+            for p in xrange(5):
+                setattr(entity, 'p%i' % p, [-1, 5])
+        db.put(entities)
+        query = db.Query(db.Expando).filter('p4 >=', 0)
+        self.assertEqual(['e0', 'e1', 'e2'], keyNames(query))
+        query = db.Query(db.Expando).filter('p0 =', 6)
+        self.assertEqual([], keyNames(query))
+
+    def testStreamingQueries(self):
+        """Streams results in batches and skips duplicates."""
+
+        class Numbers(db.Model):
+            values = db.ListProperty(int)
+
+        for i in xrange(250):
+            Numbers(values=[i, i + 1000]).put()
+
+        self.assertEqual(250, Numbers.all().count())
+        self.assertEqual(250, len(list(Numbers.all())))
+
+        query = Numbers.all().filter('values >=', 0)
+        self.assertEqual(250, len(set(n.key() for n in query)))
+        self.assertEqual(250, len(list(query)))
+
+        # A few open cursors are kept while new queries run.
+        iterators = [iter(Numbers.all()) for i in xrange(3)]
+        for iterator in iterators:
+            iterator.next()
+        self.assertEqual(1, Numbers.all().filter('values =', 1000).count())
+        self.assertEqual([249] * 3, [len(list(i)) for i in iterators])
+
+        # Abandoned cursors don't exhaust the connection pool.
+        start = time.time()
+        for i in xrange(3 * typhoonae.mysql.datastore_mysql_stub._POOL_SIZE):
+            iterator = iter(Numbers.all())
+            iterator.next()
+        self.assertEqual(250, len(list(Numbers.all())))
+        self.assertEqual(1, Numbers.all().filter('values =', 1000).count())
+        self.assertTrue(time.time() - start <
+                        typhoonae.mysql.datastore_mysql_stub._POOL_TIMEOUT)
+
     def testStringListProperties(self):
         """Tests string list properties."""
 
@@ -941,8 +1195,119 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
         self.assertEqual(1000, query.count())
 
         start, end = db.allocate_ids(key, 2000)
-        self.assertEqual(start, 1001)
-        self.assertEqual(end, 3000)
+        self.assertTrue(start > key.id())
+        self.assertEqual(2000, end - start + 1)
+        self.assertFalse(start <= EmptyModel().put().id() <= end)
+
+    def testAllocateIdsInProcesses(self):
+        """Processes sharing the database never allocate the same IDs."""
+
+        import multiprocessing
+
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=putEntities, args=(200, queue))
+            for i in xrange(4)]
+        for process in processes:
+            process.start()
+        ids = [datastore.Put(datastore.Entity('Counter')).id()
+               for i in xrange(200)]
+        for process in processes:
+            ids.extend(queue.get())
+        for process in processes:
+            process.join()
+
+        self.assertEqual(5 * 200 + 4 * 10, len(set(ids)))
+
+    def testAsyncRPC(self):
+        """Runs asynchronous gets in worker threads."""
+
+        keys = [datastore.Put(datastore.Entity('Async', name='e%i' % i))
+                for i in xrange(10)]
+        rpcs = []
+        for key in keys:
+            request = datastore_pb.GetRequest()
+            request.add_key().CopyFrom(key._ToPb())
+            response = datastore_pb.GetResponse()
+            rpc = apiproxy_stub_map.UserRPC('datastore_v3')
+            rpc.make_call('Get', request, response)
+            rpcs.append((rpc, response))
+
+        names = []
+        for rpc, response in rpcs:
+            rpc.check_success()
+            entity = response.entity(0).entity()
+            names.append(entity.key().path().element_list()[-1].name())
+        self.assertEqual(['e%i' % i for i in xrange(10)], names)
+
+    def testMultiValueFilters(self):
+        """Runs IN and != queries as single queries."""
+
+        class Ware(db.Model):
+            price = db.IntegerProperty()
+
+        for i in xrange(10):
+            Ware(key_name='w%i' % i, price=i % 5).put()
+
+        def runs():
+            return sum(self.stub.QueryHistory().values())
+
+        before = runs()
+        query = Ware.all().filter('price IN', [3, 1]).order('-price')
+        self.assertEqual([3, 3, 1, 1], [ware.price for ware in query])
+        self.assertEqual(before + 1, runs())
+
+        before = runs()
+        query = Ware.all().filter('price IN', [4, 0])
+        self.assertEqual(['w0', 'w4', 'w5', 'w9'],
+                         [ware.key().name() for ware in query])
+        self.assertEqual(before + 1, runs())
+
+        before = runs()
+        query = Ware.all().filter('price !=', 2)
+        self.assertEqual([0, 0, 1, 1, 3, 3, 4, 4],
+                         [ware.price for ware in query])
+        self.assertEqual(before + 1, runs())
+        self.assertEqual(8, query.count())
+
+    def testKeysOnlyQueries(self):
+        """Returns keys without reading the stored entities."""
+
+        class Note(db.Model):
+            rank = db.IntegerProperty()
+
+        parent = Note(key_name='parent', rank=0).put()
+        keys = [Note(key_name='user:1', rank=1).put(),
+                Note(parent=parent, rank=2).put(),
+                Note(key_name='note', rank=3).put(),
+                Note(key_name='123', rank=4).put(),
+                Note(key_name='1234567890', rank=5).put(),
+                Note(key_name='a!Note:b', rank=6).put(),
+                Note(key_name='c:d', rank=7).put(),
+                Note(rank=8).put()]
+
+        query = Note.all(keys_only=True).filter('rank >', 0).order('rank')
+        self.assertEqual(keys, query.fetch(10))
+
+        query = datastore_pb.Query()
+        query.set_app('test')
+        query.set_kind('Note')
+        query.set_keys_only(True)
+        result = datastore_pb.QueryResult()
+        self.stub.MakeSyncCall('datastore_v3', 'RunQuery', query, result)
+        self.assertTrue(result.keys_only())
+        self.assertEqual(
+            sorted([parent] + keys),
+            sorted(datastore_types.Key._FromPb(entity.key())
+                   for entity in result.result_list()))
+        self.assertEqual(
+            [0] * len(result.result_list()),
+            [entity.property_size() + entity.raw_property_size()
+             for entity in result.result_list()])
+
+        query = db.Query(keys_only=True).filter(
+            '__key__ >', db.Key.from_path('Note', 'c'))
+        self.assertTrue(db.Key.from_path('Note', 'c:d') in query.fetch(20))
 
     def testCursors(self):
         """Tests the cursor API."""
@@ -1013,6 +1378,247 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
             [1978L, 1976L, 1974L, 1972L, 1970L, 1968L],
             [n.value for n in f])
 
+    def testCursorsWithEqualSortValues(self):
+        """Resumes queries between results with equal sort values."""
+
+        class Number(db.Model):
+            parity = db.IntegerProperty()
+            value = db.IntegerProperty()
+
+        for i in xrange(100):
+            Number(key_name='n%03i' % i, parity=i % 2, value=i).put()
+
+        query = Number.all().order('parity')
+        seen = []
+        while True:
+            page = query.fetch(15)
+            if not page:
+                break
+            seen.extend(n.value for n in page)
+            query.with_cursor(query.cursor())
+
+        self.assertEqual(range(0, 100, 2) + range(1, 100, 2), seen)
+
+        query = Number.all().order('parity')
+        query.fetch(10)
+        start = query.cursor()
+        query.fetch(30)
+        end = query.cursor()
+
+        query = Number.all().order('parity').with_cursor(start, end)
+        self.assertEqual(range(20, 60, 2),
+                         [n.value for n in query.fetch(100)])
+
+    def testLongValues(self):
+        """Compares values which share their truncated index prefix."""
+
+        from google.appengine.api.datastore_admin import GetSchema
+
+        class Note(db.Model):
+            text = db.StringProperty()
+            tag = db.StringProperty()
+
+        prefix = u'\u20ac' * 300
+        Note(key_name='b', text=prefix + u'b', tag='x').put()
+        Note(key_name='a', text=prefix + u'a', tag='x').put()
+        Note(key_name='c', text=u'c', tag='x').put()
+
+        def names(query):
+            return [n.key().name() for n in query]
+
+        self.assertEqual(
+            ['a'], names(Note.all().filter('text =', prefix + u'a')))
+        self.assertEqual(
+            ['b'], names(Note.all().filter('text >', prefix + u'a')))
+        self.assertEqual(
+            ['c', 'a'], names(Note.all().filter('text <', prefix + u'b')))
+        self.assertEqual(
+            ['b'], names(Note.all().filter('text IN', [prefix + u'b'])))
+        self.assertEqual(['c', 'a', 'b'], names(Note.all().order('text')))
+        self.assertEqual(['b', 'a', 'c'], names(Note.all().order('-text')))
+        self.assertEqual(
+            ['c', 'a', 'b'],
+            [k.name() for k in Note.all(keys_only=True).order('text')])
+        self.assertEqual(
+            ['b', 'a', 'c'],
+            names(Note.all().filter('tag =', 'x').order('-text')))
+        self.assertEqual(
+            ['a'],
+            names(Note.all().filter('tag =', 'x')
+                  .filter('text =', prefix + u'a')))
+        self.assertEqual(
+            ['a'],
+            [k.name() for k in Note.all(keys_only=True)
+             .filter('text =', prefix + u'a')])
+
+        query = Note.all().order('text')
+        self.assertEqual(['c', 'a'], names(query.fetch(2)))
+        query.with_cursor(query.cursor())
+        self.assertEqual(['b'], names(query.fetch(10)))
+
+        self.assertEqual(
+            ['tag', 'text'],
+            [p.name() for p in GetSchema()[0].property_list()])
+
+    def testCompositeIndexQueries(self):
+        """Serves queries from composite index tables."""
+
+        from google.appengine.api.datastore_admin import (
+            CreateIndex, DeleteIndex)
+
+        class Book(db.Model):
+            author = db.StringProperty()
+            tags = db.StringListProperty()
+            year = db.IntegerProperty()
+
+        for i in xrange(10):
+            Book(key_name='b%i' % i, author=['Alice', 'Bob'][i % 2],
+                 tags=['x', 'y'][:i % 3], year=2000 + i).put()
+
+        index = datastore_index.IndexDefinitionsToProtos(
+            'test', datastore_index.ParseIndexDefinitions("""
+indexes:
+- kind: Book
+  properties:
+  - name: author
+  - name: tags
+  - name: year
+    direction: desc
+""").indexes)[0]
+        CreateIndex(index)
+
+        Book(key_name='b10', author='Alice', tags=['x'], year=2010).put()
+        db.delete(db.Key.from_path('Book', 'b4'))
+
+        query = (Book.all().filter('author =', 'Alice').filter('tags =', 'x')
+                 .order('-year'))
+        self.assertEqual(['b10', 'b8', 'b2'],
+                         [b.key().name() for b in query.fetch(10)])
+
+        query = (Book.all().filter('author =', 'Bob').filter('tags =', 'y')
+                 .filter('year <', 2009).order('-year'))
+        self.assertEqual(['b5'], [b.key().name() for b in query.fetch(10)])
+
+        # Values longer than the index columns share their stored prefix.
+        long_name = 'Z' * 2000
+        Book(key_name='b11', author=long_name + 'a', tags=['x'],
+             year=2011).put()
+        Book(key_name='b12', author=long_name + 'b', tags=['x'],
+             year=2012).put()
+        query = (Book.all().filter('author =', long_name + 'a')
+                 .filter('tags =', 'x').order('-year'))
+        self.assertEqual(['b11'], [b.key().name() for b in query.fetch(10)])
+
+        DeleteIndex(index)
+
+        query = (Book.all().filter('author =', 'Alice').filter('tags =', 'x')
+                 .order('-year'))
+        self.assertEqual(['b10', 'b8', 'b2'],
+                         [b.key().name() for b in query.fetch(10)])
+
+    def testSchemaStatistics(self):
+        """Answers schema and kind statistics queries from statistics tables."""
+
+        from google.appengine.api.datastore_admin import GetSchema
+        from google.appengine.ext.db import stats
+
+        class Book(db.Model):
+            title = db.StringProperty()
+            year = db.IntegerProperty()
+
+        class Shelf(db.Model):
+            label = db.StringProperty()
+
+        books = [Book(title='b%i' % i, year=2000 + i) for i in xrange(3)]
+        db.put(books)
+        shelf = Shelf(label='x')
+        shelf.put()
+
+        schema = GetSchema()
+        self.assertEqual(
+            [('Book', ['title', 'year']), ('Shelf', ['label'])],
+            [(kind.key().path().element(0).type(),
+              [p.name() for p in kind.property_list()]) for kind in schema])
+
+        stat = stats.KindStat.all().filter('kind_name =', 'Book').get()
+        self.assertEqual(3, stat.count)
+        self.assertEqual(sum(len(db.model_to_protobuf(b).Encode())
+                             for b in books), stat.bytes)
+
+        books[0].year = None
+        books[0].put()
+        shelf.delete()
+        db.delete(books[1:])
+
+        self.assertEqual(['Book'], [kind.key().path().element(0).type()
+                                    for kind in GetSchema()])
+        self.assertEqual(
+            [(u'Book', 1)],
+            [(s.kind_name, s.count) for s in stats.KindStat.all()])
+
+    def testUpgradeTable(self):
+        """Upgrades an EntitiesByProperty table of an earlier version."""
+
+        from google.appengine.api import namespace_manager
+        from typhoonae.mysql import upgrade
+
+        conn = MySQLdb.connect(host="127.0.0.1", user="root", passwd="",
+                               db="testdb")
+        conn.cursor().execute(
+            upgrade.LEGACY_SCHEMA % {'prefix': 'test_legacy'})
+
+        # A new stub detects the table of the earlier version.
+        stub = typhoonae.mysql.datastore_mysql_stub.DatastoreMySQLStub(
+            'test', {"host": "127.0.0.1", "user": "root", "passwd": "",
+                     "db": "testdb"})
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        namespace_manager.set_namespace('legacy')
+        try:
+            db.put([Item(number=i) for i in xrange(10)])
+
+            # Earlier versions stored untruncated values, the stub writes
+            # truncated twins of them.
+            cursor = conn.cursor()
+            for value, path in (('a' * 1000, 'p1'), ('a' * 767, 'p1'),
+                                ('b' * 1000, 'p2')):
+                cursor.execute(
+                    'INSERT INTO test_legacy_EntitiesByProperty '
+                    '(kind, name, value, __path__, hashed_index) '
+                    "VALUES ('Item', 'note', %s, %s, "
+                    "MD5(CONCAT('Item', 'note', %s, %s)))",
+                    (value, path, value, path))
+            conn.commit()
+
+            self.assertEqual(
+                ['test_legacy_EntitiesByProperty'],
+                upgrade.getLegacyTables(conn, 'testdb'))
+            self.assertEqual(
+                12, upgrade.upgradeTable(conn, 'test_legacy_EntitiesByProperty',
+                                         batch_size=3))
+            self.assertEqual([], upgrade.getLegacyTables(conn, 'testdb'))
+            cursor.execute(
+                'SELECT LENGTH(value), __path__ '
+                'FROM test_legacy_EntitiesByProperty '
+                "WHERE name = 'note' ORDER BY __path__")
+            self.assertEqual(((767, 'p1'), (767, 'p2')), cursor.fetchall())
+
+            # The stub falls back to the current layout.
+            db.put([Item(number=i) for i in xrange(10, 15)])
+            self.assertEqual(
+                range(15),
+                [item.number for item in Item.all().order('number')])
+            self.assertEqual(
+                [3, 4], [item.number for item in
+                         Item.all().filter('number >', 2).filter('number <', 5)])
+        finally:
+            namespace_manager.set_namespace('')
+            conn.close()
+
     def testTransactionalTasks(self):
         """Tests tasks within transactions."""
 
@@ -1030,3 +1636,37 @@ class DatastoreMySQLTestCase(DatastoreMySQLTestCaseBase):
         self.assertEqual(1, CreateIndex(self.indices[0]))
         UpdateIndex(self.indices[0])
         DeleteIndex(self.indices[0])
+
+    def testMissingTables(self):
+        """Creates the missing tables of existing namespaces."""
+
+        from google.appengine.api import namespace_manager
+        from google.appengine.api.datastore_admin import CreateIndex
+
+        class Item(db.Model):
+            number = db.IntegerProperty()
+
+        namespace_manager.set_namespace('other')
+        try:
+            Item(number=1).put()
+        finally:
+            namespace_manager.set_namespace('')
+        self.assertEqual(1, CreateIndex(self.indices[0]))
+
+        conn = MySQLdb.connect(host="127.0.0.1", user="root", passwd="",
+                               db="testdb")
+        try:
+            cursor = conn.cursor()
+            cursor.execute('DROP TABLE test_other_CompositeIndex1')
+
+            typhoonae.mysql.datastore_mysql_stub.DatastoreMySQLStub(
+                'test', {"host": "127.0.0.1", "user": "root", "passwd": "",
+                         "db": "testdb"})
+
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = 'testdb' "
+                "AND TABLE_NAME = 'test_other_CompositeIndex1'")
+            self.assertEqual(1, cursor.fetchone()[0])
+        finally:
+            conn.close()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Upgrades the tables of the Datastore MySQL stub to the current schema.
+
+Earlier versions keyed the EntitiesByProperty tables by an md5 hash of every
+row. The current layout clusters the rows by (kind, name, value, __path__).
+
+Tables are upgraded online. Triggers mirror concurrent writes into a table
+with the new layout while existing rows get copied in batches, and finally
+both tables are swapped atomically. Running appservers keep working
+throughout. The MySQL user needs the TRIGGER privilege.
+"""
+
+import MySQLdb
+import logging
+import optparse
+import typhoonae.mysql.datastore_mysql_stub as datastore_mysql_stub
+
+DESCRIPTION = "Upgrades the tables of the Datastore MySQL stub."
+USAGE = "usage: %prog [options]"
+
+BATCH_SIZE = 1000
+
+# The layout of earlier versions.
+LEGACY_SCHEMA = """
+CREATE TABLE %(prefix)s_EntitiesByProperty (
+  kind VARCHAR(255) NOT NULL,
+  name VARCHAR(255) NOT NULL,
+  value BLOB NOT NULL,
+  __path__ VARCHAR(255) NOT NULL REFERENCES Entities,
+  hashed_index CHAR(32) NOT NULL,
+  PRIMARY KEY(hashed_index),
+  INDEX(value(32))
+) ENGINE=InnoDB;
+"""
+
+_INSERT_TRIGGER = """
+CREATE TRIGGER %(table)s_ins AFTER INSERT ON %(table)s FOR EACH ROW
+  INSERT IGNORE INTO %(new_table)s (kind, name, value, __path__)
+  VALUES (NEW.kind, NEW.name, LEFT(NEW.value, %(length)d), NEW.__path__)
+"""
+
+_DELETE_TRIGGER = """
+CREATE TRIGGER %(table)s_del AFTER DELETE ON %(table)s FOR EACH ROW
+  DELETE FROM %(new_table)s
+  WHERE kind = OLD.kind AND name = OLD.name
+  AND value = LEFT(OLD.value, %(length)d) AND __path__ = OLD.__path__
+"""
+
+
+def getLegacyTables(conn, db):
+    """Returns the names of all tables which need to be upgraded.
+
+    Args:
+        conn: A MySQL connection.
+        db: The database name.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT TABLE_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = %s AND COLUMN_NAME = 'hashed_index' "
+        "ORDER BY TABLE_NAME", (db,))
+    tables = [row[0] for row in cursor.fetchall()
+              if row[0].endswith('_EntitiesByProperty')]
+    cursor.close()
+    return tables
+
+
+def _dropTriggers(cursor, table):
+    cursor.execute('DROP TRIGGER IF EXISTS %s_ins' % table)
+    cursor.execute('DROP TRIGGER IF EXISTS %s_del' % table)
+
+
+def _normalizeBatch(cursor, format_args, batch, params):
+    """Truncates the legacy values of a batch of copied rows.
+
+    Rows of earlier versions hold untruncated values and hashes, whereas
+    the stub writes truncated ones, so queries and hashes of the legacy table
+    agree until it gets swapped. A row whose truncated twin already exists
+    is deleted. The delete trigger removes the twin's copy along with it,
+    which is inserted again.
+
+    Args:
+        cursor: A MySQL cursor.
+        format_args: The format arguments of upgradeTable.
+        batch: A condition selecting the batch's rows.
+        params: The parameters of the condition.
+    """
+    long_values = ' AND LENGTH(value) > %(length)d' % format_args
+    cursor.execute(
+        'UPDATE IGNORE %(table)s SET value = LEFT(value, %(length)d), '
+        'hashed_index = MD5(CONCAT(kind, name, LEFT(value, %(length)d), '
+        '__path__)) ' % format_args + batch + long_values, params)
+    cursor.execute(
+        'SELECT kind, name, LEFT(value, %(length)d), __path__ '
+        'FROM %(table)s ' % format_args + batch + long_values, params)
+    twins = cursor.fetchall()
+    if not twins:
+        return
+    cursor.execute('DELETE FROM %(table)s ' % format_args + batch +
+                   long_values, params)
+    cursor.executemany(
+        'INSERT IGNORE INTO %(new_table)s (kind, name, value, __path__) '
+        'VALUES (%%s, %%s, %%s, %%s)' % format_args, twins)
+
+
+def upgradeTable(conn, table, batch_size=BATCH_SIZE):
+    """Converts an EntitiesByProperty table to the current layout.
+
+    Legacy values are truncated in both tables while they get copied. An
+    interrupted upgrade can simply be started again.
+
+    Args:
+        conn: A MySQL connection.
+        table: The table name.
+        batch_size: Number of rows copied per transaction.
+
+    Returns:
+        The number of copied rows.
+    """
+    format_args = {
+        'table': table,
+        'new_table': table + '_upgrade',
+        'old_table': table + '_legacy',
+        'length': datastore_mysql_stub._MAX_KEY_PART_LENGTH,
+    }
+
+    cursor = conn.cursor()
+    _dropTriggers(cursor, table)
+    cursor.execute('DROP TABLE IF EXISTS %(new_table)s' % format_args)
+    cursor.execute('DROP TABLE IF EXISTS %(old_table)s' % format_args)
+    cursor.execute(datastore_mysql_stub._ENTITIES_BY_PROPERTY_SCHEMA %
+                   {'table': format_args['new_table']})
+    cursor.execute(_INSERT_TRIGGER % format_args)
+    cursor.execute(_DELETE_TRIGGER % format_args)
+
+    copy = ('INSERT IGNORE INTO %(new_table)s (kind, name, value, __path__) '
+            'SELECT kind, name, LEFT(value, %(length)d), __path__ '
+            'FROM %(table)s ' % format_args)
+
+    copied = 0
+    last = ''
+    while True:
+        # Finds the upper bound of the next batch on the old primary key.
+        cursor.execute(
+            'SELECT hashed_index FROM %s WHERE hashed_index > %%s '
+            'ORDER BY hashed_index LIMIT %d, 1' % (table, batch_size - 1),
+            (last,))
+        row = cursor.fetchone()
+        batch, params = 'WHERE hashed_index > %s', (last,)
+        if row is not None:
+            batch += ' AND hashed_index <= %s'
+            params += (row[0],)
+        cursor.execute(copy + batch, params)
+        copied += cursor.rowcount
+        # Normalized rows get new hashes, so they are normalized after they
+        # have been copied.
+        _normalizeBatch(cursor, format_args, batch, params)
+        conn.commit()
+        if row is None:
+            break
+        last = row[0]
+
+    cursor.execute('RENAME TABLE %(table)s TO %(old_table)s, '
+                   '%(new_table)s TO %(table)s' % format_args)
+    # Triggers keep their names when the table gets renamed.
+    _dropTriggers(cursor, table)
+    cursor.execute('DROP TABLE %(old_table)s' % format_args)
+    cursor.close()
+    return copied
+
+
+def main():
+    """Upgrades all tables of a database."""
+
+    op = optparse.OptionParser(description=DESCRIPTION, usage=USAGE)
+
+    op.add_option("--batch_size", dest="batch_size", metavar="NUMBER",
+                  help="number of rows copied per transaction",
+                  default=BATCH_SIZE, type="int")
+
+    op.add_option("--mysql_db", dest="mysql_db", metavar="STRING",
+                  help="upgrade this MySQL database",
+                  default='typhoonae')
+
+    op.add_option("--mysql_host", dest="mysql_host", metavar="ADDR",
+                  help="connect to this MySQL database server",
+                  default='127.0.0.1')
+
+    op.add_option("--mysql_passwd", dest="mysql_passwd", metavar="PASSWORD",
+                  help="use this password to connect to the MySQL database "
+                       "server", default='')
+
+    op.add_option("--mysql_user", dest="mysql_user", metavar="USER",
+                  help="use this user to connect to the MySQL database server",
+                  default='root')
+
+    (options, args) = op.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    conn = MySQLdb.connect(host=options.mysql_host, user=options.mysql_user,
+                           passwd=options.mysql_passwd, db=options.mysql_db)
+    try:
+        tables = getLegacyTables(conn, options.mysql_db)
+        if not tables:
+            logging.info("All tables are up to date.")
+        for table in tables:
+            logging.info("Upgrading %s", table)
+            copied = upgradeTable(conn, table, options.batch_size)
+            logging.info("Upgraded %s, copied %i rows", table, copied)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
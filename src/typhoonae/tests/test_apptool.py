@@ -45,6 +45,8 @@ class ApptoolTestCase(unittest.TestCase):
             blobstore_path = "/tmp/blobstore"
             current_version_id = None
             datastore = "mongodb"
+            datastore_cache = None
+            datastore_query_cache = None
             develop_mode = False
             fcgi_host = "localhost"
             fcgi_port = 8081
@@ -62,6 +64,12 @@ class ApptoolTestCase(unittest.TestCase):
             internal_address = "localhost:8770"
             login_url = None
             logout_url = None
+            mongodb_pool_size = None
+            mongodb_read_preference = None
+            mongodb_replica_set = None
+            mongodb_timeout = None
+            mongodb_uri = None
+            mongodb_write_concern = None
             multiple = False
             password = ""
             rdbms_sqlite_path = None
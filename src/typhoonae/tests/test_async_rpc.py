@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for asynchronous API calls."""
+
+from google.appengine.datastore import datastore_pb
+
+import threading
+import typhoonae.async_rpc
+import unittest
+
+
+class StubMock(object):
+    """Stub whose calls block until they are released."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def MakeSyncCall(self, service, call, request, response):
+        self.started.set()
+        self.release.wait()
+        if call == 'Fail':
+            raise ValueError(request)
+        response.append(request)
+
+
+class AsyncRPCTestCase(unittest.TestCase):
+    """Tests the thread pool and the asynchronous RPC."""
+
+    def setUp(self):
+        self.pool = typhoonae.async_rpc.ThreadPool(4)
+
+    def testConcurrency(self):
+        """Runs calls without a key concurrently."""
+
+        first, second = threading.Event(), threading.Event()
+
+        def waitFor(event, other):
+            other.set()
+            assert event.wait(5) or event.isSet()
+
+        a = self.pool.submit(waitFor, (first, second))
+        b = self.pool.submit(waitFor, (second, first))
+        a.wait()
+        b.wait()
+
+    def testSerialKeys(self):
+        """Runs calls with the same key in order."""
+
+        order = []
+        calls = [self.pool.submit(order.append, (i,), key='tx')
+                 for i in xrange(20)]
+        for call in calls:
+            call.wait()
+        self.assertEqual(range(20), order)
+
+    def testException(self):
+        """Re-raises the exception of a call."""
+
+        def fail():
+            raise ValueError('failed')
+
+        call = self.pool.submit(fail)
+        self.assertRaises(ValueError, call.wait)
+        self.assertTrue(call.done())
+
+    def testTransactionKey(self):
+        """Finds the transaction of a call."""
+
+        transaction = datastore_pb.Transaction()
+        transaction.set_handle(7)
+        self.assertEqual(
+            7, typhoonae.async_rpc.transactionKey('Commit', transaction))
+        request = datastore_pb.GetRequest()
+        self.assertEqual(
+            None, typhoonae.async_rpc.transactionKey('Get', request))
+        request.mutable_transaction().CopyFrom(transaction)
+        self.assertEqual(
+            7, typhoonae.async_rpc.transactionKey('Get', request))
+
+    def testAsyncRPC(self):
+        """Starts the call when it is made and finishes it on wait."""
+
+        stub = StubMock()
+        results = []
+        rpc = typhoonae.async_rpc.AsyncRPC(
+            self.pool, stub=stub, callback=lambda: results.append('callback'))
+        rpc.MakeCall('service', 'Call', 'request', results)
+        stub.started.wait(5)
+        self.assertTrue(stub.started.isSet())
+        self.assertEqual([], results)
+        stub.release.set()
+        rpc.Wait()
+        rpc.CheckSuccess()
+        self.assertEqual(['request', 'callback'], results)
+
+        rpc = typhoonae.async_rpc.AsyncRPC(self.pool, stub=stub)
+        rpc.MakeCall('service', 'Fail', 'request', results)
+        rpc.Wait()
+        self.assertRaises(ValueError, rpc.CheckSuccess)
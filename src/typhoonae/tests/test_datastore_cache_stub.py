@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for the Datastore cache stub."""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import memcache
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import db
+
+import os
+import typhoonae.datastore_cache_stub
+import unittest
+
+
+class Post(db.Model):
+    title = db.StringProperty()
+
+
+class Comment(db.Model):
+    text = db.StringProperty()
+
+
+class DatastoreCacheStubTestCase(unittest.TestCase):
+    """Tests the Datastore cache stub."""
+
+    def setUp(self):
+        """Wraps a file stub with the cache stub."""
+
+        os.environ['APPLICATION_ID'] = 'test'
+
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        self.backend = datastore_file_stub.DatastoreFileStub('test', None)
+        self.stub = typhoonae.datastore_cache_stub.DatastoreCacheStub(
+            self.backend, typhoonae.datastore_cache_stub.parseKinds('Post'),
+            query_cache_size=100)
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.stub)
+        apiproxy_stub_map.apiproxy.RegisterStub(
+            'memcache', memcache_stub.MemcacheServiceStub())
+
+    def tearDown(self):
+        """Clears the stubs."""
+
+        self.stub.Clear()
+
+    def testParseKinds(self):
+        """Parses kinds and their TTLs."""
+
+        self.assertEqual(
+            {'Post': 60, 'Comment': 10, '*': 5},
+            typhoonae.datastore_cache_stub.parseKinds('Post, Comment:10,*:5'))
+
+    def testReadThrough(self):
+        """Serves entities from the cache after the first get."""
+
+        key = Post(title='Hello').put()
+        self.assertEqual('Hello', Post.get(key).title)
+        self.assertEqual(
+            {'local_hits': 0, 'memcache_hits': 0, 'misses': 1,
+             'hit_ratio': 0.0, 'query_hits': 0, 'query_misses': 0,
+             'query_hit_ratio': 0.0},
+            self.stub.GetStats())
+
+        # Changes behind the cache's back are not seen.
+        self.backend.Clear()
+        self.assertEqual('Hello', Post.get(key).title)
+        self.assertEqual(1, self.stub.GetStats()['local_hits'])
+
+        # Another process would find the entity in memcache.
+        self.stub._local_cache.clear()
+        self.assertEqual('Hello', Post.get(key).title)
+        self.assertEqual(1, self.stub.GetStats()['memcache_hits'])
+        self.assertAlmostEqual(2 / 3.0, self.stub.GetStats()['hit_ratio'])
+
+    def testInvalidate(self):
+        """Puts and deletes invalidate cached entities."""
+
+        key = Post(title='Hello').put()
+        post = Post.get(key)
+        post.title = 'Bye'
+        post.put()
+        self.assertEqual('Bye', Post.get(key).title)
+        db.delete(key)
+        self.assertEqual(None, Post.get(key))
+        self.assertEqual(0, self.stub.GetStats()['local_hits'])
+
+    def testConcurrentWrite(self):
+        """Doesn't cache entities read before a concurrent write."""
+
+        key = Post(title='Hello').put()
+        backend_call = self.backend.MakeSyncCall
+
+        def getThenWrite(service, call, request, response):
+            backend_call(service, call, request, response)
+            if call == 'Get':
+                self.backend.MakeSyncCall = backend_call
+                Post(key=key, title='Bye').put()
+
+        self.backend.MakeSyncCall = getThenWrite
+        self.assertEqual('Hello', Post.get(key).title)
+        self.assertEqual('Bye', Post.get(key).title)
+        self.stub._local_cache.clear()
+        self.assertEqual('Bye', Post.get(key).title)
+
+    def testMixedKinds(self):
+        """Only caches opted in kinds."""
+
+        post_key = Post(title='Hello').put()
+        comment_key = Comment(text='Nice').put()
+        db.get([post_key, comment_key])
+        posts, comments = db.get([post_key, comment_key])
+        self.assertEqual('Nice', comments.text)
+        self.assertEqual(1, self.stub.GetStats()['local_hits'])
+        self.assertEqual(
+            None,
+            memcache.get(comment_key._ToPb().Encode(),
+                         namespace=typhoonae.datastore_cache_stub.
+                         MEMCACHE_NAMESPACE))
+
+    def testTransactions(self):
+        """Bypasses the cache in transactions and invalidates on commit."""
+
+        key = Post(title='Hello').put()
+        Post.get(key)
+
+        def update():
+            post = Post.get(key)
+            post.title = 'Bye'
+            post.put()
+            # The cached entity stays valid until the transaction commits.
+            self.assertTrue(key._ToPb().Encode() in self.stub._local_cache)
+
+        db.run_in_transaction(update)
+        self.assertEqual('Bye', Post.get(key).title)
+        self.assertEqual(0, self.stub.GetStats()['local_hits'])
+
+    def testDelegation(self):
+        """Exposes the wrapped stub."""
+
+        Post(title='Hello').put()
+        self.assertEqual(1, Post.all().count())
+        self.assertEqual(1, len(self.stub.QueryHistory()))
+
+    def testQueryCache(self):
+        """Caches query results until the kind is written."""
+
+        Post(title='a').put()
+        self.assertEqual(['a'], [p.title for p in Post.all().fetch(10)])
+        self.assertEqual(['a'], [p.title for p in Post.all().fetch(10)])
+        self.assertEqual(1, len(Post.all(keys_only=True).fetch(10)))
+        stats = self.stub.GetStats()
+        self.assertEqual((1, 2), (stats['query_hits'], stats['query_misses']))
+
+        Post(title='b').put()
+        self.assertEqual(2, len(Post.all().fetch(10)))
+        self.assertEqual(3, self.stub.GetStats()['query_misses'])
+
+        # Queries of other kinds and without a limit are not cached.
+        Comment(text='Nice').put()
+        Comment.all().fetch(10)
+        Comment.all().fetch(10)
+        list(Post.all())
+        list(Post.all())
+        self.assertEqual(3, self.stub.GetStats()['query_misses'])
+
+    def testEvictedGenerations(self):
+        """Doesn't serve queries cached before their counters were lost."""
+
+        Post(title='a').put()
+        memcache.flush_all()
+        self.assertEqual(1, len(Post.all().fetch(10)))
+        Post(title='b').put()
+        memcache.flush_all()
+        self.assertEqual(2, len(Post.all().fetch(10)))
+        self.assertEqual(0, self.stub.GetStats()['query_hits'])
+
+    def testAncestorQueryCache(self):
+        """Only writes to their entity group invalidate ancestor queries."""
+
+        parent = Post(title='parent').put()
+        Post(parent=parent, title='child').put()
+
+        def query():
+            return Post.all().ancestor(parent).fetch(10)
+
+        self.assertEqual(2, len(query()))
+        Post(title='other').put()
+        self.assertEqual(2, len(query()))
+        self.assertEqual(1, self.stub.GetStats()['query_hits'])
+
+        Post(parent=parent, title='another child').put()
+        self.assertEqual(3, len(query()))
+        self.assertEqual(2, self.stub.GetStats()['query_misses'])
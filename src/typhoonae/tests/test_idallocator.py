@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for the ID block allocator."""
+
+import threading
+import typhoonae.idallocator
+import unittest
+
+
+class ClockMock(object):
+    """Clock which only advances when told to."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CounterMock(object):
+    """Shared counters which record their reservations."""
+
+    def __init__(self):
+        self.next_ids = {}
+        self.reservations = []
+        self.lock = threading.Lock()
+
+    def __call__(self, key, size):
+        self.lock.acquire()
+        try:
+            first = self.next_ids.get(key, 1)
+            self.next_ids[key] = first + size
+            self.reservations.append((key, size))
+            return first
+        finally:
+            self.lock.release()
+
+
+class SharedCounter(object):
+    """Counter in shared memory which serves several processes."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, key, size):
+        self.value.get_lock().acquire()
+        try:
+            first = self.value.value
+            self.value.value += size
+            return first
+        finally:
+            self.value.get_lock().release()
+
+
+def allocateInProcess(value, count, queue):
+    """Allocates IDs with an allocator of its own and reports them."""
+
+    allocator = typhoonae.idallocator.IdAllocator(SharedCounter(value))
+    queue.put([allocator.allocate('Kind') for i in xrange(count)])
+
+
+class IdAllocatorTestCase(unittest.TestCase):
+    """Tests the ID block allocator."""
+
+    def setUp(self):
+        """Creates an allocator with a mocked counter and clock."""
+
+        self.clock = ClockMock()
+        self.counter = CounterMock()
+        self.allocator = typhoonae.idallocator.IdAllocator(
+            self.counter, min_block_size=10, max_block_size=80, interval=10,
+            clock=self.clock)
+
+    def testAllocate(self):
+        """Hands out consecutive IDs from a single reservation."""
+
+        self.assertEqual(range(1, 11),
+                         [self.allocator.allocate('A') for i in xrange(10)])
+        self.assertEqual(1, self.allocator.allocate('B'))
+        self.assertEqual([('A', 10), ('B', 10)], self.counter.reservations)
+
+    def testAdaptiveBlockSize(self):
+        """Adapts the block size to the rate of allocations."""
+
+        for i in xrange(70):
+            self.allocator.allocate('A')
+        self.assertEqual([10, 20, 40],
+                         [size for _, size in self.counter.reservations])
+
+        self.clock.now = 100
+        for i in xrange(21):
+            self.allocator.allocate('A')
+        self.assertEqual([10, 20, 40, 20, 40],
+                         [size for _, size in self.counter.reservations])
+
+        for i in xrange(200):
+            self.allocator.allocate('A')
+        self.assertEqual(
+            80, max(size for _, size in self.counter.reservations))
+
+    def testLargeAllocation(self):
+        """Reserves large ranges directly."""
+
+        self.assertEqual(1, self.allocator.allocate('A'))
+        self.assertEqual(11, self.allocator.allocate('A', 100))
+        self.assertEqual(2, self.allocator.allocate('A'))
+
+    def testDiscard(self):
+        """Forgets unused IDs."""
+
+        self.assertEqual(1, self.allocator.allocate('A'))
+        self.allocator.discard('A')
+        self.assertEqual(11, self.allocator.allocate('A'))
+        self.allocator.clear()
+        self.assertEqual(21, self.allocator.allocate('A'))
+
+    def testThreads(self):
+        """Never hands out an ID twice to concurrent threads."""
+
+        ids = []
+
+        def allocate():
+            result = [self.allocator.allocate('A') for i in xrange(500)]
+            self.counter.lock.acquire()
+            ids.extend(result)
+            self.counter.lock.release()
+
+        threads = [threading.Thread(target=allocate) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(4000, len(set(ids)))
+
+    def testProcesses(self):
+        """Never hands out an ID twice to processes sharing a counter."""
+
+        import multiprocessing
+
+        value = multiprocessing.Value('l', 1)
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=allocateInProcess,
+                                    args=(value, 1000, queue))
+            for i in xrange(4)]
+        for process in processes:
+            process.start()
+        ids = []
+        for process in processes:
+            ids.extend(queue.get())
+        for process in processes:
+            process.join()
+
+        self.assertEqual(4000, len(set(ids)))
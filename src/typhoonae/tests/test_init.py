@@ -41,10 +41,18 @@ class InitTestCase(unittest.TestCase):
         class TestOptions:
             blobstore_path = 'blobstore'
             datastore = 'mongodb'
+            datastore_cache = None
+            datastore_query_cache = 0
             http_port = 8080
             internal_address = 'localhost:8770'
             login_url = '/_ah/login'
             logout_url = '/_ah/logout'
+            mongodb_pool_size = 10
+            mongodb_read_preference = 'primary'
+            mongodb_replica_set = None
+            mongodb_timeout = None
+            mongodb_uri = None
+            mongodb_write_concern = None
             rdbms_sqlite_path = os.path.join(tempfile.gettempdir(), 'test.db')
             server_name = 'localhost'
             smtp_host = 'localhost'
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for the bounded LRU cache."""
+
+import typhoonae.lrucache
+import unittest
+
+
+class ClockMock(object):
+    """Clock which only advances when told to."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """Tests the LRU cache."""
+
+    def setUp(self):
+        """Creates a cache which records evictions."""
+
+        self.clock = ClockMock()
+        self.evicted = []
+        self.cache = typhoonae.lrucache.LRUCache(
+            3, ttl=10, clock=self.clock,
+            on_evict=lambda k, v: self.evicted.append((k, v)))
+
+    def testGetPut(self):
+        """Stores and retrieves items."""
+
+        self.cache.put('a', 1)
+        self.cache['b'] = 2
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(2, self.cache.get('b'))
+        self.assertEqual(None, self.cache.get('c'))
+        self.assertTrue('a' in self.cache)
+        self.assertFalse('c' in self.cache)
+        self.assertEqual(2, len(self.cache))
+
+    def testEviction(self):
+        """Evicts the least recently used item when full."""
+
+        for key in 'abc':
+            self.cache.put(key, key.upper())
+        self.cache.get('a')
+        self.cache.put('d', 'D')
+
+        self.assertEqual([('b', 'B')], self.evicted)
+        self.assertEqual(['c', 'a', 'd'], [k for k, v in self.cache.items()])
+
+        self.cache.trim(1)
+        self.assertEqual([('b', 'B'), ('c', 'C'), ('a', 'A')], self.evicted)
+        self.assertEqual(['d'], [k for k, v in self.cache.items()])
+
+    def testExpiration(self):
+        """Expires items after their time to live."""
+
+        self.cache.put('a', 1)
+        self.cache.put('b', 2, ttl=20)
+        self.clock.now = 10
+
+        self.assertEqual(None, self.cache.get('a'))
+        self.assertEqual([('a', 1)], self.evicted)
+
+        self.cache.expire()
+        self.assertEqual(2, self.cache.get('b'))
+
+        self.clock.now = 20
+        self.cache.expire()
+        self.assertEqual(0, len(self.cache))
+
+    def testPopAndClear(self):
+        """Pops items silently and evicts all items on clear."""
+
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+
+        self.assertEqual(1, self.cache.pop('a'))
+        self.assertEqual(None, self.cache.pop('a'))
+        self.assertEqual([], self.evicted)
+
+        self.cache.clear()
+        self.assertEqual([('b', 2)], self.evicted)
+        self.assertEqual(0, len(self.cache))
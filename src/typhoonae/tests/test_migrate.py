@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Tobias Rodäbel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for the Datastore migration tool."""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import namespace_manager
+
+import os
+import shutil
+import tempfile
+import typhoonae.migrate
+import unittest
+
+
+class MigrateTestCase(unittest.TestCase):
+    """Tests copying entities between two SQLite files."""
+
+    def setUp(self):
+        """Fills the source datastore."""
+
+        os.environ['APPLICATION_ID'] = 'test'
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = self.sourceSpec()
+        self.destination = 'sqlite:' + os.path.join(self.tmpdir, 'dest')
+        self.checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+
+        self.useStub(self.source)
+        self.keys = datastore.Put(
+            [datastore.Entity('Item', id=i + 1) for i in xrange(25)])
+        parent = self.keys[0]
+        self.keys.append(datastore.Put(datastore.Entity('Part', parent=parent,
+                                                        name='part')))
+        namespace_manager.set_namespace('other')
+        try:
+            self.other = datastore.Put(datastore.Entity('Item'))
+        finally:
+            namespace_manager.set_namespace('')
+
+    def tearDown(self):
+        """Removes the datastore files."""
+
+        shutil.rmtree(self.tmpdir)
+
+    def sourceSpec(self):
+        return 'sqlite:' + os.path.join(self.tmpdir, 'source')
+
+    def useStub(self, spec):
+        self.stub = typhoonae.migrate.createStub(spec, 'test')
+        apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+        apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.stub)
+
+    def migrate(self):
+        return typhoonae.migrate.migrate(
+            self.source, self.destination, 'test', ['', 'other'],
+            checkpoint_path=self.checkpoint, workers=2, batch_size=10)
+
+    def testMigrate(self):
+        """Copies all kinds and namespaces and keeps the IDs."""
+
+        self.assertEqual([], self.migrate())
+
+        self.useStub(self.destination)
+        self.assertEqual(len(self.keys), len(
+            [e for e in datastore.Get(self.keys) if e is not None]))
+        self.assertNotEqual(None, datastore.Get(self.other))
+        new_key = datastore.Put(datastore.Entity('Item'))
+        self.assertTrue(new_key.id() > 25)
+
+    def testResume(self):
+        """Skips kinds the checkpoint marks as done."""
+
+        checkpoint = typhoonae.migrate.Checkpoint(self.checkpoint)
+        checkpoint.get('', 'Part')['done'] = True
+        checkpoint.save()
+
+        self.assertEqual([], self.migrate())
+
+        self.useStub(self.destination)
+        self.assertEqual([None], datastore.Get([self.keys[-1]]))
+        self.assertNotEqual(None, datastore.Get(self.keys[0]))
+
+    def testNoKinds(self):
+        """Fails if the source reports no kinds."""
+
+        self.assertRaises(
+            ValueError, typhoonae.migrate.migrate,
+            'sqlite:' + os.path.join(self.tmpdir, 'empty'), self.destination,
+            'test', [''])
+
+
+class MongoMigrateTestCase(MigrateTestCase):
+    """Tests copying entities from MongoDB to a SQLite file."""
+
+    def tearDown(self):
+        """Clears the source datastore."""
+
+        self.useStub(self.source)
+        self.stub.Clear()
+        super(MongoMigrateTestCase, self).tearDown()
+
+    def sourceSpec(self):
+        return 'mongodb:'
+
+    def testDiscovery(self):
+        """Finds the namespaces and kinds of the source."""
+
+        self.assertEqual(['', 'other'], typhoonae.migrate.getNamespaces(
+            self.stub, 'test'))
+        self.assertEqual(['Item', 'Part'], typhoonae.migrate.getKinds(
+            self.stub, 'test', ''))
+        self.assertEqual([], typhoonae.migrate.migrate(
+            self.source, self.destination, 'test', None, workers=2))
+
+        self.useStub(self.destination)
+        self.assertNotEqual(None, datastore.Get(self.other))
+        self.assertNotEqual(None, datastore.Get(self.keys[-1]))